@@ -0,0 +1,73 @@
+# IMPORTS
+from sql_queries import aggregate_tables, aggregate_measures
+
+FACT_TABLE = 'i94_immigration'
+
+
+def table_rows(fetch_all, tables=aggregate_tables):
+    """
+    Reads the current row count of each aggregate table, to size the registry
+    with real numbers instead of the estimates in 'aggregate_tables'.
+
+    Args:
+        fetch_all (function): Executes a query and returns all rows.
+        tables (list): Aggregate table definitions.
+    Returns:
+        dict: Table name mapped to its row count.
+    """
+    return dict((table['table'], fetch_all('SELECT COUNT(*) FROM {};'.format(table['table']))[0][0])
+                for table in tables)
+
+
+def find_aggregate(dimensions, measures, filters=None, row_counts=None, tables=aggregate_tables):
+    """
+    Finds the smallest aggregate table that can answer a query: it must be grouped
+    by every dimension the query groups or filters on, and the measures must be
+    known. Falls back to 'i94_immigration' when no aggregate qualifies.
+
+    Args:
+        dimensions (list): Columns to group by, example: ['i94addr'].
+        measures (list): Measures from 'aggregate_measures', example: ['arrivals'].
+        filters (dict): Column mapped to the value it must equal, example: {'i94yr': 2016}.
+        row_counts (dict): Table mapped to row count (see 'table_rows'); estimates are used if missing.
+        tables (list): Aggregate table definitions.
+    Returns:
+        str: Table name.
+    """
+    unknown = [measure for measure in measures if measure not in aggregate_measures]
+    if unknown:
+        raise ValueError('Unknown measures: {}'.format(', '.join(unknown)))
+    needed = set(dimensions) | set(filters or {})
+    row_counts = row_counts or {}
+    matches = [table for table in tables if needed <= set(table['dimensions'])]
+    if not matches:
+        return FACT_TABLE
+    return min(matches, key=lambda table: row_counts.get(table['table'], table['rows_per_month'] * 12))['table']
+
+
+def aggregate_query(dimensions, measures, filters=None, row_counts=None, tables=aggregate_tables, schema=None):
+    """
+    Builds the query for a dashboard request against the smallest aggregate that
+    answers it (see 'find_aggregate'), rolling the aggregate up to 'dimensions'.
+
+    Args:
+        dimensions (list): Columns to group by.
+        measures (list): Measures from 'aggregate_measures'.
+        filters (dict): Column mapped to the value it must equal.
+        row_counts (dict): Table mapped to row count.
+        tables (list): Aggregate table definitions.
+        schema (str): Schema to name the table in; unqualified if None.
+    Returns:
+        tuple: (query, parameters, table); parameters use the psycopg2 '%s' style.
+    """
+    filters = filters or {}
+    table = find_aggregate(dimensions, measures, filters, row_counts, tables)
+    expression = 1 if table == FACT_TABLE else 0
+    select_list = list(dimensions) + ['{} AS {}'.format(aggregate_measures[measure][expression], measure)
+                                      for measure in measures]
+    query = 'SELECT {} FROM {}'.format(', '.join(select_list), table if schema is None else schema + '.' + table)
+    if filters:
+        query += ' WHERE ' + ' AND '.join('{} = %s'.format(column) for column in sorted(filters))
+    if dimensions:
+        query += ' GROUP BY {} ORDER BY {}'.format(', '.join(dimensions), ', '.join(dimensions))
+    return query + ';', [filters[column] for column in sorted(filters)], table
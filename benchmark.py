@@ -0,0 +1,187 @@
+# IMPORTS
+import argparse
+import glob
+import json
+import os
+import tempfile
+import pyarrow.parquet as pq
+import local_engine
+from synthetic_i94 import SCALES, parse_rows, read_samples, read_lookup_codes, learn, generate
+
+# Tables whose row count must match the baseline exactly at each scale.
+CHECKED_TABLES = ['staging_i94_immigration', 'i94_immigration', 'us_state_visitor_demographics', 'load_watermark']
+
+
+def scale_name(rows):
+    """
+    Args:
+        rows (int): Row count.
+    Returns:
+        str: Scale label, example: '10M'.
+    """
+    for name, scale_rows in SCALES.items():
+        if scale_rows == rows:
+            return name
+    return str(rows)
+
+
+def synthetic_data(rows, data_dir, model_cache):
+    """
+    Returns the parquet glob of the synthetic dataset for 'rows', generating it
+    first if it does not exist yet.
+
+    Args:
+        rows (int): Rows in the dataset.
+        data_dir (str): Directory holding one subfolder per scale.
+        model_cache (dict): Generator model, learned on first use.
+    Returns:
+        str: Parquet glob.
+    """
+    output_dir = os.path.join(data_dir, scale_name(rows))
+    path = os.path.join(output_dir, 'parquet', 'part-*')
+    files = glob.glob(path)
+    if files and sum(pq.ParquetFile(f).metadata.num_rows for f in files) == rows:
+        return path
+    if 'model' not in model_cache:
+        model_cache['model'] = learn(read_samples(), read_lookup_codes())
+    generate(model_cache['model'], rows, output_dir)
+    return path
+
+
+def run_scale(rows, i94_path, work_dir):
+    """
+    Runs the local ETL flow on one synthetic dataset.
+
+    Args:
+        rows (int): Rows in the dataset.
+        i94_path (str): Parquet glob of the dataset.
+        work_dir (str): Directory for the on-disk DuckDB database.
+    Returns:
+        dict: {'rows', 'stages': {stage: seconds}, 'tables': {table: rows}}.
+    """
+    local_engine.LOCAL_DATA['i94_immigration_data'] = i94_path
+    database = os.path.join(work_dir, 'benchmark_{}.duckdb'.format(rows))
+    try:
+        stages = local_engine.main(database)
+    finally:
+        for path in glob.glob(database + '*'):
+            os.remove(path)
+    tables = {}
+    for record in local_engine.RUN_LOG.summary('success')['steps']:
+        if record['step'] in ('load_staging_tables', 'insert_tables') and record.get('rows') is not None:
+            tables[record['table']] = record['rows']
+    return {'rows': rows, 'stages': stages, 'tables': tables}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Checks each scale against the baseline: row counts must match exactly and no
+    stage may be more than 'tolerance' slower.
+
+    Args:
+        results (dict): Scale label mapped to the output of 'run_scale'.
+        baseline (dict): Stored results of a previous benchmark.
+        tolerance (float): Allowed slowdown, example: 0.25 for 25%.
+    Returns:
+        tuple: (passed_tests, failed_tests), lists of (scale, check, value, baseline value).
+    """
+    passed_tests = []
+    failed_tests = []
+    for scale, result in sorted(results.items()):
+        if scale not in baseline:
+            passed_tests.append((scale, 'baseline', 'not available', None))
+            continue
+        for table in CHECKED_TABLES:
+            value = result['tables'].get(table)
+            expected = baseline[scale]['tables'].get(table)
+            (passed_tests if value == expected else failed_tests).append((scale, table + ' rows', value, expected))
+        for stage, seconds in result['stages'].items():
+            expected = baseline[scale]['stages'].get(stage)
+            if expected is None:
+                continue
+            # Sub-second stages are dominated by noise; compare them with a 1s floor.
+            slower = seconds > max(expected, 1.0) * (1 + tolerance)
+            (failed_tests if slower else passed_tests).append((scale, stage + ' seconds', round(seconds, 2), round(expected, 2)))
+    return passed_tests, failed_tests
+
+
+def print_report(results):
+    """
+    Prints the seconds per stage at each scale, the throughput and how the time
+    grows relative to the smallest scale (1.00x per 1.00x rows is linear).
+
+    Args:
+        results (dict): Scale label mapped to the output of 'run_scale'.
+    Returns:
+        None
+    """
+    ordered = sorted(results.values(), key=lambda result: result['rows'])
+    base = ordered[0]
+    print('{:<28}'.format('STAGE') + ''.join('{:>14}'.format(scale_name(result['rows'])) for result in ordered))
+    for stage in base['stages']:
+        print('{:<28}'.format(stage) + ''.join('{:>13.2f}s'.format(result['stages'][stage]) for result in ordered))
+    totals = [sum(result['stages'].values()) for result in ordered]
+    print('{:<28}'.format('TOTAL') + ''.join('{:>13.2f}s'.format(total) for total in totals))
+    print('{:<28}'.format('rows/s') + ''.join('{:>14,.0f}'.format(result['rows'] / total)
+                                              for result, total in zip(ordered, totals)))
+    print('{:<28}'.format('time growth / row growth') +
+          ''.join('{:>14.2f}'.format((total / totals[0]) / (float(result['rows']) / base['rows']))
+                  for result, total in zip(ordered, totals)))
+
+
+def main():
+    """
+    Generates synthetic i94 data at each scale, runs the local ETL on it, prints
+    how every stage scales and checks the results against the stored baseline.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the ETL stages on synthetic I94 data.')
+    parser.add_argument('--scales', type=parse_rows, nargs='+', default=[SCALES['1M'], SCALES['10M']],
+                        help='row counts to benchmark, example: 1M 10M 100M (default 1M 10M)')
+    parser.add_argument('--data-dir', default='synthetic_data')
+    parser.add_argument('--work-dir', default=None,
+                        help='directory for the DuckDB database files (default: a temporary directory)')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown per stage before the benchmark fails (default 0.25)')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    args = parser.parse_args()
+
+    model_cache = {}
+    results = {}
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='benchmark_')
+    for rows in sorted(args.scales):
+        i94_path = synthetic_data(rows, args.data_dir, model_cache)
+        print('\n' + 'Benchmark {} rows:'.format(scale_name(rows)))
+        results[scale_name(rows)] = run_scale(rows, i94_path, work_dir)
+
+    print('')
+    print_report(results)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('\n' + 'Baseline written to ' + args.baseline)
+        return
+
+    passed_tests, failed_tests = compare(results, baseline, args.tolerance)
+    if passed_tests:
+        print("PASSED BENCHMARK CHECKS:")
+        for passed_test in passed_tests:
+            print(passed_test)
+    if failed_tests:
+        print("FAILED BENCHMARK CHECKS:")
+        for failed_test in failed_tests:
+            print(failed_test)
+        raise Exception('Benchmark FAILED!')
+
+
+if __name__ == "__main__":
+    main()
+#EOF
@@ -0,0 +1,251 @@
+# IMPORTS
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from instrumentation import is_copy
+
+
+def text_hash(text):
+    """
+    Args:
+        text (str): Text to hash.
+    Returns:
+        str: SHA-256 hex digest.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def query_inputs(query, table):
+    """
+    Returns the tables a query reads, other than the table it writes to.
+
+    Args:
+        query (str): Query, possibly bound to a schema.
+        table (str): Table the query writes to.
+    Returns:
+        list: Table names, sorted.
+    """
+    tables = set(re.findall(r'\b(?:FROM|JOIN)\s+(?:\w+\.)?"?(\w+)"?', query, re.IGNORECASE))
+    return sorted(tables - {table})
+
+
+def copy_source(query):
+    """
+    Args:
+        query (str): COPY query.
+    Returns:
+        str: S3 URL the query loads from, example: 's3://bucket/manifests/...manifest'.
+    """
+    return re.search(r"\bFROM\s+'([^']+)'", query, re.IGNORECASE).group(1)
+
+
+class RunState:
+    """
+    Records every completed step of a full load in a JSON file, with its query and
+    a hash of its inputs, so a failed run can be resumed from its first incomplete
+    step. The inputs of a COPY are the S3 objects (key and ETag) under its source;
+    the inputs of any other query are the tables it reads, each hashed from the
+    steps that wrote it. Safe to share between the threads of the parallel steps.
+    """
+    def __init__(self, path='run_state.json'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = None
+        self.list_source = None
+        self.sources = {}
+        self.counters = {}
+        self.tables = {}
+        self.skipped = 0
+        # Set when a recorded step no longer matches its query or inputs; the run must restart.
+        self.stale = False
+
+    def load(self):
+        """
+        Returns:
+            dict: Run state saved by the previous run, or None.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self):
+        self.state['updated_at'] = time.time()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def start(self, run_id, mode, resume=True, list_source=None):
+        """
+        Starts recording a run. The previous run is resumed if it was of the same
+        mode and did not succeed.
+
+        Args:
+            run_id (str): Id of this run, kept only when starting fresh.
+            mode (str): Load mode, example: 'full'.
+            resume (bool): Whether an unfinished previous run may be resumed.
+            list_source (function): Lists the objects under an S3 URL as
+                {key: {'size', 'version'}}; used to hash the inputs of COPY queries.
+        Returns:
+            bool: True if the previous run is resumed.
+        """
+        previous = self.load() if resume else None
+        resumed = bool(previous) and previous.get('mode') == mode and previous.get('status') != 'success'
+        with self.lock:
+            self.list_source = list_source
+            self.state = previous if resumed else {'run_id': run_id, 'mode': mode, 'schema': None,
+                                                   'started_at': time.time(), 'steps': {}}
+            self.state['status'] = 'running'
+            self.clear()
+            self.save()
+        return resumed
+
+    def reset(self):
+        """
+        Forgets the completed steps, so the run starts again from the first step.
+        """
+        with self.lock:
+            self.state.update({'schema': None, 'started_at': time.time(), 'steps': {}, 'status': 'running'})
+            self.clear()
+            self.save()
+
+    def clear(self):
+        self.sources = {}
+        self.counters = {}
+        self.tables = {}
+        self.skipped = 0
+        self.stale = False
+
+    def active(self):
+        return self.state is not None and self.state['status'] == 'running'
+
+    def run_id(self):
+        return self.state['run_id']
+
+    def completed_steps(self):
+        return len(self.state['steps'])
+
+    def schema(self):
+        return self.state.get('schema')
+
+    def set_schema(self, schema):
+        """
+        Args:
+            schema (str): Build schema of the run, reused when it is resumed.
+        """
+        with self.lock:
+            self.state['schema'] = schema
+            self.save()
+
+    def input_hash(self, query, table):
+        """
+        Args:
+            query (str): Query about to run.
+            table (str): Table it writes to.
+        Returns:
+            str: Hash of the S3 objects a COPY loads, or of the tables another query reads.
+        """
+        if is_copy(query) and self.list_source is not None:
+            url = copy_source(query)
+            if url not in self.sources:
+                self.sources[url] = self.list_source(url)
+            inputs = self.sources[url]
+        else:
+            with self.lock:
+                inputs = dict((name, self.tables.get(name)) for name in query_inputs(query, table))
+        return text_hash(json.dumps(inputs, sort_keys=True))
+
+    def begin(self, step, table, query):
+        """
+        Identifies a step by its ETL step, table and position among the queries of
+        that step on that table, and tells whether the resumed run completed it.
+
+        Args:
+            step (str): ETL step, example: 'load_staging_tables'.
+            table (str): Table the query writes to.
+            query (str): Query about to run.
+        Returns:
+            dict: Checkpoint to pass to 'complete'; 'done' is True if the step can be skipped.
+        """
+        if not self.active():
+            return {'done': False}
+        with self.lock:
+            ordinal = self.counters.get((step, table), 0)
+            self.counters[(step, table)] = ordinal + 1
+        checkpoint = {'key': '{}:{}:{}'.format(step, table, ordinal), 'step': step, 'table': table,
+                      'query': query, 'query_hash': text_hash(query),
+                      'input_hash': self.input_hash(query, table), 'done': False}
+        with self.lock:
+            recorded = self.state['steps'].get(checkpoint['key'])
+            if recorded is None:
+                return checkpoint
+            if recorded.get('uncertain'):
+                self.stale = True
+                raise Exception('Resume FAILED! ' + checkpoint['key'] + ' may have been committed by run '
+                                + self.state['run_id'])
+            if (recorded['query_hash'], recorded['input_hash']) != (checkpoint['query_hash'], checkpoint['input_hash']):
+                self.stale = True
+                raise Exception('Resume FAILED! ' + checkpoint['key'] + ' changed since run ' + self.state['run_id'])
+            self.written(checkpoint)
+            self.skipped += 1
+        checkpoint['done'] = True
+        return checkpoint
+
+    def complete(self, checkpoint):
+        """
+        Records a step as completed; call after its transaction is committed.
+
+        Args:
+            checkpoint (dict): Result of 'begin'.
+        """
+        if 'key' not in checkpoint or not self.active():
+            return
+        with self.lock:
+            self.state['steps'][checkpoint['key']] = {'step': checkpoint['step'],
+                                                      'table': checkpoint['table'],
+                                                      'query': checkpoint['query'],
+                                                      'query_hash': checkpoint['query_hash'],
+                                                      'input_hash': checkpoint['input_hash'],
+                                                      'completed_at': time.time()}
+            self.written(checkpoint)
+            self.save()
+
+    def uncertain(self, checkpoint):
+        """
+        Records a step whose COMMIT was lost with the connection: it may or may not
+        have been applied, so resuming after it is unsafe and the next run starts over.
+
+        Args:
+            checkpoint (dict): Result of 'begin'.
+        """
+        if 'key' not in checkpoint or not self.active():
+            return
+        with self.lock:
+            self.state['steps'][checkpoint['key']] = {'step': checkpoint['step'],
+                                                      'table': checkpoint['table'],
+                                                      'query': checkpoint['query'],
+                                                      'query_hash': checkpoint['query_hash'],
+                                                      'input_hash': checkpoint['input_hash'],
+                                                      'uncertain': True}
+            self.save()
+
+    def written(self, checkpoint):
+        # Chains the hashes of every step that wrote the table, in run order.
+        self.tables[checkpoint['table']] = text_hash((self.tables.get(checkpoint['table']) or '')
+                                                     + checkpoint['query_hash'] + checkpoint['input_hash'])
+
+    def finish(self, status):
+        """
+        Args:
+            status (str): 'success' or 'failed'; a failed run is resumed by the next one.
+        """
+        if not self.active():
+            return
+        with self.lock:
+            self.state['status'] = status
+            self.save()
+#EOF
@@ -0,0 +1,292 @@
+# IMPORTS
+import argparse
+import io
+import json
+import re
+import time
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from quality import profile_query
+from sql_queries import create_table_queries, column_encodings_path
+
+# Redshift types AZ64 supports; other types fall back to ZSTD.
+AZ64_TYPES = ('int2', 'int4', 'int8', 'smallint', 'integer', 'bigint', 'decimal', 'numeric', 'date', 'timestamp')
+# Parquet settings used locally as a stand-in for each Redshift encoding when estimating sizes.
+PARQUET_ENCODINGS = {'raw': {'use_dictionary': False, 'compression': 'none'},
+                     'bytedict': {'use_dictionary': True, 'compression': 'none'},
+                     'runlength': {'use_dictionary': True, 'compression': 'none'},
+                     'az64': {'use_dictionary': False, 'compression': 'zstd'},
+                     'zstd': {'use_dictionary': False, 'compression': 'zstd'}}
+
+
+def table_definitions(queries=create_table_queries):
+    """
+    Extracts the columns, types and sort key of each table from CREATE TABLE queries.
+
+    Args:
+        queries (list): CREATE TABLE queries.
+    Returns:
+        dict: Table name mapped to {'query': str, 'columns': [(name, type)], 'sortkey': [names],
+              'diststyle': 'KEY'|'ALL'|'EVEN'|'AUTO', 'distkey': name or None}.
+    """
+    tables = {}
+    for query in queries:
+        table = re.search(r'CREATE TABLE (?:IF NOT EXISTS )?(?:public\.)?"?(\w+)"?', query).group(1)
+        body = query[query.index('(') + 1:]
+        columns = re.findall(r'^\s+"?(\w+)"?\s+(\w+)(?:\(\d+(?:,\s*\d+)?\))?[^\n]*$', body, flags=re.MULTILINE)
+        columns = [(name, data_type.lower()) for name, data_type in columns
+                   if name.upper() not in ('CONSTRAINT', 'COMPOUND', 'INTERLEAVED', 'DISTKEY', 'SORTKEY', 'DISTSTYLE')]
+        sortkey = re.search(r'SORTKEY\s*\(([^)]*)\)', query)
+        distkey = re.search(r'DISTKEY\s*\(\s*"?(\w+)"?\s*\)', query)
+        diststyle = re.search(r'DISTSTYLE\s+(\w+)', query)
+        tables[table] = {'query': query,
+                         'columns': columns,
+                         'sortkey': [name.strip() for name in sortkey.group(1).split(',')] if sortkey else [],
+                         'diststyle': 'KEY' if distkey else (diststyle.group(1).upper() if diststyle else 'AUTO'),
+                         'distkey': distkey.group(1) if distkey else None}
+    return tables
+
+
+def choose_encoding(data_type, column):
+    """
+    Picks a Redshift encoding from the statistics of a sampled column: long runs
+    get RUNLENGTH, low cardinality BYTEDICT, numbers and dates AZ64, the rest ZSTD.
+
+    Args:
+        data_type (str): Redshift data type, example: 'int2'.
+        column (pyarrow.ChunkedArray): Sampled values, in sort key order.
+    Returns:
+        str: Encoding name.
+    """
+    rows = len(column)
+    if not rows:
+        return 'raw'
+    column = column.combine_chunks()
+    changes = pc.sum(pc.cast(pc.not_equal(column.slice(1), column.slice(0, rows - 1)), 'int64')).as_py()
+    runs = 1 + (changes or 0)
+    distinct = pc.count_distinct(column, mode='all').as_py()
+    if float(rows) / runs >= 8:
+        return 'runlength'
+    if distinct <= 255 and data_type not in ('float4', 'float8', 'real', 'double', 'bool', 'boolean'):
+        return 'bytedict'
+    if data_type in AZ64_TYPES:
+        return 'az64'
+    return 'zstd'
+
+
+def encoded_size(table, encodings):
+    """
+    Writes a sample table to in-memory parquet using the stand-in for each column's encoding.
+
+    Args:
+        table (pyarrow.Table): Sampled rows.
+        encodings (dict): Column mapped to encoding.
+    Returns:
+        tuple: (bytes, parquet buffer).
+    """
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer,
+                   use_dictionary=[name for name in table.column_names
+                                   if PARQUET_ENCODINGS[encodings[name]]['use_dictionary']],
+                   compression={name: PARQUET_ENCODINGS[encodings[name]]['compression']
+                                for name in table.column_names})
+    return buffer.tell(), buffer
+
+
+def scan_seconds(buffer, repeat=3):
+    """
+    Times a full read of an in-memory parquet file, best of 'repeat'.
+
+    Args:
+        buffer (io.BytesIO): Parquet file.
+        repeat (int): Number of reads.
+    Returns:
+        float: Seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        buffer.seek(0)
+        start = time.time()
+        pq.read_table(buffer)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def profile_local(conn, definition, table, sample_rows=1000000):
+    """
+    Samples a table from the local DuckDB engine with Arrow and picks an encoding per
+    column, estimating size and scan time before (all RAW) and after.
+
+    Args:
+        conn (duckdb.DuckDBPyConnection): Local database with the loaded tables.
+        definition (dict): Entry of 'table_definitions'.
+        table (str): Table name.
+        sample_rows (int): Rows to sample.
+    Returns:
+        dict: {'encodings': {column: encoding}, 'size_before', 'size_after', 'scan_before', 'scan_after'}.
+    """
+    order_by = 'ORDER BY ' + ', '.join(definition['sortkey']) if definition['sortkey'] else ''
+    row_count = conn.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+    percent = min(100.0, sample_rows * 100.0 / max(row_count, 1))
+    result = conn.execute('SELECT * FROM (SELECT * FROM {} USING SAMPLE {}% (system)) {}'
+                          .format(table, percent, order_by))
+    sample = result.to_arrow_table() if hasattr(result, 'to_arrow_table') else result.fetch_arrow_table()
+
+    encodings = {}
+    for name, data_type in definition['columns']:
+        encodings[name] = choose_encoding(data_type, sample.column(name))
+    # The leading sort key column stays RAW so range-restricted scans can skip blocks.
+    if definition['sortkey']:
+        encodings[definition['sortkey'][0]] = 'raw'
+
+    size_before, buffer_before = encoded_size(sample, dict((name, 'raw') for name in sample.column_names))
+    size_after, buffer_after = encoded_size(sample, encodings)
+    return {'encodings': encodings,
+            'size_before': size_before,
+            'size_after': size_after,
+            'scan_before': scan_seconds(buffer_before),
+            'scan_after': scan_seconds(buffer_after)}
+
+
+def table_size_mb(cur, table):
+    """
+    Returns the size of a Redshift table in 1MB blocks, from SVV_TABLE_INFO.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        table (str): Table name.
+    Returns:
+        int: Size in MB.
+    """
+    cur.execute('SELECT size FROM svv_table_info WHERE "table" = %s;', (table,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def timed_scan(cur, table, columns):
+    """
+    Times a query that reads every column of a table.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        table (str): Table name.
+        columns (list): Column names.
+    Returns:
+        float: Seconds.
+    """
+    # Disable the result cache so the query is actually executed.
+    cur.execute('SET enable_result_cache_for_session TO off;')
+    start = time.time()
+    cur.execute(profile_query(table, columns))
+    cur.fetchall()
+    return time.time() - start
+
+
+def profile_redshift(cur, conn, definition, table):
+    """
+    Uses ANALYZE COMPRESSION to pick encodings, then deep-copies the table into an
+    encoded copy to measure the size and scan time before and after.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        definition (dict): Entry of 'table_definitions'.
+        table (str): Table name.
+    Returns:
+        dict: {'encodings': {column: encoding}, 'size_before', 'size_after', 'scan_before', 'scan_after'}.
+    """
+    conn.autocommit = True  # ANALYZE COMPRESSION cannot run inside a transaction block.
+    try:
+        cur.execute('ANALYZE COMPRESSION public.{};'.format(table))
+        encodings = dict((row[1], row[2].lower()) for row in cur.fetchall())
+    finally:
+        conn.autocommit = False
+    if definition['sortkey']:
+        encodings[definition['sortkey'][0]] = 'raw'
+
+    from sql_queries import apply_column_encodings
+    encoded_table = table + '_encoded'
+    encoded_query = apply_column_encodings(definition['query'], {table: encodings})
+    encoded_query = re.sub(r'(CREATE TABLE (?:IF NOT EXISTS )?(?:public\.)?"?){}("?)'.format(table),
+                           r'\g<1>{}\g<2>'.format(encoded_table), encoded_query, count=1)
+    encoded_query = re.sub(r'CONSTRAINT (\w+)', r'CONSTRAINT \1_encoded', encoded_query)
+    columns = [name for name, _ in definition['columns']]
+
+    cur.execute('DROP TABLE IF EXISTS public.{};'.format(encoded_table))
+    cur.execute(encoded_query)
+    cur.execute('INSERT INTO public.{} (SELECT * FROM public.{});'.format(encoded_table, table))
+    conn.commit()
+    try:
+        return {'encodings': encodings,
+                'size_before': table_size_mb(cur, table) * 1024 * 1024,
+                'size_after': table_size_mb(cur, encoded_table) * 1024 * 1024,
+                'scan_before': timed_scan(cur, table, columns),
+                'scan_after': timed_scan(cur, encoded_table, columns)}
+    finally:
+        cur.execute('DROP TABLE IF EXISTS public.{};'.format(encoded_table))
+        conn.commit()
+
+
+def print_report(results):
+    """
+    Prints the chosen encodings and the size and scan time before and after, per table.
+
+    Args:
+        results (dict): Table name mapped to the output of 'profile_local' or 'profile_redshift'.
+    Returns:
+        None
+    """
+    print('{:<32}{:>12}{:>12}{:>8}{:>10}{:>10}'.format('TABLE', 'MB BEFORE', 'MB AFTER', 'SAVED', 'SCAN s', 'SCAN s'))
+    for table, result in sorted(results.items()):
+        saved = 1 - float(result['size_after']) / result['size_before'] if result['size_before'] else 0
+        print('{:<32}{:>12.2f}{:>12.2f}{:>7.0%}{:>10.3f}{:>10.3f}'
+              .format(table, result['size_before'] / 1048576.0, result['size_after'] / 1048576.0,
+                      saved, result['scan_before'], result['scan_after']))
+        for column, encoding in result['encodings'].items():
+            print('    {:<28}{}'.format(column, encoding))
+
+
+def main():
+    """
+    Profiles every table in 'create_table_queries' and writes the chosen column
+    encodings to the file 'sql_queries.py' applies to the generated DDL.
+    """
+    parser = argparse.ArgumentParser(description='Choose column compression encodings.')
+    parser.add_argument('--source', choices=['local', 'redshift'], default='local',
+                        help="'local' samples the local DuckDB engine with Arrow, "
+                             "'redshift' runs ANALYZE COMPRESSION on the cluster")
+    parser.add_argument('--database', default='local_dwh.duckdb',
+                        help='DuckDB database loaded by local_engine.py (local source only)')
+    parser.add_argument('--output', default=column_encodings_path)
+    args = parser.parse_args()
+
+    definitions = table_definitions()
+    results = {}
+    if args.source == 'local':
+        import duckdb
+        conn = duckdb.connect(args.database, read_only=True)
+        for table, definition in definitions.items():
+            if conn.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]:
+                results[table] = profile_local(conn, definition, table)
+        conn.close()
+    else:
+        import psycopg2
+        from etl import connection_string
+        conn = psycopg2.connect(connection_string())
+        cur = conn.cursor()
+        for table, definition in definitions.items():
+            if not table.startswith('staging_'):
+                results[table] = profile_redshift(cur, conn, definition, table)
+        conn.close()
+
+    print_report(results)
+    with open(args.output, 'w') as f:
+        json.dump(dict((table, result['encodings']) for table, result in results.items()),
+                  f, indent=2, sort_keys=True)
+    print('\n' + 'Column encodings written to ' + args.output)
+
+
+if __name__ == "__main__":
+    main()
+#EOF
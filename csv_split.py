@@ -0,0 +1,88 @@
+# IMPORTS
+import gzip
+import os
+
+# Redshift COPY flag and file extension of each supported compression.
+COMPRESSIONS = {'gzip': ('GZIP', '.gz'), 'zstd': ('ZSTD', '.zst')}
+
+
+def part_count(size, slices, parts_per_slice=1, min_split_bytes=64 * 1024 * 1024):
+    """
+    Returns how many parts a file is split into: a multiple of the cluster's slice
+    count, so every slice loads the same number of files, or 1 for small files.
+
+    Args:
+        size (int): File size in bytes.
+        slices (int): Slices in the cluster.
+        parts_per_slice (int): Parts loaded by each slice.
+        min_split_bytes (int): Files smaller than this are not split.
+    Returns:
+        int: Number of parts.
+    """
+    return slices * parts_per_slice if size >= min_split_bytes else 1
+
+
+def open_part(path, compression):
+    """
+    Args:
+        path (str): Part file to write.
+        compression (str): 'gzip' or 'zstd'.
+    Returns:
+        file: Binary file object compressing what is written to it.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('zstd compression requires the zstandard package')
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'), closefd=True)
+    raise ValueError('Unknown compression: {}'.format(compression))
+
+
+def split_csv(path, output_dir, parts, compression='gzip', header=True, quoted=True):
+    """
+    Splits a CSV file into compressed parts of about the same size, in one pass.
+    Parts only end between records; with 'quoted', a newline inside a quoted field
+    does not end a record. The header line is repeated in every part, so
+    'IGNOREHEADER 1' applies to each file as before.
+
+    Args:
+        path (str): CSV file.
+        output_dir (str): Directory the parts are written to.
+        parts (int): Number of parts.
+        compression (str): 'gzip' or 'zstd'.
+        header (bool): Whether the first line is a header.
+        quoted (bool): Whether fields may be quoted with '"' (CSV format).
+    Returns:
+        list: Paths of the parts written, in order.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    extension = COMPRESSIONS[compression][1]
+    target = os.path.getsize(path) / float(parts)
+    paths = []
+
+    def next_part(head):
+        paths.append(os.path.join(output_dir, 'part-{:05d}.csv{}'.format(len(paths), extension)))
+        out = open_part(paths[-1], compression)
+        out.write(head)
+        return out
+
+    with open(path, 'rb') as f:
+        head = f.readline() if header else b''
+        out = next_part(head)
+        written = 0
+        in_quotes = False
+        for line in f:
+            out.write(line)
+            written += len(line)
+            if quoted and line.count(b'"') % 2:
+                in_quotes = not in_quotes
+            if not in_quotes and written >= target and len(paths) < parts:
+                out.close()
+                out = next_part(head)
+                written = 0
+        out.close()
+    return paths
+#EOF
@@ -0,0 +1,579 @@
+# IMPORTS
+import argparse
+import configparser
+import os
+import re
+import zlib
+from compression import table_definitions
+from sql_queries import insert_table_queries, i94_immigration_month_delete, load_watermark_month_delete
+
+# Queries whose joins, group-bys and filters the keys are evaluated against.
+WORKLOAD_QUERIES = insert_table_queries + [i94_immigration_month_delete, load_watermark_month_delete]
+SLICES_PER_NODE = {'dc2.large': 2, 'dc2.8xlarge': 16, 'ds2.xlarge': 2, 'ds2.8xlarge': 16,
+                   'ra3.xlplus': 2, 'ra3.4xlarge': 4, 'ra3.16xlarge': 16}
+SQL_KEYWORDS = ('WHERE', 'GROUP', 'LEFT', 'RIGHT', 'INNER', 'FULL', 'CROSS', 'OUTER', 'JOIN', 'ON',
+                'ORDER', 'USING', 'AND', 'OR', 'LIMIT', 'HAVING', 'UNION')
+
+
+def split_subqueries(query):
+    """
+    Replaces each top-level '(SELECT ...)' of a query with a '__subN__' placeholder.
+
+    Args:
+        query (str): SQL text.
+    Returns:
+        tuple: (text with placeholders, [subquery texts]).
+    """
+    text = []
+    subqueries = []
+    depth = 0
+    start = None
+    for i, char in enumerate(query):
+        if char == '(':
+            if start is None and re.match(r'\(\s*SELECT\b', query[i:], re.IGNORECASE):
+                start = i
+                start_depth = depth
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if start is not None and depth == start_depth:
+                subqueries.append(query[start + 1:i])
+                text.append(' __sub{}__ '.format(len(subqueries) - 1))
+                start = None
+                continue
+        if start is None:
+            text.append(char)
+    return ''.join(text), subqueries
+
+
+def parse_scope(query):
+    """
+    Parses one SELECT scope and its subqueries: sources and aliases, output column
+    aliases, GROUP BY columns, equality joins and literal filters.
+
+    Args:
+        query (str): SQL text.
+    Returns:
+        dict: Scope with 'sources', 'default', 'outputs', 'group_by', 'joins', 'filters', 'subqueries'.
+    """
+    text, subqueries = split_subqueries(query)
+    scope = {'sources': {}, 'default': None, 'outputs': {}, 'group_by': [], 'joins': [], 'filters': [],
+             'subqueries': [parse_scope(subquery) for subquery in subqueries]}
+
+    for name, alias in re.findall(r'\b(?:FROM|JOIN)\s+(?:public\.)?(\w+)(?:\s+(?:AS\s+)?(\w+))?', text, re.IGNORECASE):
+        source = scope['subqueries'][int(name[5:-2])] if name.startswith('__sub') else name
+        scope['sources'][name] = source
+        if alias and alias.upper() not in SQL_KEYWORDS:
+            scope['sources'][alias] = source
+        if scope['default'] is None:
+            scope['default'] = source
+
+    select_list = re.search(r'\bSELECT\b(.*?)\bFROM\b', text, re.IGNORECASE | re.DOTALL)
+    if select_list:
+        for alias, column, output in re.findall(r'(?:(\w+)\.)?(\w+)\s+AS\s+(\w+)', select_list.group(1), re.IGNORECASE):
+            scope['outputs'][output] = (alias or None, column)
+
+    group_by = re.search(r'\bGROUP\s+BY\s+(.+?)(?:\bHAVING\b|\bORDER\b|\bLIMIT\b|;|$)', text, re.IGNORECASE | re.DOTALL)
+    if group_by:
+        scope['group_by'] = [tuple(column.strip().split('.')) if '.' in column else (None, column.strip())
+                             for column in group_by.group(1).split(',') if re.match(r'^\s*[\w.]+\s*$', column)]
+
+    body = text[text.upper().find(' FROM ') if ' FROM ' in text.upper() else 0:]
+    scope['joins'] = re.findall(r'\b(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)', body)
+    where = re.search(r'\bWHERE\b(.*)$', body, re.IGNORECASE | re.DOTALL)
+    if where:
+        scope['filters'] = [(alias or None, column) for alias, column in
+                            re.findall(r"(?:(\w+)\.)?(\w+)\s*(?:=|<=|>=|<|>|\bBETWEEN\b|\bIN\b)\s*(?=['\d{(-])",
+                                       where.group(1), re.IGNORECASE)]
+    return scope
+
+
+def resolve(scope, alias, column):
+    """
+    Follows a column reference through subqueries to the table column it reads.
+
+    Args:
+        scope (dict): Output of 'parse_scope'.
+        alias (str): Table or subquery alias, or None for the scope's first source.
+        column (str): Column name or output alias.
+    Returns:
+        tuple: (table, column, grouped) where 'grouped' tells if a GROUP BY ran first, or None.
+    """
+    source = scope['sources'].get(alias) if alias else scope['default']
+    if source is None:
+        return None
+    if isinstance(source, str):
+        return (source, column, bool(scope['group_by']) and alias is None)
+    inner_alias, inner_column = source['outputs'].get(column, (None, column))
+    resolved = resolve(source, inner_alias, inner_column)
+    if resolved is None:
+        return None
+    return (resolved[0], resolved[1], resolved[2] or bool(source['group_by']))
+
+
+def scope_patterns(scope):
+    """
+    Args:
+        scope (dict): Output of 'parse_scope'.
+    Returns:
+        list: Patterns of the scope and its subqueries, see 'workload_patterns'.
+    """
+    patterns = []
+    for left_alias, left_column, right_alias, right_column in scope['joins']:
+        left = resolve(scope, left_alias, left_column)
+        right = resolve(scope, right_alias, right_column)
+        if left and right and left[0] != right[0]:
+            patterns.append({'type': 'join', 'left': left, 'right': right})
+    for kind, key in [('group', 'group_by'), ('filter', 'filters')]:
+        columns = [resolve(scope, alias, column) for alias, column in scope[key]]
+        columns = [column for column in columns if column]
+        if columns:
+            patterns.append({'type': kind, 'table': columns[0][0],
+                             'columns': [column for table, column, _ in columns if table == columns[0][0]]})
+    for subquery in scope['subqueries']:
+        patterns += scope_patterns(subquery)
+    return patterns
+
+
+def workload_patterns(queries=WORKLOAD_QUERIES):
+    """
+    Extracts the access patterns a table layout has to serve from the workload queries.
+
+    Args:
+        queries (list): SQL queries.
+    Returns:
+        list: Patterns, example: {'type': 'join', 'left': (table, column, grouped), 'right': (...)},
+              {'type': 'group', 'table': t, 'columns': [...]} or {'type': 'filter', 'table': t, 'columns': [...]}.
+    """
+    patterns = []
+    for query in queries:
+        patterns += scope_patterns(parse_scope(query))
+    return patterns
+
+
+def slice_rows(value_counts, slices):
+    """
+    Simulates the hash distribution of a key: rows per slice.
+
+    Args:
+        value_counts (list): (value, rows) of the key column; NULLs all land on one slice.
+        slices (int): Number of slices.
+    Returns:
+        list: Rows on each slice.
+    """
+    rows = [0] * slices
+    for value, count in value_counts:
+        rows[zlib.crc32(str(value).encode('utf-8')) % slices] += count
+    return rows
+
+
+def skew(rows):
+    """
+    Args:
+        rows (list): Rows on each slice.
+    Returns:
+        float: Rows on the fullest slice relative to the average (1.0 is even).
+    """
+    total = sum(rows)
+    return float(max(rows)) * len(rows) / total if total else 1.0
+
+
+class Statistics:
+    """
+    Row counts, distinct counts and simulated slice skew of the loaded tables,
+    queried through 'fetch_all' and cached.
+    """
+    def __init__(self, fetch_all, slices):
+        self.fetch_all = fetch_all
+        self.slices = slices
+        self.cache = {}
+
+    def rows(self, table):
+        if ('rows', table) not in self.cache:
+            self.cache[('rows', table)] = self.fetch_all('SELECT COUNT(*) FROM {};'.format(table))[0][0]
+        return self.cache[('rows', table)]
+
+    def distinct(self, table, columns):
+        key = ('distinct', table, tuple(columns))
+        if key not in self.cache:
+            self.cache[key] = self.fetch_all('SELECT COUNT(*) FROM (SELECT DISTINCT {} FROM {}) d;'
+                                             .format(', '.join(columns), table))[0][0]
+        return self.cache[key]
+
+    def skew(self, table, distribution):
+        if not distribution.startswith('KEY'):
+            return 1.0
+        column = distribution[4:-1]
+        if ('skew', table, column) not in self.cache:
+            counts = self.fetch_all('SELECT {0}, COUNT(*) FROM {1} GROUP BY {0};'.format(column, table))
+            self.cache[('skew', table, column)] = skew(slice_rows(counts, self.slices))
+        return self.cache[('skew', table, column)]
+
+
+def current_distribution(definition):
+    """
+    Args:
+        definition (dict): Entry of 'table_definitions'.
+    Returns:
+        str: 'KEY(<column>)', 'ALL' or 'EVEN' (AUTO is costed as EVEN).
+    """
+    if definition['diststyle'] == 'KEY':
+        return 'KEY({})'.format(definition['distkey'])
+    return 'ALL' if definition['diststyle'] == 'ALL' else 'EVEN'
+
+
+def side_rows(stats, side):
+    """
+    Args:
+        stats (Statistics): Table statistics.
+        side (tuple): (table, column, grouped) of a join.
+    Returns:
+        int: Rows entering the join: the table's rows, or its distinct keys if grouped first.
+    """
+    table, column, grouped = side
+    return stats.distinct(table, [column]) if grouped else stats.rows(table)
+
+
+def pattern_cost(pattern, distributions, stats):
+    """
+    Estimates the rows a pattern moves between slices under the given distributions:
+    a join is free when both sides are distributed on the join columns or one side
+    is ALL, otherwise the mismatched side is redistributed or the smaller one is
+    broadcast (DS_DIST_INNER/OUTER, DS_DIST_BOTH, DS_BCAST_INNER). A GROUP BY not
+    on the dist key moves its partial aggregates.
+
+    Args:
+        pattern (dict): Entry of 'workload_patterns'.
+        distributions (dict): Table mapped to 'KEY(<column>)', 'ALL' or 'EVEN'.
+        stats (Statistics): Table statistics.
+    Returns:
+        float: Rows redistributed.
+    """
+    if pattern['type'] == 'join':
+        left, right = pattern['left'], pattern['right']
+        left_dist, right_dist = distributions.get(left[0], 'EVEN'), distributions.get(right[0], 'EVEN')
+        if 'ALL' in (left_dist, right_dist):
+            return 0.0
+        left_local = left_dist == 'KEY({})'.format(left[1])
+        right_local = right_dist == 'KEY({})'.format(right[1])
+        left_rows, right_rows = side_rows(stats, left), side_rows(stats, right)
+        if left_local and right_local:
+            return 0.0
+        broadcast = min(left_rows, right_rows) * stats.slices
+        if left_local:
+            return float(min(right_rows, broadcast))
+        if right_local:
+            return float(min(left_rows, broadcast))
+        return float(min(left_rows + right_rows, broadcast))
+    if pattern['type'] == 'group':
+        distribution = distributions.get(pattern['table'], 'EVEN')
+        if distribution == 'ALL' or distribution[4:-1] in pattern['columns']:
+            return 0.0
+        return float(stats.distinct(pattern['table'], pattern['columns']) * stats.slices)
+    return 0.0
+
+
+def skew_cost(table, distribution, patterns, stats):
+    """
+    Extra rows the fullest slice processes, over a balanced layout, across the
+    patterns reading 'table': the slowest slice sets the pace of every query.
+
+    Args:
+        table (str): Table name.
+        distribution (str): 'KEY(<column>)', 'ALL' or 'EVEN'.
+        patterns (list): Entries of 'workload_patterns'.
+        stats (Statistics): Table statistics.
+    Returns:
+        float: Rows.
+    """
+    reads = sum(1 for pattern in patterns if table in pattern_tables(pattern))
+    return stats.rows(table) * (stats.skew(table, distribution) - 1) * max(reads, 1)
+
+
+def pattern_tables(pattern):
+    """
+    Args:
+        pattern (dict): Entry of 'workload_patterns'.
+    Returns:
+        list: Tables the pattern reads.
+    """
+    if pattern['type'] == 'join':
+        return [pattern['left'][0], pattern['right'][0]]
+    return [pattern['table']]
+
+
+def total_cost(distributions, patterns, stats, nodes):
+    """
+    Args:
+        distributions (dict): Table mapped to its distribution.
+        patterns (list): Entries of 'workload_patterns'.
+        stats (Statistics): Table statistics.
+        nodes (int): Compute nodes; ALL tables are written once per node on every load.
+    Returns:
+        float: Rows moved, plus skew and ALL load overheads.
+    """
+    cost = sum(pattern_cost(pattern, distributions, stats) for pattern in patterns)
+    for table, distribution in distributions.items():
+        cost += skew_cost(table, distribution, patterns, stats)
+        if distribution == 'ALL':
+            cost += stats.rows(table) * (nodes - 1)
+    return cost
+
+
+def candidates(table, definition, patterns, stats, all_max_rows):
+    """
+    Args:
+        table (str): Table name.
+        definition (dict): Entry of 'table_definitions'.
+        patterns (list): Entries of 'workload_patterns'.
+        stats (Statistics): Table statistics.
+        all_max_rows (int): Largest table considered for DISTSTYLE ALL.
+    Returns:
+        list: Distributions to evaluate, the current one first.
+    """
+    options = [current_distribution(definition), 'EVEN']
+    if stats.rows(table) <= all_max_rows:
+        options.append('ALL')
+    columns = [name for name, _ in definition['columns']]
+    for pattern in patterns:
+        if pattern['type'] == 'join':
+            options += ['KEY({})'.format(column) for other, column, _ in (pattern['left'], pattern['right'])
+                        if other == table]
+        elif pattern['type'] == 'group' and pattern['table'] == table:
+            options += ['KEY({})'.format(column) for column in pattern['columns']]
+    return [option for i, option in enumerate(options)
+            if option not in options[:i] and (not option.startswith('KEY') or option[4:-1] in columns)]
+
+
+def recommend_distributions(definitions, patterns, stats, nodes, all_max_rows, min_saving=100000, rounds=3):
+    """
+    Picks each table's distribution by coordinate descent: one table at a time
+    switches to the candidate with the lowest total cost, the others held fixed,
+    if that saves at least 'min_saving' rows.
+
+    Args:
+        definitions (dict): Output of 'table_definitions', loaded tables only.
+        patterns (list): Entries of 'workload_patterns'.
+        stats (Statistics): Table statistics.
+        nodes (int): Compute nodes.
+        all_max_rows (int): Largest table considered for DISTSTYLE ALL.
+        min_saving (int): Rows a change must save; smaller gains are noise.
+        rounds (int): Passes over the tables.
+    Returns:
+        dict: Table mapped to its recommended distribution.
+    """
+    distributions = dict((table, current_distribution(definition)) for table, definition in definitions.items())
+    for _ in range(rounds):
+        changed = False
+        for table, definition in definitions.items():
+            best, best_cost = distributions[table], total_cost(distributions, patterns, stats, nodes)
+            threshold = best_cost - min_saving
+            for option in candidates(table, definition, patterns, stats, all_max_rows):
+                cost = total_cost(dict(distributions, **{table: option}), patterns, stats, nodes)
+                if cost < best_cost and cost <= threshold:
+                    best, best_cost = option, cost
+            changed = changed or best != distributions[table]
+            distributions[table] = best
+        if not changed:
+            break
+    return distributions
+
+
+def sortkey_score(table, sortkey, distribution, distributions, patterns, stats):
+    """
+    Scores a sort key against the patterns: literal filters on a prefix of the sort
+    key let zone maps skip the blocks of other values, and a join on the leading
+    sort key column between tables distributed on it can run as a merge join.
+
+    Args:
+        table (str): Table name.
+        sortkey (list): Sort key columns.
+        distribution (str): Distribution of the table.
+        distributions (dict): Distributions of all tables.
+        patterns (list): Entries of 'workload_patterns'.
+        stats (Statistics): Table statistics.
+    Returns:
+        float: Rows not read or hashed, summed over the patterns.
+    """
+    score = 0.0
+    rows = stats.rows(table)
+    for pattern in patterns:
+        if pattern['type'] == 'filter' and pattern['table'] == table:
+            prefix = []
+            for column in sortkey:
+                if column not in pattern['columns']:
+                    break
+                prefix.append(column)
+            if prefix:
+                score += rows * (1 - 1.0 / max(stats.distinct(table, prefix), 1))
+        elif pattern['type'] == 'join' and sortkey:
+            for side, other in [(pattern['left'], pattern['right']), (pattern['right'], pattern['left'])]:
+                if side[0] == table and not side[2] and not other[2] and sortkey[0] == side[1] \
+                   and distribution == 'KEY({})'.format(side[1]) \
+                   and distributions.get(other[0]) == 'KEY({})'.format(other[1]):
+                    score += rows * 0.5
+    return score
+
+
+def recommend_sortkey(table, definition, distribution, distributions, patterns, stats):
+    """
+    Args:
+        table (str): Table name.
+        definition (dict): Entry of 'table_definitions'.
+        distribution (str): Recommended distribution of the table.
+        distributions (dict): Recommended distributions of all tables.
+        patterns (list): Entries of 'workload_patterns'.
+        stats (Statistics): Table statistics.
+    Returns:
+        list: Sort key columns; the current key unless another one scores higher.
+    """
+    options = [definition['sortkey']]
+    for pattern in patterns:
+        if pattern['type'] == 'filter' and pattern['table'] == table:
+            options.append(pattern['columns'] + [column for column in definition['sortkey']
+                                                 if column not in pattern['columns']])
+    if distribution.startswith('KEY'):
+        options.append([distribution[4:-1]] + [column for column in definition['sortkey']
+                                               if column != distribution[4:-1]])
+    best = definition['sortkey']
+    best_score = sortkey_score(table, best, distribution, distributions, patterns, stats)
+    for option in options[1:]:
+        score = sortkey_score(table, option, distribution, distributions, patterns, stats)
+        if score > best_score:
+            best, best_score = option, score
+    return best
+
+
+def recommended_ddl(query, distribution, sortkey):
+    """
+    Rewrites the physical design clauses of a CREATE TABLE query.
+
+    Args:
+        query (str): CREATE TABLE query.
+        distribution (str): 'KEY(<column>)', 'ALL' or 'EVEN'.
+        sortkey (list): Sort key columns.
+    Returns:
+        str: CREATE TABLE query with the recommended DISTSTYLE/DISTKEY and SORTKEY.
+    """
+    query = re.sub(r'\s*\bDISTSTYLE\s+\w+', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\s*\bDISTKEY\s*\([^)]*\)', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\s*\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', '', query, flags=re.IGNORECASE)
+    clauses = ['DISTKEY ({})'.format(distribution[4:-1]) if distribution.startswith('KEY')
+               else 'DISTSTYLE ' + distribution]
+    if sortkey:
+        clauses.append('COMPOUND SORTKEY (\n        {}\n    )'.format(','.join(sortkey)))
+    return re.sub(r'\s*;\s*$', '\n    ' + '\n    '.join(clauses) + ';\n', query.rstrip())
+
+
+def print_report(results, current_cost, recommended_cost):
+    """
+    Prints the current and recommended layout of each table with its simulated skew.
+
+    Args:
+        results (dict): Table mapped to {'rows', 'current', 'current_skew', 'svv_skew_rows', 'recommended',
+                        'recommended_skew', 'sortkey', 'recommended_sortkey'}.
+        current_cost (float): Rows moved by the workload with the current layout.
+        recommended_cost (float): Rows moved with the recommended layout.
+    Returns:
+        None
+    """
+    print('{:<32}{:>12}  {:<22}{:>6}  {:<22}{:>6}'.format('TABLE', 'ROWS', 'CURRENT', 'SKEW', 'RECOMMENDED', 'SKEW'))
+    for table, result in sorted(results.items()):
+        print('{:<32}{:>12}  {:<22}{:>6.2f}  {:<22}{:>6.2f}'
+              .format(table, result['rows'], result['current'], result['current_skew'],
+                      result['recommended'], result['recommended_skew']))
+        if result.get('svv_skew_rows') is not None:
+            print('    SVV_TABLE_INFO skew_rows (fullest / emptiest slice): {:.2f}'.format(result['svv_skew_rows']))
+        if result['recommended_sortkey'] != result['sortkey']:
+            print('    SORTKEY ({}) -> ({})'.format(','.join(result['sortkey']), ','.join(result['recommended_sortkey'])))
+    print('\n' + 'Estimated rows redistributed per load: {:,.0f} current, {:,.0f} recommended'
+          .format(current_cost, recommended_cost))
+
+
+def main():
+    """
+    Measures per-slice skew of every table in 'create_table_queries', evaluates
+    alternative dist and sort keys against the workload and writes recommended DDL.
+    """
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    nodes = config.getint('DWH', 'dwh_num_nodes', fallback=2)
+    slices = nodes * SLICES_PER_NODE.get(config.get('DWH', 'dwh_node_type', fallback='dc2.large'), 2)
+
+    parser = argparse.ArgumentParser(description='Recommend DISTKEY and SORTKEY settings.')
+    parser.add_argument('--source', choices=['local', 'redshift'], default='local',
+                        help="'local' simulates the hash distribution over the local DuckDB engine, "
+                             "'redshift' over the cluster's tables and reports SVV_TABLE_INFO skew")
+    parser.add_argument('--database', default=config.get('LOCAL', 'database', fallback=':memory:'),
+                        help="DuckDB database loaded by local_engine.py (local source only; "
+                             "default: 'database' under [LOCAL])")
+    parser.add_argument('--slices', type=int, default=slices,
+                        help='slices to simulate (default: nodes x slices per node from [DWH])')
+    parser.add_argument('--all-max-rows', type=int, default=1000000,
+                        help='largest table considered for DISTSTYLE ALL')
+    parser.add_argument('--min-saving', type=int, default=100000,
+                        help='rows per load a layout change must save to be recommended')
+    parser.add_argument('--output', default='distkey_recommendations.sql')
+    args = parser.parse_args()
+    nodes = max(1, args.slices // SLICES_PER_NODE.get(config.get('DWH', 'dwh_node_type', fallback='dc2.large'), 2))
+
+    if args.source == 'local' and (args.database == ':memory:' or not os.path.exists(args.database)):
+        parser.error("--source local reads the tables local_engine.py loaded into a DuckDB file, but '{}' is not one. "
+                     "Set 'database = local_dwh.duckdb' under [LOCAL] in dwh.cfg and run local_engine.py first, "
+                     "or pass --database.".format(args.database))
+
+    svv_skew = {}
+    if args.source == 'local':
+        import duckdb
+        conn = duckdb.connect(args.database, read_only=True)
+        fetch_all = lambda query: conn.execute(query).fetchall()
+    else:
+        import psycopg2
+        from etl import connection_string
+        conn = psycopg2.connect(connection_string())
+        cur = conn.cursor()
+
+        def fetch_all(query):
+            cur.execute(query)
+            return cur.fetchall()
+        cur.execute('SELECT COUNT(*) FROM stv_slices;')
+        args.slices = cur.fetchone()[0]
+        svv_skew = dict(fetch_all('SELECT "table", skew_rows FROM svv_table_info WHERE schema = \'public\';'))
+
+    stats = Statistics(fetch_all, args.slices)
+    definitions = dict((table, definition) for table, definition in table_definitions().items()
+                       if stats.rows(table))
+    patterns = [pattern for pattern in workload_patterns()
+                if all(table in definitions for table in pattern_tables(pattern))]
+
+    current = dict((table, current_distribution(definition)) for table, definition in definitions.items())
+    recommended = recommend_distributions(definitions, patterns, stats, nodes, args.all_max_rows, args.min_saving)
+    results = {}
+    ddl = []
+    for table, definition in definitions.items():
+        sortkey = recommend_sortkey(table, definition, recommended[table], recommended, patterns, stats)
+        results[table] = {'rows': stats.rows(table),
+                          'current': current[table],
+                          'current_skew': stats.skew(table, current[table]),
+                          'svv_skew_rows': svv_skew.get(table),
+                          'recommended': recommended[table],
+                          'recommended_skew': stats.skew(table, recommended[table]),
+                          'sortkey': definition['sortkey'],
+                          'recommended_sortkey': sortkey}
+        if recommended[table] != current[table] or sortkey != definition['sortkey']:
+            ddl.append('-- {}: {} (skew {:.2f}) -> {} (skew {:.2f})\n{}'
+                       .format(table, current[table], results[table]['current_skew'],
+                               recommended[table], results[table]['recommended_skew'],
+                               recommended_ddl(definition['query'], recommended[table], sortkey).strip('\n')))
+    conn.close()
+
+    print('Simulated {} slices, {} workload patterns'.format(args.slices, len(patterns)) + '\n')
+    print_report(results, total_cost(current, patterns, stats, nodes), total_cost(recommended, patterns, stats, nodes))
+    with open(args.output, 'w') as f:
+        f.write('\n\n'.join(ddl) + '\n' if ddl else '-- No changes recommended.\n')
+    print('\n' + 'Recommended DDL written to ' + args.output)
+
+
+if __name__ == "__main__":
+    main()
+#EOF
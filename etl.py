@@ -1,12 +1,61 @@
 # IMPORTS
 import configparser
+import re
+import sys
+import time
+import boto3
 import psycopg2
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from psycopg2.pool import ThreadedConnectionPool
+from manifest import list_s3_objects \
+                   , load_catalog \
+                   , save_catalog \
+                   , month_keys \
+                   , changed_months \
+                   , build_manifest \
+                   , upload_manifest
+from instrumentation import RunLog
+from checkpoint import RunState
+from quality import profile_tables, evaluate, load_history, save_history
+from query_plans import check_plans
+from scheduler import run_dag, print_timing_report
+from serving_export import export_serving
+from spatial import nearest_stations
+from unload import S3Target, unload_queries, publish_unload
 from sql_queries import drop_table_queries \
                       , create_table_queries \
                       , copy_table_queries \
                       , insert_table_queries \
+                      , insert_table_steps \
                       , staging_checks \
-                      , insert_checks
+                      , insert_checks \
+                      , load_watermark_select \
+                      , incremental_i94_month_queries \
+                      , incremental_i94_month_removal_queries \
+                      , incremental_refresh_queries \
+                      , incremental_checks \
+                      , i94_manifest_key \
+                      , i94_source_prefix \
+                      , staging_profiles \
+                      , insert_profiles \
+                      , schema_create \
+                      , schema_drop \
+                      , schema_rename \
+                      , schema_exists \
+                      , schema_grant_usage \
+                      , schema_grant_select \
+                      , schema_grant_public \
+                      , search_path_reset \
+                      , table_exists \
+                      , table_carry_over \
+                      , carry_over_tables \
+                      , load_version_publish \
+                      , weather_stations_select \
+                      , port_locations_select \
+                      , port_weather_station_clear \
+                      , port_weather_station_insert \
+                      , port_month_temperature_clear \
+                      , port_month_temperature_insert
 
 config = configparser.ConfigParser()
 config.read_file(open('dwh.cfg'))
@@ -16,6 +65,251 @@ DB_USER = config.get("CLUSTER", "DB_USER")
 DB_PASSWORD = config.get("CLUSTER", "DB_PASSWORD")
 DB_PORT = config.get("CLUSTER", "DB_PORT")
 ARN_IAM_ROLE = config.get("IAM_ROLE", "arn")
+S3_BUCKET = config.get("S3", "BUCKET")
+LOAD_MODE = config.get("ETL", "load_mode", fallback="full")
+COPY_CATALOG = config.get("ETL", "copy_catalog", fallback="copy_catalog.json")
+I94_PREFIX = i94_source_prefix
+I94_MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+QUALITY_MODE = config.get("ETL", "quality_mode", fallback="queries")
+QUALITY_CONCURRENCY = config.getint("ETL", "quality_concurrency", fallback=4)
+QUALITY_HISTORY = config.get("ETL", "quality_history", fallback="quality_history.json")
+STAGING_MODE = config.get("ETL", "staging_mode", fallback="serial")
+STAGING_CONCURRENCY = config.getint("ETL", "staging_concurrency", fallback=4)
+INSERT_MODE = config.get("ETL", "insert_mode", fallback="serial")
+INSERT_CONCURRENCY = config.getint("ETL", "insert_concurrency", fallback=4)
+BLUE_GREEN = config.getboolean("ETL", "blue_green", fallback=False)
+SERVING_SCHEMA = config.get("ETL", "serving_schema", fallback="public")
+PREVIOUS_SCHEMA = SERVING_SCHEMA + '_previous'
+READER_GROUP = config.get("ETL", "reader_group", fallback="")
+RUN_LOG_PATH = config.get("ETL", "run_log", fallback="run_log.jsonl")
+METRICS_TEXTFILE = config.get("ETL", "metrics_textfile", fallback="etl_metrics.prom")
+EXPORT_ENABLED = config.getboolean("EXPORT", "enabled", fallback=False)
+UNLOAD_ENABLED = config.getboolean("UNLOAD", "enabled", fallback=False)
+UNLOAD_PREFIX = config.get("UNLOAD", "prefix", fallback="unload")
+UNLOAD_MAX_FILE_SIZE_MB = config.getint("UNLOAD", "max_file_size_mb", fallback=256)
+UNLOAD_KEEP_VERSIONS = config.getint("UNLOAD", "keep_versions", fallback=2)
+RUN_STATE_PATH = config.get("ETL", "run_state", fallback="run_state.json")
+RESUME = config.getboolean("ETL", "resume", fallback=True)
+RETRY_ATTEMPTS = config.getint("ETL", "retry_attempts", fallback=3)
+RETRY_BACKOFF_SECONDS = config.getfloat("ETL", "retry_backoff_seconds", fallback=5)
+PLAN_CHECK = config.getboolean("ETL", "plan_check", fallback=False)
+ENRICH_TEMPERATURES = config.getboolean("ETL", "enrich_temperatures", fallback=True)
+PLAN_BASELINE = config.get("ETL", "plan_baseline", fallback="plan_baseline.json")
+PLAN_COST_TOLERANCE = config.getfloat("ETL", "plan_cost_tolerance", fallback=0.5)
+# Records the timing, row count, bytes scanned and query id of every step query.
+RUN_LOG = RunLog(LOAD_MODE)
+# Records the completed steps of a full load, so a failed one can be resumed.
+RUN_STATE = RunState(RUN_STATE_PATH)
+
+
+def get_s3_client():
+    """
+    Creates an S3 client from the 'AWS' settings in 'dwh.cfg'.
+
+    Returns:
+        boto3.client: S3 client.
+    """
+    return boto3.client('s3',
+                        region_name='us-west-2',
+                        aws_access_key_id=config.get('AWS', 'KEY'),
+                        aws_secret_access_key=config.get('AWS', 'SECRET'))
+
+
+def connection_string():
+    """
+    Builds the psycopg2 connection string from the 'CLUSTER' settings in 'dwh.cfg'.
+
+    Returns:
+        str: Connection string for psycopg2.connect.
+    """
+    return "host={} dbname={} user={} password={} port={}"\
+           .format(HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT)
+
+
+def list_copy_source(url):
+    """
+    Lists the S3 objects a COPY loads, to hash its inputs in 'RUN_STATE'.
+
+    Args:
+        url (str): COPY source, example: 's3://bucket/manifests/...manifest'.
+    Returns:
+        dict: Key mapped to {'size': int, 'version': str}.
+    """
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return list_s3_objects(get_s3_client(), bucket, prefix)
+
+
+def query_table_name(query):
+    """
+    Returns the name of the table a DROP, CREATE, COPY, INSERT or DELETE query writes to.
+
+    Args:
+        query (str): DROP, CREATE, COPY, INSERT or DELETE statement.
+    Returns:
+        str: Target table name, or the first line of the query if no target is found.
+    """
+    match = re.search(r'(?:DROP\s+TABLE\s+IF\s+EXISTS|CREATE\s+TABLE\s+IF\s+NOT\s+EXISTS|CREATE\s+TABLE|COPY|INSERT\s+INTO|DELETE\s+FROM)'
+                      r'\s+(?:public\.)?"?(\w+)"?', query, re.IGNORECASE)
+    if match:
+        return match.group(1)
+    return query.strip().splitlines()[0]
+
+
+def bind_schema(query, schema=None):
+    """
+    Points a query at 'schema' instead of 'public': qualified names are rewritten
+    and the search_path is set for unqualified ones.
+
+    Args:
+        query (str): Query written against the public schema.
+        schema (str): Target schema; None leaves the query unchanged.
+    Returns:
+        str: Query bound to the schema.
+    """
+    if schema is None:
+        return query
+    return 'SET search_path TO {};'.format(schema) + re.sub(r'\bpublic\.', schema + '.', query)
+
+
+def serving_schema():
+    """
+    Returns:
+        str: Schema readers query: 'serving_schema' once full loads are swapped in
+            with 'blue_green', else 'public'.
+    """
+    return SERVING_SCHEMA if BLUE_GREEN else 'public'
+
+
+def retry(run, reconnect=None, attempts=RETRY_ATTEMPTS, backoff_seconds=RETRY_BACKOFF_SECONDS):
+    """
+    Calls 'run', retrying with exponential backoff on a fresh connection when it
+    fails with a connection error. Other errors, and any error when there is no
+    way to reconnect, are raised at once.
+
+    Args:
+        run (function): Executes and commits the work; called again on retry.
+        reconnect (function): Replaces the broken connection with a fresh one.
+        attempts (int): Retries after the first failure.
+        backoff_seconds (float): Wait before the first retry; doubled for each one after.
+    Returns:
+        The result of 'run'.
+    """
+    for attempt in range(attempts + 1):
+        try:
+            return run()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if reconnect is None or attempt == attempts:
+                raise
+            delay = backoff_seconds * 2 ** attempt
+            print('Connection error, retrying in {:.0f}s ({}/{}): {}'.format(delay, attempt + 1, attempts,
+                                                                           str(e).strip()))
+            time.sleep(delay)
+            reconnect()
+
+
+def commit_step(conn, checkpoint):
+    """
+    Commits the transaction of a step. A connection error during COMMIT leaves
+    its outcome unknown: rerunning a non-idempotent step such as an INSERT ...
+    SELECT would double its rows if the commit had been applied. The step is
+    therefore not retried; it is recorded as uncertain, so the next run starts
+    over instead of resuming after it.
+
+    Args:
+        conn (psycopg2.connect): Connection of the step.
+        checkpoint (dict): Result of 'RUN_STATE.begin' for the step.
+    Returns:
+        None
+    """
+    try:
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        RUN_STATE.uncertain(checkpoint)
+        raise Exception('Commit FAILED! Outcome of {} unknown: {}'.format(checkpoint.get('key', 'step'),
+                                                                          str(e).strip()))
+
+
+class PooledCursor:
+    """
+    Cursor of a 'PooledConnection'; moves to the new connection after a reconnect.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.owner = connection.conn
+        self.cursor = self.owner.cursor()
+
+    def current(self):
+        if self.owner is not self.connection.conn:
+            self.owner = self.connection.conn
+            self.cursor = self.owner.cursor()
+        return self.cursor
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.current().close()
+
+
+class PooledConnection:
+    """
+    Connection borrowed from a pool that 'retry' can swap for a freshly pooled
+    one after a connection error, without the caller replacing its cursor.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = pool.getconn()
+
+    def cursor(self):
+        return PooledCursor(self)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        if not self.conn.closed:
+            self.conn.rollback()
+
+    def reconnect(self):
+        self.pool.putconn(self.conn, close=True)
+        self.conn = self.pool.getconn()
+
+    def close(self):
+        self.pool.closeall()
+
+
+def execute_step(cur, conn, step, query, schema=None):
+    """
+    Executes and commits a single query, recording it in 'RUN_LOG' and 'RUN_STATE'.
+    A step completed by the run being resumed is skipped; connection errors before
+    the commit are retried on a fresh connection when 'conn' can reconnect (see
+    'commit_step' for errors during it).
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        step (str): ETL step the query belongs to, example: 'insert_tables'.
+        query (str): Query to execute.
+        schema (str): Schema to run in instead of 'public' (see 'bind_schema').
+    Returns:
+        None
+    """
+    bound_query = bind_schema(query, schema)
+    table = query_table_name(query)
+    checkpoint = RUN_STATE.begin(step, table, bound_query)
+    if checkpoint['done']:
+        return
+
+    def run():
+        with RUN_LOG.step(step, table, bound_query, cur, conn):
+            cur.execute(bound_query)
+        commit_step(conn, checkpoint)
+
+    retry(run, getattr(conn, 'reconnect', None))
+    RUN_STATE.complete(checkpoint)
 
 
 def drop_tables(cur, conn):
@@ -29,56 +323,282 @@ def drop_tables(cur, conn):
         None
     """
     for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+        execute_step(cur, conn, 'drop_tables', query)
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, schema=None):
     """
     Executes the queries defined in 'create_table_queries'.
     
     Args:
         cur (conn.cursor()): Cursor to execute database commands.
         conn (psycopg2.connect): Database connection details.
+        schema (str): Schema to build in instead of 'public' (see 'bind_schema').
     Returns:
         None
     """
     for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+        execute_step(cur, conn, 'create_tables', query, schema)
 
 
-def load_staging_tables(cur, conn):
+def load_staging_tables(cur, conn, schema=None):
     """
     Executes the queries defined in 'copy_table_queries'.
     
     Args:
         cur (conn.cursor()): Cursor to execute database commands.
         conn (psycopg2.connect): Database connection details.
+        schema (str): Schema to build in instead of 'public' (see 'bind_schema').
     Returns:
         None
     """
     for query in copy_table_queries:
-        cur.execute(query)
+        execute_step(cur, conn, 'load_staging_tables', query, schema)
+
+
+def with_pooled_connection(pool, run):
+    """
+    Calls 'run' with a connection borrowed from 'pool', retrying connection errors
+    on a fresh connection from the pool (see 'retry').
+
+    Args:
+        pool (ThreadedConnectionPool): Pool to borrow the connection from.
+        run (function): Called with the connection; executes and commits the work.
+    Returns:
+        The result of 'run'.
+    """
+    conn = pool.getconn()
+
+    def reconnect():
+        nonlocal conn
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+
+    try:
+        return retry(lambda: run(conn), reconnect)
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+def execute_with_pool(pool, query, step, table):
+    """
+    Executes and commits a single query on a connection borrowed from 'pool',
+    recording it in 'RUN_LOG' and 'RUN_STATE'. A step completed by the run being
+    resumed is skipped.
+
+    Args:
+        pool (ThreadedConnectionPool): Pool to borrow the connection from.
+        query (str): Query to execute.
+        step (str): ETL step the query belongs to, example: 'load_staging_tables'.
+        table (str): Table the query writes to.
+    Returns:
+        float: Elapsed seconds, 0 for a skipped step.
+    """
+    checkpoint = RUN_STATE.begin(step, table, query)
+    if checkpoint['done']:
+        return 0.0
+
+    def run(conn):
+        with conn.cursor() as cur:
+            with RUN_LOG.step(step, table, query, cur, conn) as record:
+                cur.execute(query)
+        commit_step(conn, checkpoint)
+        return record['seconds']
+
+    seconds = with_pooled_connection(pool, run)
+    RUN_STATE.complete(checkpoint)
+    return seconds
+
+
+def fetch_one_with_pool(pool, query, step, table):
+    """
+    Executes a query on a connection borrowed from 'pool' and returns its first row,
+    recording it in 'RUN_LOG'.
+
+    Args:
+        pool (ThreadedConnectionPool): Pool to borrow the connection from.
+        query (str): Query to execute.
+        step (str): ETL step the query belongs to, example: 'quality_checks'.
+        table (str): Table the query reads.
+    Returns:
+        dict: Column name mapped to value.
+    """
+    def run(conn):
+        with conn.cursor() as cur:
+            with RUN_LOG.step(step, table, query, cur, conn):
+                cur.execute(query)
+                row = cur.fetchone()
+                columns = [column[0] for column in cur.description]
         conn.commit()
+        return dict(zip(columns, row))
+
+    return with_pooled_connection(pool, run)
+
+
+def load_staging_tables_parallel(max_workers=STAGING_CONCURRENCY, schema=None):
+    """
+    Executes the queries defined in 'copy_table_queries' concurrently over a
+    bounded pool of connections and prints how long each COPY took.
+
+    Args:
+        max_workers (int): Maximum number of COPY commands running at the same time.
+        schema (str): Schema to build in instead of 'public' (see 'bind_schema').
+    Returns:
+        dict: Elapsed seconds for each staged table.
+    """
+    pool = ThreadedConnectionPool(1, max_workers, connection_string())
+    timings = {}
+    failed_copies = []
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(execute_with_pool, pool, bind_schema(query, schema),
+                                       'load_staging_tables', query_table_name(query)): query_table_name(query)
+                       for query in copy_table_queries}
+            for future in as_completed(futures):
+                table = futures[future]
+                try:
+                    timings[table] = future.result()
+                    print('{:<40}{:>10.2f}s'.format(table, timings[table]))
+                except Exception as e:
+                    failed_copies.append((table, str(e).strip()))
+    finally:
+        pool.closeall()
+    print('{:<40}{:>10.2f}s'.format('TOTAL (wall clock)', time.time() - start))
 
+    if failed_copies:
+        print("FAILED COPIES:")
+        for failed_copy in failed_copies:
+            print(failed_copy)
+        raise Exception('Staging COPY FAILED!')
+    return timings
 
-def insert_tables(cur, conn):
+
+def insert_tables(cur, conn, schema=None):
     """
     Executes the queries defined in 'insert_table_queries'.
     
     Args:
         cur (conn.cursor()): Cursor to execute database commands.
         conn (psycopg2.connect): Database connection details.
+        schema (str): Schema to build in instead of 'public' (see 'bind_schema').
     Returns:
         None
     """
     for query in insert_table_queries:
-        cur.execute(query)
+        execute_step(cur, conn, 'insert_tables', query, schema)
+
+
+def insert_tables_dag(max_workers=INSERT_CONCURRENCY, schema=None):
+    """
+    Executes the steps defined in 'insert_table_steps', starting each insert as
+    soon as the tables it reads have been loaded, and prints a critical-path
+    timing report.
+
+    Args:
+        max_workers (int): Maximum number of inserts running at the same time.
+        schema (str): Schema to build in instead of 'public' (see 'bind_schema').
+    Returns:
+        dict: Start, end and duration in seconds for each step.
+    """
+    pool = ThreadedConnectionPool(1, max_workers, connection_string())
+    try:
+        timings = run_dag(insert_table_steps,
+                          lambda step: execute_with_pool(pool, bind_schema(step['query'], schema), 'insert_tables', step['outputs'][0]),
+                          max_workers)
+    finally:
+        pool.closeall()
+    print_timing_report(insert_table_steps, timings)
+    return timings
+
+
+def i94_month_partition(month):
+    """
+    Converts an i94 month folder name to its (i94yr, i94mon) partition.
+
+    Args:
+        month (str): Month folder name, example: 'i94_jan16_sub'.
+    Returns:
+        tuple: (i94yr, i94mon), example: (2016, 1).
+    """
+    match = re.match(r'i94_([a-z]{3})(\d{2})_sub$', month)
+    if not match:
+        raise ValueError('Unrecognized i94 month folder: {}'.format(month))
+    return 2000 + int(match.group(2)), I94_MONTHS.index(match.group(1)) + 1
+
+
+def incremental_load(cur, conn, s3_client, catalog_path=COPY_CATALOG, schema=None):
+    """
+    Stages and inserts only the i94 months that are not yet recorded in
+    'load_watermark' or whose parquet parts were added, changed or removed
+    since they were last loaded (per the catalog at 'catalog_path').
+    Each month is staged through a COPY manifest of its parts and replaces its
+    (i94yr, i94mon) partition in 'i94_immigration' in a single transaction.
+    Months whose folder was deleted are removed from 'i94_immigration',
+    'load_watermark' and the aggregates the same way. 'us_state_visitor_demographics'
+    is then refreshed.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        s3_client (boto3.client): S3 client used to list parts and upload manifests.
+        catalog_path (str): JSON catalog of already-loaded parquet parts.
+        schema (str): Schema to load in instead of 'public' (see 'bind_schema').
+    Returns:
+        list: Month folder names that were loaded or removed.
+    """
+    create_tables(cur, conn, schema)
+
+    cur.execute(bind_schema(load_watermark_select, schema))
+    loaded = set((int(yr), int(mon)) for yr, mon in cur.fetchall())
+    if not loaded:
+        raise Exception('load_watermark is empty, run a full load first!')
+
+    objects = list_s3_objects(s3_client, S3_BUCKET, I94_PREFIX)
+    catalog = load_catalog(catalog_path)
+    listed_months = month_keys(objects, I94_PREFIX)
+    changed, removed_months = changed_months(objects, catalog, I94_PREFIX)
+    new_months = [month for month in sorted(listed_months, key=i94_month_partition)
+                  if month in changed or i94_month_partition(month) not in loaded]
+
+    for month in new_months:
+        start = time.time()
+        upload_manifest(s3_client, S3_BUCKET, i94_manifest_key.format(month),
+                        build_manifest(S3_BUCKET, listed_months[month], objects))
+        for query in incremental_i94_month_queries(month, i94_month_partition(month)):
+            cur.execute(bind_schema(query, schema))
         conn.commit()
+        for key in month_keys(catalog, I94_PREFIX).get(month, []):
+            if key not in objects:
+                del catalog[key]
+        for key in listed_months[month]:
+            catalog[key] = objects[key]
+        save_catalog(catalog_path, catalog)
+        print('{:<40}{:>10.2f}s'.format(month, time.time() - start))
 
-        
-def quality_checks(cur, conn, checks):
+    # Months whose folder was deleted from S3 are removed from the warehouse.
+    for month in removed_months:
+        start = time.time()
+        for query in incremental_i94_month_removal_queries(i94_month_partition(month)):
+            cur.execute(bind_schema(query, schema))
+        conn.commit()
+        for key in month_keys(catalog, I94_PREFIX)[month]:
+            del catalog[key]
+        save_catalog(catalog_path, catalog)
+        print('{:<40}{:>10.2f}s removed'.format(month, time.time() - start))
+
+    if new_months or removed_months:
+        for query in incremental_refresh_queries:
+            cur.execute(bind_schema(query, schema))
+        conn.commit()
+    return new_months + removed_months
+
+
+def quality_checks(cur, conn, checks, schema=None):
     """
     Executes data quality queries defined in 'checks'.
     
@@ -87,6 +607,7 @@ def quality_checks(cur, conn, checks):
         conn (psycopg2.connect): Database connection details.
         checks: dictionary of data quality checks and expected results, example:
             {'check_sql': 'SELECT COUNT(*) FROM i94visal', 'expected_result': 3}
+        schema (str): Schema to check instead of 'public' (see 'bind_schema').
 
     Returns:
         None
@@ -100,8 +621,10 @@ def quality_checks(cur, conn, checks):
         chk_sql = check.get('check_sql')
         exp_result = check.get('expected_result')
 
-        cur.execute(chk_sql)
-        result = cur.fetchall()
+        chk_query = bind_schema(chk_sql, schema)
+        with RUN_LOG.step('quality_checks', chk_sql, chk_query, cur, conn):
+            cur.execute(chk_query)
+            result = cur.fetchall()
     
         if exp_result != result[0][0]:
             failed_count += 1
@@ -122,35 +645,493 @@ def quality_checks(cur, conn, checks):
         raise Exception('Data Check FAILED!')
 
 
-def main():
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}"\
-                            .format(HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT))
-    cur = conn.cursor()
+def profile_fetch(pool, schema=None):
+    """
+    Returns the 'fetch_one' function 'profile_tables' runs the profile queries with.
+
+    Args:
+        pool (ThreadedConnectionPool): Pool to borrow the connections from.
+        schema (str): Schema to check instead of 'public' (see 'bind_schema').
+    Returns:
+        function: Executes a profile query and returns its first row as a dict.
+    """
+    def fetch_one(query):
+        table = re.search(r'\bFROM\s+(\w+)\s*;\s*$', query).group(1)
+        return fetch_one_with_pool(pool, bind_schema(query, schema), 'quality_checks', table)
+    return fetch_one
+
+
+def quality_profile_checks(profiles, max_workers=QUALITY_CONCURRENCY, history_path=QUALITY_HISTORY, schema=None):
+    """
+    Profiles each table in 'profiles' in a single scan, all tables concurrently,
+    and checks the metrics against their tolerance ranges. Profiles of a passing
+    run are saved as the baseline for the next run's row-count deltas.
+
+    Args:
+        profiles (list): Table profile definitions, example:
+            {'table': 'i94visal', 'columns': ['id'], 'checks': [{'metric': 'row_count', 'min': 3, 'max': 3}]}
+        max_workers (int): Tables profiled at the same time.
+        history_path (str): JSON file with the profiles of the previous run.
+        schema (str): Schema to check instead of 'public' (see 'bind_schema').
+    Returns:
+        dict: Table name mapped to its profile.
+    """
+    pool = ThreadedConnectionPool(1, max_workers, connection_string())
+    try:
+        results = profile_tables(profiles, profile_fetch(pool, schema), max_workers)
+    finally:
+        pool.closeall()
+    passed_tests, failed_tests = evaluate(profiles, results, load_history(history_path))
+
+    if passed_tests:
+        print("PASSED QUALITY CHECKS:")
+        for passed_test in passed_tests:
+            print(passed_test)
+
+    if failed_tests:
+        print("FAILED QUALITY CHECKS:")
+        for failed_test in failed_tests:
+            print(failed_test)
+        raise Exception('Data Check FAILED!')
+
+    save_history(history_path, results)
+    return results
+
+
+def run_quality_checks(cur, conn, checks, profiles, schema=None):
+    """
+    Runs 'profiles' when 'quality_mode = profile' is set in 'dwh.cfg', otherwise 'checks'.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        checks (list): Query checks for 'quality_checks'.
+        profiles (list): Table profile definitions for 'quality_profile_checks'.
+        schema (str): Schema to check instead of 'public' (see 'bind_schema').
+    Returns:
+        None
+    """
+    if QUALITY_MODE == 'profile':
+        quality_profile_checks(profiles, schema=schema)
+    else:
+        quality_checks(cur, conn, checks, schema)
+
+
+def plan_checks(cur, conn, schema=None, baseline_path=PLAN_BASELINE, tolerance=PLAN_COST_TOLERANCE):
+    """
+    Explains every query in 'insert_table_queries' before it runs and fails the
+    load if a plan regressed against the baseline: a higher cost, or an added
+    broadcast, redistribution or nested-loop step (see 'query_plans.py').
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        schema (str): Schema to explain in instead of 'public' (see 'bind_schema').
+        baseline_path (str): JSON file with the baseline plans.
+        tolerance (float): Allowed plan cost increase, example: 0.5 for 50%.
+    Returns:
+        dict: Query name mapped to its plan summary.
+    """
+    def fetch_all(query):
+        with RUN_LOG.step('plan_checks', query_table_name(query), query, cur, conn):
+            cur.execute(bind_schema(query, schema))
+            rows = cur.fetchall()
+        conn.commit()
+        return rows
+
+    return check_plans(fetch_all, baseline_path, tolerance)
+
+
+def create_build_schema(cur, conn):
+    """
+    Creates an empty, versioned schema to run a full load in while readers keep
+    querying the serving schema.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+    Returns:
+        str: Build schema name, example: 'public_v20160131120000'.
+    """
+    build_schema = SERVING_SCHEMA + '_v' + time.strftime('%Y%m%d%H%M%S')
+    cur.execute(schema_drop.format(build_schema))
+    cur.execute(schema_create.format(build_schema))
+    conn.commit()
+    return build_schema
+
+
+def swap_schemas(cur, conn, build_schema):
+    """
+    Publishes a checked build schema in a single transaction: the serving schema
+    becomes the previous version and the build schema takes its name, so readers
+    see either the old tables or the new ones, never empty ones. The build schema
+    is first granted what readers have on the serving schema: 'reader_group' gets
+    USAGE and SELECT, and a new 'public' gets its default privileges back. The
+    session search_path set by 'bind_schema' is reset, since the build schema it
+    names no longer exists after the swap.
 
-    print('Begin ETL:')
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        build_schema (str): Schema created by 'create_build_schema'.
+    Returns:
+        None
+    """
+    try:
+        if READER_GROUP:
+            cur.execute(schema_grant_usage.format(build_schema, READER_GROUP))
+            cur.execute(schema_grant_select.format(build_schema, READER_GROUP))
+        if SERVING_SCHEMA == 'public':
+            cur.execute(schema_grant_public.format(build_schema))
+        cur.execute(schema_drop.format(PREVIOUS_SCHEMA))
+        cur.execute(schema_exists.format(SERVING_SCHEMA))
+        if cur.fetchone()[0]:
+            cur.execute(schema_rename.format(SERVING_SCHEMA, PREVIOUS_SCHEMA))
+        cur.execute(schema_rename.format(build_schema, SERVING_SCHEMA))
+        cur.execute(search_path_reset)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise Exception('Schema swap FAILED!')
 
-    drop_tables(cur, conn)
-    print('\n' + 'drop_tables...COMPLETE')
 
-    create_tables(cur, conn)
+def rollback_schema(cur, conn):
+    """
+    Swaps the previous version back in, keeping the current one as the previous
+    version so the rollback can itself be undone.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+    Returns:
+        None
+    """
+    cur.execute(schema_exists.format(PREVIOUS_SCHEMA))
+    if not cur.fetchone()[0]:
+        raise Exception('Schema rollback FAILED! No ' + PREVIOUS_SCHEMA + ' schema to roll back to.')
+    swap_schema = SERVING_SCHEMA + '_rollback'
+    try:
+        cur.execute(schema_drop.format(swap_schema))
+        cur.execute(schema_rename.format(SERVING_SCHEMA, swap_schema))
+        cur.execute(schema_rename.format(PREVIOUS_SCHEMA, SERVING_SCHEMA))
+        cur.execute(schema_rename.format(swap_schema, PREVIOUS_SCHEMA))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise Exception('Schema rollback FAILED!')
+
+
+def sql_literal(value):
+    """
+    Args:
+        value (str, int, float or None): Value to embed in a query.
+    Returns:
+        str: SQL literal.
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return repr(value)
+
+
+def enrich_temperatures(cur, conn, schema=None, batch_size=500):
+    """
+    Maps each i94 port to its nearest weather station with a k-d tree over the
+    distinct 'world_temperatures' stations (see 'spatial.py'), then builds the
+    port x month temperature dimension 'port_month_temperature'.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        schema (str): Schema to build in instead of 'public' (see 'bind_schema').
+        batch_size (int): Ports inserted per INSERT statement.
+    Returns:
+        int: Ports mapped to a station.
+    """
+    cur.execute(bind_schema(weather_stations_select, schema))
+    stations = cur.fetchall()
+    cur.execute(bind_schema(port_locations_select, schema))
+    ports = cur.fetchall()
+    matches = nearest_stations(ports, stations)
+
+    # Each table is cleared and refilled in one step, so readers never see it empty
+    # or partly filled and a failure leaves the previous rows in place.
+    inserts = [port_weather_station_insert.format(', '.join('(' + ', '.join(sql_literal(value) for value in match) + ')'
+                                                            for match in matches[start:start + batch_size]))
+               for start in range(0, len(matches), batch_size)]
+    execute_step(cur, conn, 'enrich_temperatures', port_weather_station_clear + ''.join(inserts), schema)
+    execute_step(cur, conn, 'enrich_temperatures', port_month_temperature_clear + port_month_temperature_insert, schema)
+    print('{} ports mapped to {} weather stations'.format(len(matches), len(stations)))
+    return len(matches)
+
+
+def carry_over_serving_tables(cur, conn, schema):
+    """
+    Copies the tables in 'carry_over_tables' from the serving schema into the build
+    schema, so a blue/green load merges into them as an in-place load would.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        schema (str): Build schema.
+    Returns:
+        None
+    """
+    for table in carry_over_tables:
+        cur.execute(table_exists.format(SERVING_SCHEMA, table))
+        if cur.fetchone()[0]:
+            execute_step(cur, conn, 'carry_over_serving_tables', table_carry_over.format(table, SERVING_SCHEMA), schema)
+
+
+def full_load(cur, conn, schema=None):
+    """
+    Creates, stages, inserts and checks every table, in 'schema' when given.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        schema (str): Schema to build in instead of 'public' (see 'bind_schema').
+    Returns:
+        None
+    """
+    create_tables(cur, conn, schema)
     print('\n' + 'create_tables...COMPLETE')
 
-    load_staging_tables(cur, conn) #Approximate Staging Time: 2min for ~50 Million Records with 2 Nodes
+    if schema is not None and carry_over_tables:
+        carry_over_serving_tables(cur, conn, schema)
+        print('\n' + 'carry_over_serving_tables...COMPLETE')
+
+    if STAGING_MODE == 'parallel':
+        load_staging_tables_parallel(STAGING_CONCURRENCY, schema)
+    else:
+        load_staging_tables(cur, conn, schema) #Approximate Staging Time: 2min for ~50 Million Records with 2 Nodes
     print('\n' + 'load_staging_tables...COMPLETE')
 
     print('')
-    quality_checks(cur, conn, staging_checks)
+    run_quality_checks(cur, conn, staging_checks, staging_profiles, schema)
     print('\n' + 'staging_quality_checks...COMPLETE')
 
-    insert_tables(cur, conn) #Approximate Insert Time: 1min for ~50 Million Records with 2 Nodes
+    if PLAN_CHECK:
+        print('')
+        plan_checks(cur, conn, schema)
+        print('\n' + 'plan_checks...COMPLETE')
+
+    if INSERT_MODE == 'dag':
+        insert_tables_dag(INSERT_CONCURRENCY, schema)
+    else:
+        insert_tables(cur, conn, schema) #Approximate Insert Time: 1min for ~50 Million Records with 2 Nodes
     print('\n' + 'insert_tables...COMPLETE')
 
+    if ENRICH_TEMPERATURES:
+        enrich_temperatures(cur, conn, schema)
+        print('\n' + 'enrich_temperatures...COMPLETE')
+
     print('')
-    quality_checks(cur, conn, insert_checks)
+    run_quality_checks(cur, conn, insert_checks, insert_profiles, schema)
     print('\n' + 'insert_quality_checks...COMPLETE')
 
-    conn.close()
-    print('\n' + 'End of ETL' + '\n')
+
+def full_build(cur, conn):
+    """
+    Runs a full load in place, or with 'blue_green' in a build schema swapped in
+    once checked. Steps completed by the run being resumed are skipped, and its
+    build schema reused; a failed build schema is kept while 'resume' is on.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+    Returns:
+        None
+    """
+    if not BLUE_GREEN:
+        drop_tables(cur, conn)
+        print('\n' + 'drop_tables...COMPLETE')
+
+        full_load(cur, conn)
+        return
+
+    build_schema = RUN_STATE.schema()
+    if build_schema is not None:
+        cur.execute(schema_exists.format(build_schema))
+        if not cur.fetchone()[0]:
+            RUN_STATE.reset()
+            build_schema = None
+    if build_schema is None:
+        build_schema = create_build_schema(cur, conn)
+        RUN_STATE.set_schema(build_schema)
+        print('\n' + 'create_build_schema...COMPLETE (' + build_schema + ')')
+    else:
+        print('\n' + 'resume_build_schema...COMPLETE (' + build_schema + ')')
+    try:
+        full_load(cur, conn, build_schema)
+    except Exception:
+        # The serving schema was never touched; keep the partial build to resume or discard it.
+        conn.rollback()
+        if RESUME and not RUN_STATE.stale:
+            print('\n' + 'Build schema ' + build_schema + ' kept for the next run to resume')
+        else:
+            cur.execute(schema_drop.format(build_schema))
+            conn.commit()
+        raise
+    swap_schemas(cur, conn, build_schema)
+    print('\n' + 'swap_schemas...COMPLETE (' + build_schema + ' -> ' + SERVING_SCHEMA + ')')
+
+
+def publish_load_version(cur, conn):
+    """
+    Records this run as the load readers are served from; 'query_service.py'
+    clears its cache when the version changes.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+    Returns:
+        str: Published version.
+    """
+    version = RUN_LOG.summary('success')['run_id']
+    cur.execute(load_version_publish.format(serving_schema(), version, LOAD_MODE))
+    conn.commit()
+    return version
+
+
+def export_serving_files(cur, conn):
+    """
+    Exports the serving tables and rollups of this run to local files for dashboards
+    (see 'serving_export.py'), recording each query in the run log. The queries name
+    the serving schema, so they do not depend on the session search_path.
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+    Returns:
+        dict: Export manifest.
+    """
+    def fetch_all(query):
+        table = re.search(r'\bFROM\s+(?:\w+\.)?(\w+)', query, re.IGNORECASE).group(1)
+        with RUN_LOG.step('export_serving', table, query, cur, conn):
+            cur.execute(query)
+            rows = cur.fetchall()
+        conn.commit()
+        return rows
+
+    return export_serving(fetch_all, RUN_LOG.summary('success')['run_id'], schema=serving_schema())
+
+
+def unload_tables(cur, conn, target=None):
+    """
+    UNLOADs the tables in 'unload_exports' to partitioned, size-capped parquet
+    files for the Spark serving tier, each written in parallel by every slice,
+    then publishes this load's manifest (see 'unload.py').
+
+    Args:
+        cur (conn.cursor()): Cursor to execute database commands.
+        conn (psycopg2.connect): Database connection details.
+        target (S3Target or LocalTarget): Where the files go; the 'S3' bucket if None.
+    Returns:
+        dict: Unload manifest.
+    """
+    target = target or S3Target(get_s3_client(), S3_BUCKET)
+    version = RUN_LOG.summary('success')['run_id']
+    for table, query in unload_queries(target, version, UNLOAD_PREFIX, UNLOAD_MAX_FILE_SIZE_MB, serving_schema()):
+        # Unlike an insert, an UNLOAD is safe to rerun after a lost COMMIT: it writes
+        # no rows and CLEANPATH replaces the files of the earlier attempt.
+        def run():
+            with RUN_LOG.step('unload_tables', table, query, cur, conn) as record:
+                cur.execute(query)
+            conn.commit()
+            return record['seconds']
+
+        print('{:<40}{:>10.2f}s'.format(table, retry(run, getattr(conn, 'reconnect', None))))
+    return publish_unload(target, version, UNLOAD_PREFIX, keep_versions=UNLOAD_KEEP_VERSIONS)
+
+
+def write_run_log(status):
+    """
+    Appends the run recorded in 'RUN_LOG' to the JSON run log and replaces the
+    Prometheus textfile with its metrics.
+
+    Args:
+        status (str): 'success' or 'failed'.
+    Returns:
+        None
+    """
+    RUN_LOG.write_json(RUN_LOG_PATH, status)
+    RUN_LOG.write_prometheus(METRICS_TEXTFILE, status)
+    print('\n' + 'Run log written to ' + RUN_LOG_PATH + ' and ' + METRICS_TEXTFILE)
+
+
+def main():
+    conn = PooledConnection(ThreadedConnectionPool(1, 1, connection_string()))
+    cur = conn.cursor()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'rollback':
+        rollback_schema(cur, conn)
+        print('\n' + 'rollback_schema...COMPLETE ({} restored)'.format(PREVIOUS_SCHEMA) + '\n')
+        conn.close()
+        return
+
+    try:
+        print('Begin ETL:')
+
+        if LOAD_MODE == 'incremental':
+            # Months are loaded in place, in the schema readers are served from.
+            schema = None if serving_schema() == 'public' else serving_schema()
+            new_months = incremental_load(cur, conn, get_s3_client(), schema=schema)
+            print('\n' + 'incremental_load...COMPLETE ({} new or removed months)'.format(len(new_months)))
+
+            print('')
+            quality_checks(cur, conn, incremental_checks, schema)
+            if QUALITY_MODE == 'profile':
+                quality_profile_checks(insert_profiles, schema=schema)
+            print('\n' + 'incremental_quality_checks...COMPLETE')
+
+            print('\n' + 'publish_load_version...COMPLETE (' + publish_load_version(cur, conn) + ')')
+            if EXPORT_ENABLED:
+                export_serving_files(cur, conn)
+                print('\n' + 'export_serving...COMPLETE')
+            if UNLOAD_ENABLED:
+                unload_tables(cur, conn)
+                print('\n' + 'unload_tables...COMPLETE')
+            write_run_log('success')
+            conn.close()
+            print('\n' + 'End of ETL' + '\n')
+            return
+
+        i94_objects = list_s3_objects(get_s3_client(), S3_BUCKET, I94_PREFIX)
+
+        if RUN_STATE.start(RUN_LOG.summary('running')['run_id'], LOAD_MODE, RESUME, list_copy_source):
+            print('\n' + 'Resuming run {} ({} steps complete)'.format(RUN_STATE.run_id(), RUN_STATE.completed_steps()))
+        try:
+            full_build(cur, conn)
+        except Exception:
+            if not RUN_STATE.stale:
+                raise
+            # The inputs of a completed step changed since the failed run: start over.
+            conn.rollback()
+            print('\n' + 'Run state of run ' + RUN_STATE.run_id() + ' is stale, restarting from the first step')
+            RUN_STATE.reset()
+            full_build(cur, conn)
+        if RUN_STATE.skipped:
+            print('\n' + 'resume...COMPLETE ({} completed steps skipped)'.format(RUN_STATE.skipped))
+
+        save_catalog(COPY_CATALOG, i94_objects)
+
+        print('\n' + 'publish_load_version...COMPLETE (' + publish_load_version(cur, conn) + ')')
+        if EXPORT_ENABLED:
+            export_serving_files(cur, conn)
+            print('\n' + 'export_serving...COMPLETE')
+        if UNLOAD_ENABLED:
+            unload_tables(cur, conn)
+            print('\n' + 'unload_tables...COMPLETE')
+        RUN_STATE.finish('success')
+        write_run_log('success')
+        conn.close()
+        print('\n' + 'End of ETL' + '\n')
+    except Exception:
+        RUN_STATE.finish('failed')
+        write_run_log('failed')
+        raise
 
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+# IMPORTS
+import os
+from pyspark.sql import functions as F
+from pyspark.sql.types import StructType, StructField, StringType
+
+# Output columns and types, matching 'i94_immigration_table_create' in 'sql_queries.py'
+# so the parquet files COPY straight into public.i94_immigration.
+I94_IMMIGRATION_COLUMNS = [('cicid', 'int'),
+                           ('i94yr', 'smallint'),
+                           ('i94mon', 'smallint'),
+                           ('i94cit', 'smallint'),
+                           ('i94res', 'smallint'),
+                           ('i94port', 'string'),
+                           ('arrdate', 'date'),
+                           ('i94mode', 'smallint'),
+                           ('i94addr', 'string'),
+                           ('depdate', 'date'),
+                           ('i94bir', 'smallint'),
+                           ('i94visa', 'smallint'),
+                           ('count', 'smallint'),
+                           ('dtadfile', 'date'),
+                           ('visapost', 'string'),
+                           ('occup', 'string'),
+                           ('entdepa', 'string'),
+                           ('entdepd', 'string'),
+                           ('entdepu', 'string'),
+                           ('matflag', 'string'),
+                           ('biryear', 'smallint'),
+                           ('dtaddto', 'date'),
+                           ('gender', 'string'),
+                           ('insnum', 'string'),
+                           ('airline', 'string'),
+                           ('admnum', 'bigint'),
+                           ('fltno', 'string'),
+                           ('visatype', 'string')]
+
+
+def load_lookups(spark, lookup_dir='./lookup_data'):
+    """
+    Reads the lookup codes used to normalize the i94 columns.
+
+    Args:
+        spark (SparkSession): Spark session.
+        lookup_dir (str): Directory with the lookup CSV files.
+    Returns:
+        dict: Lookup name mapped to a single-column DataFrame of valid ids.
+    """
+    schema = StructType([StructField('id', StringType()), StructField('name', StringType())])
+    lookups = {}
+    for name in ['i94addrl', 'i94cntyl', 'i94model', 'i94visal']:
+        lookups[name] = spark.read.csv(os.path.join(lookup_dir, name + '.csv'), schema=schema) \
+                             .select(F.trim(F.col('id')).alias('id')).distinct()
+    lookups['i94prtl'] = spark.read.csv(os.path.join(lookup_dir, 'i94prtl_enriched.csv'), header=True) \
+                              .select(F.col('ID').alias('id')).distinct()
+    return lookups
+
+
+def normalize(df, column, lookup, default, cast_to):
+    """
+    Replaces values of 'column' that are not in 'lookup' with 'default', using a
+    broadcast join so the small lookup is shipped to every executor.
+
+    Args:
+        df (DataFrame): i94 data.
+        column (str): Column to normalize.
+        lookup (DataFrame): Valid ids in column 'id'.
+        default: Value for codes not found in the lookup.
+        cast_to (str): Spark SQL type of the column and of the lookup ids.
+    Returns:
+        DataFrame: Data with 'column' normalized.
+    """
+    valid = F.broadcast(lookup.select(F.col('id').cast(cast_to).alias(column + '_valid'))) \
+             .withColumn(column + '_found', F.lit(True))
+    return df.join(valid, df[column].cast(cast_to) == valid[column + '_valid'], 'left') \
+             .withColumn(column, F.when(F.col(column + '_found').isNull(), F.lit(default).cast(cast_to))
+                                  .otherwise(F.col(column).cast(cast_to))) \
+             .drop(column + '_valid', column + '_found')
+
+
+def transform_i94(df, lookups):
+    """
+    Applies the cleaning done by 'i94_immigration_table_insert' in Spark: casts the
+    SAS float columns to integers, converts SAS day numbers and date strings to
+    dates, and normalizes codes against the lookups.
+
+    Args:
+        df (DataFrame): Raw i94 data as read from a SAS file.
+        lookups (dict): Output of 'load_lookups'.
+    Returns:
+        DataFrame: Typed data with the columns of public.i94_immigration.
+    """
+    dtaddto = F.trim(F.col('dtaddto'))
+    df = df.withColumn('arrdate', F.expr("date_add(to_date('1960-01-01'), CAST(arrdate AS INT))")) \
+           .withColumn('depdate', F.expr("date_add(to_date('1960-01-01'), CAST(depdate AS INT))")) \
+           .withColumn('dtadfile', F.to_date(F.col('dtadfile'), 'yyyyMMdd')) \
+           .withColumn('dtaddto', F.when(dtaddto.rlike('^[0-9]{8}$') & ~dtaddto.isin('00000000', '12319999'),
+                                         F.to_date(dtaddto, 'MMddyyyy')))
+
+    df = normalize(df, 'i94cit', lookups['i94cntyl'], 999, 'smallint')
+    df = normalize(df, 'i94res', lookups['i94cntyl'], 999, 'smallint')
+    df = normalize(df, 'i94port', lookups['i94prtl'], 'XXX', 'string')
+    df = normalize(df, 'i94mode', lookups['i94model'], 9, 'smallint')
+    df = normalize(df, 'i94addr', lookups['i94addrl'], '99', 'string')
+    df = normalize(df, 'i94visa', lookups['i94visal'], 2, 'smallint')
+
+    return df.select([F.col(name).cast(data_type).alias(name) for name, data_type in I94_IMMIGRATION_COLUMNS])
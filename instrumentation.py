@@ -0,0 +1,262 @@
+# IMPORTS
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Leader-node functions cannot be combined with system tables in one query, so
+# the query id and COPY row count are read first and the bytes scanned second.
+LAST_QUERY_SQL = "SELECT pg_last_query_id(), pg_last_copy_count();"
+SCAN_BYTES_SQL = "SELECT COALESCE(SUM(bytes), 0) FROM stl_scan WHERE query = {};"
+COPY_BYTES_SQL = "SELECT COALESCE(SUM(transfer_size), 0) FROM stl_s3client WHERE query = {};"
+LOAD_ERROR_SQL = """
+    SELECT TRIM(filename), line_number, TRIM(colname), TRIM(err_reason)
+      FROM stl_load_errors
+     WHERE query = pg_last_copy_id()
+     ORDER BY starttime DESC
+     LIMIT 1;
+"""
+
+# Prometheus metric name, record field and help text.
+PROMETHEUS_METRICS = [('etl_step_duration_seconds', 'seconds', 'Wall time of the query.'),
+                      ('etl_step_rows', 'rows', 'Rows loaded, inserted or returned by the query.'),
+                      ('etl_step_bytes_scanned', 'bytes_scanned', 'Bytes read from tables or S3 by the query.'),
+                      ('etl_step_failed', 'failed', '1 if the query failed.')]
+
+
+def is_copy(query):
+    """
+    Tells whether a query, possibly bound to a schema, is a COPY.
+
+    Args:
+        query (str): Query.
+    Returns:
+        bool: True for COPY queries.
+    """
+    statement = query.strip().split(';', 1)[1] if query.lstrip().upper().startswith('SET ') else query
+    return statement.lstrip().upper().startswith('COPY')
+
+
+def query_stats(cur, query):
+    """
+    Reads the Redshift query id, COPY row count and bytes scanned of the query the
+    cursor just ran. Must be called before the transaction is committed. Errors
+    are not raised: the stats are None and the error is returned instead.
+
+    Args:
+        cur (conn.cursor()): Cursor the query ran on.
+        query (str): The query, to tell a COPY (bytes read from S3) from other queries.
+    Returns:
+        dict: {'query_id', 'copy_rows', 'bytes_scanned', 'error'}; unknown values are None.
+    """
+    stats = {'query_id': None, 'copy_rows': None, 'bytes_scanned': None, 'error': None}
+    try:
+        cur.execute(LAST_QUERY_SQL)
+        query_id, stats['copy_rows'] = cur.fetchone()
+        if query_id is None or query_id < 0:
+            return stats
+        cur.execute((COPY_BYTES_SQL if is_copy(query) else SCAN_BYTES_SQL).format(query_id))
+        stats['bytes_scanned'] = cur.fetchone()[0]
+        stats['query_id'] = query_id
+    except Exception as e:
+        stats.update({'query_id': None, 'copy_rows': None, 'bytes_scanned': None, 'error': e})
+    return stats
+
+
+def transaction_aborted(conn):
+    """
+    Tells whether a failed query aborted the open transaction, or lost it with the
+    connection; committing then would silently discard the work done in it.
+
+    Args:
+        conn (psycopg2.connect): Connection, possibly wrapped in 'conn.conn'.
+    Returns:
+        bool: True if the transaction cannot be committed.
+    """
+    status = getattr(getattr(conn, 'conn', conn), 'get_transaction_status', None)
+    # psycopg2.extensions.TRANSACTION_STATUS_INERROR and TRANSACTION_STATUS_UNKNOWN.
+    return status is not None and status() in (3, 4)
+
+
+def load_error(cur):
+    """
+    Reads the most recent row rejected by the last COPY of the session.
+
+    Args:
+        cur (conn.cursor()): Cursor on the session that ran the COPY.
+    Returns:
+        dict: {'filename', 'line_number', 'column', 'reason'}, or None.
+    """
+    try:
+        cur.execute(LOAD_ERROR_SQL)
+        row = cur.fetchone()
+    except Exception:
+        return None
+    if not row:
+        return None
+    return dict(zip(['filename', 'line_number', 'column', 'reason'], row))
+
+
+def safe_rollback(conn):
+    """
+    Rolls back without masking the error being handled: a dropped connection
+    cannot roll back, and is replaced by the caller's retry instead.
+
+    Args:
+        conn (psycopg2.connect): Connection to roll back.
+    Returns:
+        bool: True if the rollback succeeded.
+    """
+    try:
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def prometheus_label(value):
+    """
+    Escapes a Prometheus label value.
+
+    Args:
+        value (str): Label value.
+    Returns:
+        str: Escaped value.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+class RunLog:
+    """
+    Collects one record per instrumented query of an ETL run; safe to share
+    between the threads of the parallel staging, insert and quality steps.
+    """
+    def __init__(self, mode='full'):
+        self.lock = threading.Lock()
+        self.records = []
+        self.mode = mode
+        self.started_at = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.records = []
+            self.started_at = time.time()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    @contextmanager
+    def step(self, step, table, query, cur, conn):
+        """
+        Times the queries run in the 'with' block and records the row count, bytes
+        scanned and query id of the last one. Results must be fetched inside the
+        block; commit after it. On failure the transaction is rolled back, the
+        COPY load error (if any) recorded and the exception re-raised. Stats that
+        cannot be read are recorded as None; the step only fails if reading them
+        aborted its transaction.
+
+        Args:
+            step (str): ETL step, example: 'load_staging_tables'.
+            table (str): Table the query loads or checks.
+            query (str): The query run in the block.
+            cur (conn.cursor()): Cursor the query runs on.
+            conn (psycopg2.connect): Connection of the cursor.
+        """
+        record = {'step': step, 'table': table, 'started_at': time.time()}
+        try:
+            yield record
+            record['seconds'] = time.time() - record['started_at']
+            rowcount = cur.rowcount
+            stats = query_stats(cur, query)
+            if stats['error'] is not None and transaction_aborted(conn):
+                raise stats['error']
+        except Exception as e:
+            record['seconds'] = time.time() - record['started_at']
+            record['failed'] = 1
+            record['error'] = str(e).strip()
+            if safe_rollback(conn) and is_copy(query):
+                record['load_error'] = load_error(cur)
+                safe_rollback(conn)
+            self.add(record)
+            raise
+        record['rows'] = stats['copy_rows'] if is_copy(query) and stats['copy_rows'] is not None \
+            else (rowcount if rowcount is not None and rowcount >= 0 else None)
+        record['bytes_scanned'] = stats['bytes_scanned']
+        record['query_id'] = stats['query_id']
+        record['rows_per_second'] = record['rows'] / record['seconds'] \
+            if record['rows'] is not None and record['seconds'] > 0 else None
+        record['failed'] = 0
+        self.add(record)
+
+    def summary(self, status):
+        """
+        Args:
+            status (str): 'success' or 'failed'.
+        Returns:
+            dict: The run with its step records, in start order.
+        """
+        with self.lock:
+            records = sorted(self.records, key=lambda record: record['started_at'])
+        return {'run_id': time.strftime('%Y%m%d%H%M%S', time.localtime(self.started_at)),
+                'mode': self.mode,
+                'status': status,
+                'started_at': self.started_at,
+                'seconds': time.time() - self.started_at,
+                'steps': records}
+
+    def write_json(self, path, status):
+        """
+        Appends the run as one JSON line to the run log, so runs can be compared.
+
+        Args:
+            path (str): JSON-lines run log.
+            status (str): 'success' or 'failed'.
+        Returns:
+            None
+        """
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.summary(status), sort_keys=True, default=str) + '\n')
+
+    def write_prometheus(self, path, status):
+        """
+        Writes the run in the Prometheus text format for the node_exporter textfile
+        collector. The file is replaced atomically, as the collector requires.
+
+        Args:
+            path (str): '.prom' file.
+            status (str): 'success' or 'failed'.
+        Returns:
+            None
+        """
+        run = self.summary(status)
+        totals = {}
+        for record in run['steps']:
+            key = (record['step'], record['table'])
+            total = totals.setdefault(key, dict((field, None) for _, field, _ in PROMETHEUS_METRICS))
+            for _, field, _ in PROMETHEUS_METRICS:
+                if record.get(field) is not None:
+                    total[field] = (total[field] or 0) + record[field]
+
+        lines = []
+        for metric, field, help_text in PROMETHEUS_METRICS:
+            lines += ['# HELP {} {}'.format(metric, help_text), '# TYPE {} gauge'.format(metric)]
+            for (step, table), total in sorted(totals.items()):
+                if total[field] is not None:
+                    lines.append('{}{{mode="{}",step="{}",table="{}"}} {}'
+                                 .format(metric, run['mode'], prometheus_label(step), prometheus_label(table), total[field]))
+        lines += ['# HELP etl_run_duration_seconds Wall time of the ETL run.',
+                  '# TYPE etl_run_duration_seconds gauge',
+                  'etl_run_duration_seconds{{mode="{}"}} {}'.format(run['mode'], run['seconds']),
+                  '# HELP etl_run_success 1 if the ETL run succeeded.',
+                  '# TYPE etl_run_success gauge',
+                  'etl_run_success{{mode="{}"}} {}'.format(run['mode'], int(status == 'success')),
+                  '# HELP etl_run_timestamp_seconds Start time of the ETL run.',
+                  '# TYPE etl_run_timestamp_seconds gauge',
+                  'etl_run_timestamp_seconds{{mode="{}"}} {}'.format(run['mode'], run['started_at'])]
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
@@ -0,0 +1,360 @@
+# IMPORTS
+import configparser
+import itertools
+import json
+import os
+import re
+import shutil
+import time
+import duckdb
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from etl import RUN_LOG \
+              , ENRICH_TEMPERATURES \
+              , drop_tables \
+              , create_tables \
+              , load_staging_tables \
+              , insert_tables \
+              , enrich_temperatures \
+              , publish_load_version \
+              , export_serving_files \
+              , unload_tables
+from quality import profile_tables, evaluate
+from sql_queries import staging_profiles, insert_profiles
+from unload import LocalTarget
+
+config = configparser.ConfigParser()
+config.read_file(open('dwh.cfg'))
+LOCAL_DATABASE = config.get("LOCAL", "database", fallback=":memory:")
+LOCAL_DATA = {
+    'i94_immigration_data': config.get("LOCAL", "i94_immigration_data", fallback="sas_data/*.parquet"),
+    'i94_immigration_clean': config.get("LOCAL", "i94_immigration_clean", fallback="sas_clean_data/*.parquet"),
+    'world_temperature_data': config.get("LOCAL", "world_temperature_data", fallback="raw_data/GlobalLandTemperaturesByCity.csv"),
+    'us_city_demographic_data': config.get("LOCAL", "us_city_demographic_data", fallback="raw_data/us-cities-demographics.csv"),
+    'airport_code_data': config.get("LOCAL", "airport_code_data", fallback="raw_data/airport-codes_csv.csv"),
+    'lookup': config.get("LOCAL", "lookup", fallback="lookup_data")
+}
+LOCAL_UNLOAD = config.get("LOCAL", "unload", fallback="unload_data")
+MB = 1024 * 1024
+
+# Redshift functions without a DuckDB equivalent of the same name.
+LOCAL_MACROS = [
+    "CREATE OR REPLACE MACRO getdate() AS current_timestamp::timestamp;",
+    """CREATE OR REPLACE MACRO to_date(s, fmt) AS
+       CAST(CASE fmt WHEN 'YYYYMMDD' THEN try_strptime(s, '%Y%m%d')
+                     WHEN 'MMDDYYYY' THEN try_strptime(s, '%m%d%Y')
+                     WHEN 'YYYY-MM-DD' THEN try_strptime(s, '%Y-%m-%d')
+             END AS date);""",
+    """CREATE OR REPLACE MACRO to_char(d, fmt) AS
+       CASE fmt WHEN 'YYYYMMDD' THEN strftime(d, '%Y%m%d')
+                WHEN 'MMDDYYYY' THEN strftime(d, '%m%d%Y')
+                WHEN 'YYYY-MM-DD' THEN strftime(d, '%Y-%m-%d')
+       END;""",
+    # No query ids or COPY counts locally: instrumentation falls back to cursor row counts.
+    "CREATE OR REPLACE MACRO pg_last_query_id() AS CAST(NULL AS INTEGER);",
+    "CREATE OR REPLACE MACRO pg_last_copy_count() AS CAST(NULL AS BIGINT);"
+]
+
+
+def local_path(url):
+    """
+    Maps an S3 URL used by a COPY query to its local stand-in. A CSV manifest maps
+    to the unsplit source file its parts were cut from.
+
+    Args:
+        url (str): S3 URL, example: 's3://<bucket>/lookup/i94visal.csv'.
+    Returns:
+        str: Local file path or glob.
+    """
+    key = re.sub(r'^s3://[^/]*/', '', url)
+    parts = key.split('/')
+    if parts[0] == 'lookup':
+        return os.path.join(LOCAL_DATA['lookup'], parts[-1])
+    if parts[0] in ('raw', 'manifests') and len(parts) > 1 and parts[1] in LOCAL_DATA:
+        return LOCAL_DATA[parts[1]]
+    raise ValueError('No local stand-in for {}'.format(url))
+
+
+def translate_copy(query, conn):
+    """
+    Translates a Redshift COPY into a DuckDB INSERT reading the local stand-in file.
+    Columns are read positionally with the target table's types, like COPY does.
+
+    Args:
+        query (str): Redshift COPY query.
+        conn (duckdb.DuckDBPyConnection): Connection used to look up the table's columns.
+    Returns:
+        str: DuckDB query, or None if the local file does not exist.
+    """
+    table = re.search(r'COPY\s+(?:public\.)?(\w+)', query, re.IGNORECASE).group(1)
+    url = re.search(r"FROM\s+'([^']*)'", query, re.IGNORECASE).group(1)
+    if re.search(r'\bMANIFEST\b', query, re.IGNORECASE) and re.search(r'FORMAT\s+AS\s+PARQUET', query, re.IGNORECASE):
+        raise ValueError('Manifest COPY is not supported by the local engine: {}'.format(url))
+
+    path = local_path(url)
+    if not any(char in path for char in '*?[') and not os.path.exists(path):
+        print('WARNING: {} not found, {} left empty'.format(path, table))
+        return None
+
+    if re.search(r'FORMAT\s+AS\s+PARQUET', query, re.IGNORECASE):
+        return "INSERT INTO {} BY NAME SELECT * FROM read_parquet('{}');".format(table, path)
+
+    columns = conn.execute("""SELECT column_name, data_type
+                                FROM information_schema.columns
+                               WHERE table_name = ?
+                                 AND table_schema = current_schema()
+                               ORDER BY ordinal_position""", [table]).fetchall()
+    delimiter = re.search(r"DELIMITER\s+'([^']*)'", query, re.IGNORECASE)
+    return ("INSERT INTO {} SELECT * FROM read_csv('{}', header={}, delim='{}', quote='\"', columns={{{}}});"
+            .format(table,
+                    path,
+                    'true' if re.search(r'IGNOREHEADER\s+1', query, re.IGNORECASE) else 'false',
+                    delimiter.group(1) if delimiter else ',',
+                    ', '.join("'{}': '{}'".format(name, data_type) for name, data_type in columns)))
+
+
+def translate(query, conn=None):
+    """
+    Translates Redshift SQL from 'sql_queries.py' to DuckDB SQL.
+
+    Args:
+        query (str): Redshift query.
+        conn (duckdb.DuckDBPyConnection): Connection, needed to translate COPY queries.
+    Returns:
+        str: DuckDB query, or None if there is nothing to run locally.
+    """
+    # Queries bound to a build schema by 'etl.bind_schema'.
+    search_path = re.match(r'\s*(SET\s+search_path\s+TO\s+\w+;)(.*)$', query, re.IGNORECASE | re.DOTALL)
+    if search_path:
+        if conn is not None:
+            conn.execute(search_path.group(1))
+        local_query = translate(search_path.group(2), conn)
+        return search_path.group(1) + local_query if local_query else None
+
+    if re.match(r'\s*COPY\s', query, re.IGNORECASE):
+        return translate_copy(query, conn)
+
+    query = re.sub(r'\bpublic\.', '', query)
+    # Redshift physical design and informational constraints.
+    query = re.sub(r',\s*CONSTRAINT\s+\w+\s+PRIMARY\s+KEY\s*\([^)]*\)', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\bDISTSTYLE\s+\w+', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\bDISTKEY\s*\([^)]*\)', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', '', query, flags=re.IGNORECASE)
+    query = re.sub(r'\bENCODE\s+\w+', '', query, flags=re.IGNORECASE)
+    # Functions.
+    query = re.sub(r"DATEADD\(\s*day\s*,\s*(.+?)\s*,\s*'(\d{4})/(\d{2})/(\d{2})'\s*\)",
+                   r"(DATE '\2-\3-\4' + CAST(\1 AS INTEGER))", query, flags=re.IGNORECASE)
+    query = re.sub(r'\bLEN\(', 'LENGTH(', query)
+    query = re.sub(r'APPROXIMATE\s+COUNT\s*\(\s*DISTINCT\s+', 'approx_count_distinct(', query, flags=re.IGNORECASE)
+    # INSERT INTO t ( SELECT ... ); -> INSERT INTO t SELECT ...;
+    query = re.sub(r'(INSERT\s+INTO\s+\w+\s*)\(\s*(SELECT\b.*)\)\s*;\s*$', r'\1\2;', query,
+                   flags=re.IGNORECASE | re.DOTALL)
+    return query
+
+
+def local_unload(query, conn, batch_rows=100000):
+    """
+    Runs a Redshift UNLOAD into a local directory: the SELECT is streamed from
+    DuckDB into parquet files, hive-partitioned on the PARTITION BY columns and
+    kept under MAXFILESIZE, and a 'manifest' in the MANIFEST VERBOSE format is
+    written next to them. Existing files at the target are removed first, as
+    CLEANPATH does.
+
+    Args:
+        query (str): UNLOAD query built by 'unload.unload_query'.
+        conn (duckdb.DuckDBPyConnection): Connection.
+        batch_rows (int): Rows read from DuckDB at a time.
+    Returns:
+        int: Rows unloaded.
+    """
+    select = re.search(r"UNLOAD\s*\(\s*'((?:[^']|'')*)'\s*\)", query, re.IGNORECASE | re.DOTALL).group(1)
+    path = re.search(r"\bTO\s+'([^']+)'", query, re.IGNORECASE).group(1)
+    partition = re.search(r'PARTITION\s+BY\s*\(([^)]*)\)', query, re.IGNORECASE)
+    partition_by = [column.strip() for column in partition.group(1).split(',')] if partition else []
+    max_file_bytes = int(re.search(r'MAXFILESIZE\s+(\d+)\s*MB', query, re.IGNORECASE).group(1)) * MB
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    result = conn.execute(translate(select.replace("''", "'")))
+    reader = result.to_arrow_reader(batch_rows) if hasattr(result, 'to_arrow_reader') \
+        else result.fetch_record_batch(batch_rows)
+    first = next(iter(reader), None)
+    if first is not None:
+        # Parquet files are smaller than the Arrow batches they are written from,
+        # so sizing files by in-memory bytes per row keeps them under the cap.
+        file_rows = max(1, max_file_bytes // max(1, first.nbytes // max(1, first.num_rows)))
+        ds.write_dataset(pa.RecordBatchReader.from_batches(first.schema, itertools.chain([first], reader)),
+                         path, format='parquet', basename_template='part-{i}.parquet',
+                         partitioning=partition_by or None, partitioning_flavor='hive' if partition_by else None,
+                         max_rows_per_file=file_rows, max_rows_per_group=min(file_rows, 1024 * 1024),
+                         existing_data_behavior='overwrite_or_ignore')
+
+    entries = []
+    schema = None
+    for folder, _, names in sorted(os.walk(path)):
+        for name in sorted(names):
+            if name.endswith('.parquet'):
+                metadata = pq.ParquetFile(os.path.join(folder, name)).metadata
+                schema = schema or metadata.schema.to_arrow_schema()
+                entries.append({'url': os.path.join(folder, name),
+                                'meta': {'content_length': os.path.getsize(os.path.join(folder, name)),
+                                         'record_count': metadata.num_rows}})
+    manifest = {'entries': entries,
+                'schema': {'elements': [{'name': field.name, 'type': {'base': str(field.type)}}
+                                        for field in (schema or [])]},
+                'meta': {'content_length': sum(entry['meta']['content_length'] for entry in entries),
+                         'record_count': sum(entry['meta']['record_count'] for entry in entries)}}
+    with open(os.path.join(path, 'manifest'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest['meta']['record_count']
+
+
+class LocalCursor:
+    """
+    Cursor with the psycopg2 methods 'etl.py' uses; translates each query before running it.
+    """
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, query):
+        if re.match(r'\s*UNLOAD\s*\(', query, re.IGNORECASE):
+            self.rowcount = local_unload(query, self.cursor)
+            self.description = None
+            return
+        local_query = translate(query, self.cursor)
+        if local_query is None:
+            self.rowcount = 0
+            return
+        self.cursor.execute(local_query)
+        self.description = self.cursor.description
+        # DuckDB returns the affected row count as the result of DML statements.
+        if re.match(r'\s*(?:SET\s[^;]*;\s*)?(?:INSERT|DELETE|UPDATE)\b', local_query, re.IGNORECASE):
+            self.rowcount = self.cursor.fetchone()[0]
+            self.description = None
+        else:
+            self.rowcount = -1
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def close(self):
+        self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LocalConnection:
+    """
+    Connection with the psycopg2 methods 'etl.py' uses, backed by an embedded DuckDB database.
+    DuckDB runs in autocommit mode here, so 'commit' and 'rollback' are no-ops.
+    """
+    def __init__(self, database=LOCAL_DATABASE):
+        self.conn = duckdb.connect(database)
+        for macro in LOCAL_MACROS:
+            self.conn.execute(macro)
+
+    def cursor(self):
+        return LocalCursor(self.conn)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+def local_quality_checks(conn, profiles):
+    """
+    Runs the profile checks locally, skipping row-count checks because the
+    local sample data is smaller than the full load.
+
+    Args:
+        conn (LocalConnection): Local connection.
+        profiles (list): Table profile definitions.
+    Returns:
+        dict: Table name mapped to its profile.
+    """
+    local_profiles = [dict(profile, checks=[check for check in profile.get('checks', [])
+                                            if not check['metric'].startswith('row_count')])
+                      for profile in profiles]
+
+    def fetch_one(query):
+        with conn.cursor() as cur:
+            cur.execute(query)
+            row = cur.fetchone()
+            return dict(zip([column[0] for column in cur.description], row))
+
+    results = profile_tables(local_profiles, fetch_one)
+    passed_tests, failed_tests = evaluate(local_profiles, results, {})
+    for table in sorted(results):
+        print('{:<40}{:>12} rows'.format(table, results[table]['row_count']))
+
+    if failed_tests:
+        print("FAILED QUALITY CHECKS:")
+        for failed_test in failed_tests:
+            print(failed_test)
+        raise Exception('Data Check FAILED!')
+    return results
+
+
+def main(database=LOCAL_DATABASE):
+    """
+    Runs the drop/create/copy/insert/check flow from 'etl.py' against an embedded
+    DuckDB database and local files, printing the time taken by each step.
+
+    Args:
+        database (str): DuckDB database file, or ':memory:'.
+    Returns:
+        dict: Step name mapped to elapsed seconds.
+    """
+    RUN_LOG.reset()
+    conn = LocalConnection(database)
+    cur = conn.cursor()
+
+    steps = [('drop_tables', lambda: drop_tables(cur, conn)),
+             ('create_tables', lambda: create_tables(cur, conn)),
+             ('load_staging_tables', lambda: load_staging_tables(cur, conn)),
+             ('staging_quality_checks', lambda: local_quality_checks(conn, staging_profiles)),
+             ('insert_tables', lambda: insert_tables(cur, conn)),
+             ('enrich_temperatures', lambda: enrich_temperatures(cur, conn) if ENRICH_TEMPERATURES else None),
+             ('insert_quality_checks', lambda: local_quality_checks(conn, insert_profiles)),
+             ('publish_load_version', lambda: publish_load_version(cur, conn)),
+             ('export_serving', lambda: export_serving_files(cur, conn)),
+             ('unload_tables', lambda: unload_tables(cur, conn, LocalTarget(LOCAL_UNLOAD)))]
+
+    print('Begin local ETL:')
+    timings = {}
+    for name, step in steps:
+        start = time.time()
+        step()
+        timings[name] = time.time() - start
+        print('\n' + '{}...COMPLETE ({:.2f}s)'.format(name, timings[name]) + '\n')
+
+    conn.close()
+    for record in RUN_LOG.summary('success')['steps']:
+        if record['step'] in ('load_staging_tables', 'insert_tables', 'unload_tables') \
+                and record['rows'] is not None:
+            print('{:<40}{:>12} rows{:>10.2f}s'.format(record['table'], record['rows'], record['seconds']))
+    print('{:<40}{:>10.2f}s'.format('TOTAL', sum(timings.values())))
+    print('\n' + 'End of local ETL' + '\n')
+    return timings
+
+
+if __name__ == "__main__":
+    main()
+#EOF
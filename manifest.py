@@ -0,0 +1,146 @@
+# IMPORTS
+import json
+import os
+
+
+def list_s3_objects(s3_client, bucket, prefix):
+    """
+    Lists the data files under an S3 prefix, skipping markers such as '_SUCCESS'.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        bucket (str): S3 bucket name.
+        prefix (str): Key prefix, example: 'raw/i94_immigration_data/'.
+    Returns:
+        dict: Key mapped to {'size': int, 'version': str}, where version is the ETag.
+    """
+    objects = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            name = obj['Key'].split('/')[-1]
+            if not name or name.startswith(('_', '.')) or obj['Size'] == 0:
+                continue
+            objects[obj['Key']] = {'size': obj['Size'], 'version': obj['ETag'].strip('"')}
+    return objects
+
+
+def load_catalog(path):
+    """
+    Reads the catalog of already-loaded files.
+
+    Args:
+        path (str): JSON catalog file; a missing file is an empty catalog.
+    Returns:
+        dict: Key mapped to {'size': int, 'version': str}.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_catalog(path, catalog):
+    """
+    Writes the catalog of already-loaded files, replacing the previous file atomically.
+
+    Args:
+        path (str): JSON catalog file.
+        catalog (dict): Key mapped to {'size': int, 'version': str}.
+    Returns:
+        None
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(catalog, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def changed_objects(objects, catalog):
+    """
+    Returns the keys that are new or whose size or version differs from the catalog,
+    and the catalog keys that are no longer listed, whose rows must be removed.
+
+    Args:
+        objects (dict): Current listing from 'list_s3_objects'.
+        catalog (dict): Previously loaded files from 'load_catalog'.
+    Returns:
+        list: Sorted keys that changed.
+    """
+    return sorted(set(key for key, obj in objects.items() if catalog.get(key) != obj)
+                  | set(key for key in catalog if key not in objects))
+
+
+def month_folder(key, prefix):
+    """
+    Args:
+        key (str): Key of a part, example: 'raw/i94_immigration_data/i94_jan16_sub/part-00000.parquet'.
+        prefix (str): Prefix of the month folders, example: 'raw/i94_immigration_data/'.
+    Returns:
+        str: Month folder name, example: 'i94_jan16_sub'.
+    """
+    return key[len(prefix):].split('/')[0]
+
+
+def month_keys(keys, prefix):
+    """
+    Args:
+        keys (iterable): Keys under 'prefix'.
+        prefix (str): Prefix of the month folders.
+    Returns:
+        dict: Month folder name mapped to its sorted keys.
+    """
+    months = {}
+    for key in sorted(keys):
+        months.setdefault(month_folder(key, prefix), []).append(key)
+    return months
+
+
+def changed_months(objects, catalog, prefix):
+    """
+    Groups the changes from 'changed_objects' by month folder.
+
+    Args:
+        objects (dict): Current listing from 'list_s3_objects'.
+        catalog (dict): Previously loaded files from 'load_catalog'.
+        prefix (str): Prefix of the month folders.
+    Returns:
+        tuple: (months with a part added, changed or removed that are still listed,
+            months whose every part was removed), each sorted.
+    """
+    listed = set(month_keys(objects, prefix))
+    changed = set(month_folder(key, prefix) for key in changed_objects(objects, catalog))
+    return sorted(changed & listed), sorted(changed - listed)
+
+
+def build_manifest(bucket, keys, objects):
+    """
+    Builds a Redshift COPY manifest. 'content_length' is included because COPY
+    requires it for columnar formats such as parquet.
+
+    Args:
+        bucket (str): S3 bucket name.
+        keys (list): Keys to include.
+        objects (dict): Listing with the size of each key.
+    Returns:
+        dict: Manifest document.
+    """
+    return {'entries': [{'url': 's3://{}/{}'.format(bucket, key),
+                         'mandatory': True,
+                         'meta': {'content_length': objects[key]['size']}}
+                        for key in keys]}
+
+
+def upload_manifest(s3_client, bucket, key, manifest):
+    """
+    Uploads a COPY manifest to S3.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        bucket (str): S3 bucket name.
+        key (str): Manifest key, example: 'manifests/i94_immigration_data/i94_jan16_sub.manifest'.
+        manifest (dict): Manifest document from 'build_manifest'.
+    Returns:
+        None
+    """
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
@@ -0,0 +1,156 @@
+# IMPORTS
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+COLUMN_METRICS = ['null_rate', 'min', 'max', 'distinct']
+
+
+def profile_query(table, columns):
+    """
+    Builds one query that profiles a table in a single scan: row count plus,
+    for each column, non-null count, min, max and approximate distinct count.
+
+    Args:
+        table (str): Table name.
+        columns (list): Columns to profile.
+    Returns:
+        str: Profile query.
+    """
+    select_list = ['COUNT(*) AS row_count']
+    for column in columns:
+        select_list += ['COUNT("{0}") AS "{0}__non_null"'.format(column),
+                        'MIN("{0}") AS "{0}__min"'.format(column),
+                        'MAX("{0}") AS "{0}__max"'.format(column),
+                        'APPROXIMATE COUNT(DISTINCT "{0}") AS "{0}__distinct"'.format(column)]
+    return 'SELECT {} FROM {};'.format('\n     , '.join(select_list), table)
+
+
+def parse_profile(row, columns):
+    """
+    Converts the result row of 'profile_query' to a profile.
+
+    Args:
+        row (dict): Column alias mapped to value.
+        columns (list): Profiled columns.
+    Returns:
+        dict: {'row_count': int, 'columns': {column: {'null_rate', 'min', 'max', 'distinct'}}}.
+    """
+    row_count = row['row_count']
+    profile = {'row_count': row_count, 'columns': {}}
+    for column in columns:
+        non_null = row[column + '__non_null']
+        profile['columns'][column] = {
+            'null_rate': (1 - float(non_null) / row_count) if row_count else 0.0,
+            'min': row[column + '__min'],
+            'max': row[column + '__max'],
+            'distinct': row[column + '__distinct']
+        }
+    return profile
+
+
+def profile_tables(profiles, fetch_one, max_workers=4):
+    """
+    Profiles every table concurrently, one scan per table.
+
+    Args:
+        profiles (list): Table profile definitions, example:
+            {'table': 'i94visal', 'columns': ['id'], 'checks': [...]}
+        fetch_one (function): Executes a query and returns its first row as a dict.
+        max_workers (int): Tables profiled at the same time.
+    Returns:
+        dict: Table name mapped to its profile.
+    """
+    def run_profile(profile):
+        row = fetch_one(profile_query(profile['table'], profile.get('columns', [])))
+        return parse_profile(row, profile.get('columns', []))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_profile, profile): profile['table'] for profile in profiles}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def metric_value(check, profile, previous):
+    """
+    Looks up the value a check applies to.
+
+    Args:
+        check (dict): Check definition with 'metric' and optionally 'column'.
+        profile (dict): Current profile of the table.
+        previous (dict): Profile of the table from the previous run, or None.
+    Returns:
+        The metric value, or None if it cannot be computed (no previous run or no rows).
+    """
+    metric = check['metric']
+    if metric == 'row_count':
+        return profile['row_count']
+    if metric == 'row_count_delta_pct':
+        if not previous or not previous.get('row_count'):
+            return None
+        return (profile['row_count'] - previous['row_count']) * 100.0 / previous['row_count']
+    if metric in COLUMN_METRICS:
+        return profile['columns'][check['column']][metric]
+    raise ValueError('Unknown quality metric: {}'.format(metric))
+
+
+def evaluate(profiles, results, history):
+    """
+    Compares profiled metrics against the tolerance range ('min'/'max') of each check.
+
+    Args:
+        profiles (list): Table profile definitions.
+        results (dict): Output of 'profile_tables'.
+        history (dict): Profiles from the previous run, keyed by table.
+    Returns:
+        tuple: (passed_tests, failed_tests), lists of (table, check, value).
+    """
+    passed_tests = []
+    failed_tests = []
+    for profile in profiles:
+        table = profile['table']
+        for check in profile.get('checks', []):
+            value = metric_value(check, results[table], history.get(table))
+            if value is None:
+                passed_tests.append((table, check, 'not available'))
+                continue
+            if ('min' in check and value < check['min']) or ('max' in check and value > check['max']):
+                failed_tests.append((table, check, value))
+            else:
+                passed_tests.append((table, check, value))
+    return passed_tests, failed_tests
+
+
+def load_history(path):
+    """
+    Reads the profiles recorded by the last successful run.
+
+    Args:
+        path (str): JSON history file; a missing file is an empty history.
+    Returns:
+        dict: Table name mapped to its profile.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_history(path, results):
+    """
+    Records the profiles of this run, merged over the previous history.
+
+    Args:
+        path (str): JSON history file.
+        results (dict): Output of 'profile_tables'.
+    Returns:
+        None
+    """
+    history = load_history(path)
+    history.update(results)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(history, f, indent=2, sort_keys=True, default=str)
+    os.replace(tmp_path, path)
@@ -0,0 +1,334 @@
+# IMPORTS
+import argparse
+import json
+import os
+import re
+from sql_queries import insert_table_queries
+
+# Join distribution labels that move data between slices at run time. DS_DIST_NONE
+# and DS_DIST_ALL_NONE (collocated or DISTSTYLE ALL inner) move nothing.
+DATA_MOVEMENT = ['DS_BCAST_INNER', 'DS_DIST_BOTH', 'DS_DIST_ALL_INNER', 'DS_DIST_INNER', 'DS_DIST_OUTER']
+PLAN_NODE = re.compile(r'^(\s*)(?:->\s+)?(XN\s.+?)\s+\(cost=([\d.]+)\.\.([\d.]+) rows=(\d+) width=(\d+)\)\s*$')
+
+
+def parse_plan(lines):
+    """
+    Parses Redshift EXPLAIN output into a tree. Each node line ('XN ... (cost=...)')
+    becomes a node, nested under the closest less-indented node above it; the
+    lines below a node (join conditions, filters) are kept as its details.
+
+    Args:
+        lines (list): EXPLAIN output, one line per row.
+    Returns:
+        dict: Root node {'operation', 'distribution', 'table', 'startup_cost', 'cost',
+            'rows', 'width', 'details', 'children'}, plus the plan's 'warnings'.
+    """
+    root = None
+    stack = []
+    warnings = []
+    for line in lines:
+        match = PLAN_NODE.match(line)
+        if not match:
+            if line.strip().startswith('-----'):
+                warnings.append(line.strip().strip('-').strip())
+            elif stack and line.strip():
+                stack[-1][1]['details'].append(line.strip())
+            continue
+        indent = len(match.group(1)) + (0 if root is None else 1)
+        text = match.group(2)[3:].strip()
+        distribution = re.search(r'\b(DS_\w+)\b', text)
+        table = re.search(r'\bon\s+"?(\w+)"?', text)
+        node = {'operation': re.sub(r'\s*\bDS_\w+\b', '', re.sub(r'\s+on\s+.*$', '', text)).strip(),
+                'distribution': distribution.group(1) if distribution else None,
+                'table': table.group(1) if table else None,
+                'startup_cost': float(match.group(3)),
+                'cost': float(match.group(4)),
+                'rows': int(match.group(5)),
+                'width': int(match.group(6)),
+                'details': [],
+                'children': []}
+        while stack and stack[-1][0] >= indent:
+            stack.pop()
+        if stack:
+            stack[-1][1]['children'].append(node)
+        elif root is None:
+            root = node
+        stack.append((indent, node))
+    if root is None:
+        raise ValueError('No plan nodes in EXPLAIN output')
+    root['warnings'] = warnings
+    return root
+
+
+def plan_nodes(node):
+    """
+    Args:
+        node (dict): Output of 'parse_plan'.
+    Yields:
+        dict: The node and every node below it, depth first.
+    """
+    yield node
+    for child in node['children']:
+        for descendant in plan_nodes(child):
+            yield descendant
+
+
+def scanned_tables(node):
+    """
+    Returns:
+        list: Tables scanned under 'node', in plan order.
+    """
+    return [descendant['table'] for descendant in plan_nodes(node) if descendant['table']]
+
+
+def summarize_plan(tree):
+    """
+    Flags the steps of a plan that move data between slices or loop over rows.
+
+    Args:
+        tree (dict): Output of 'parse_plan'.
+    Returns:
+        dict: {'cost', 'rows', 'movement' (label mapped to step count), 'nested_loops',
+            'flagged' (one description per flagged step)}.
+    """
+    movement = dict((label, 0) for label in DATA_MOVEMENT)
+    nested_loops = 0
+    flagged = []
+    for node in plan_nodes(tree):
+        # The inner (moved) side of a join is its last child.
+        inner = ', '.join(scanned_tables(node['children'][-1])) if node['children'] else ''
+        moves = node['distribution'] in movement
+        loops = 'Nested Loop' in node['operation']
+        if moves:
+            movement[node['distribution']] += 1
+        if loops:
+            nested_loops += 1
+        if moves or loops:
+            flagged.append('{} {}(inner: {})'.format(node['operation'], node['distribution'] + ' ' if moves else '', inner))
+    return {'cost': tree['cost'], 'rows': tree['rows'], 'movement': movement,
+            'nested_loops': nested_loops, 'flagged': flagged}
+
+
+def plan_name(query):
+    """
+    Args:
+        query (str): INSERT query.
+    Returns:
+        str: Table the query inserts into, used as its name in the baseline.
+    """
+    return re.search(r'INSERT\s+INTO\s+(?:public\.)?(\w+)', query, re.IGNORECASE).group(1)
+
+
+def explainable_statements(query):
+    """
+    Splits a query into its statements and keeps those EXPLAIN accepts. Statements
+    reading a temporary table created earlier in the query are left out, since the
+    table does not exist until the query runs.
+
+    Args:
+        query (str): One or more statements separated by ';'.
+    Returns:
+        list: Statements to explain, in order.
+    """
+    temporary_tables = []
+    explainable = []
+    for statement in [statement.strip() for statement in query.split(';') if statement.strip()]:
+        if any(re.search(r'\b' + table + r'\b', statement) for table in temporary_tables):
+            continue
+        temporary = re.match(r'CREATE\s+TEMP(?:ORARY)?\s+TABLE\s+(\w+)', statement, re.IGNORECASE)
+        if temporary:
+            temporary_tables.append(temporary.group(1))
+        if temporary or re.match(r'(?:SELECT|WITH|INSERT|UPDATE|DELETE)\b', statement, re.IGNORECASE):
+            explainable.append(statement)
+    return explainable
+
+
+def merge_summaries(summaries):
+    """
+    Args:
+        summaries (list): Outputs of 'summarize_plan' for the statements of one query.
+    Returns:
+        dict: Summary of the query: costs, rows and step counts added up.
+    """
+    return {'cost': sum(summary['cost'] for summary in summaries),
+            'rows': sum(summary['rows'] for summary in summaries),
+            'movement': dict((label, sum(summary['movement'][label] for summary in summaries))
+                             for label in DATA_MOVEMENT),
+            'nested_loops': sum(summary['nested_loops'] for summary in summaries),
+            'flagged': [step for summary in summaries for step in summary['flagged']]}
+
+
+def explain_queries(fetch_all, queries=insert_table_queries):
+    """
+    Runs EXPLAIN on each statement of each query and summarizes the plans.
+
+    Args:
+        fetch_all (function): Executes a query and returns all rows.
+        queries (list): Queries to explain.
+    Returns:
+        dict: Query name mapped to the output of 'summarize_plan'.
+    """
+    plans = {}
+    for query in queries:
+        summaries = [summarize_plan(parse_plan([row[0] for row in fetch_all('EXPLAIN ' + statement + ';')]))
+                     for statement in explainable_statements(query)]
+        plans[plan_name(query)] = merge_summaries(summaries)
+    return plans
+
+
+def compare(plans, baseline, tolerance):
+    """
+    Checks each plan against the baseline: the plan cost may not grow by more than
+    'tolerance', and no data-movement or nested-loop step may be added.
+
+    Args:
+        plans (dict): Output of 'explain_queries'.
+        baseline (dict): Plans stored as the baseline.
+        tolerance (float): Allowed cost increase, example: 0.5 for 50%.
+    Returns:
+        tuple: (passed_tests, failed_tests), lists of (query, check, value, baseline value).
+    """
+    passed_tests = []
+    failed_tests = []
+    for name, plan in sorted(plans.items()):
+        if name not in baseline:
+            passed_tests.append((name, 'baseline', 'not available', None))
+            continue
+        expected = baseline[name]
+        costlier = plan['cost'] > expected['cost'] * (1 + tolerance)
+        (failed_tests if costlier else passed_tests).append((name, 'cost', plan['cost'], expected['cost']))
+        for label in DATA_MOVEMENT:
+            value = plan['movement'][label]
+            expected_value = expected['movement'].get(label, 0)
+            (failed_tests if value > expected_value else passed_tests).append((name, label, value, expected_value))
+        (failed_tests if plan['nested_loops'] > expected['nested_loops'] else passed_tests)\
+            .append((name, 'nested_loops', plan['nested_loops'], expected['nested_loops']))
+    return passed_tests, failed_tests
+
+
+def load_baseline(path):
+    """
+    Args:
+        path (str): JSON baseline file; a missing file is an empty baseline.
+    Returns:
+        dict: Query name mapped to its plan summary.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, plans):
+    """
+    Stores plans as the baseline, merged over the previous baseline.
+
+    Args:
+        path (str): JSON baseline file.
+        plans (dict): Query name mapped to its plan summary.
+    Returns:
+        None
+    """
+    baseline = load_baseline(path)
+    baseline.update(plans)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def print_report(plans):
+    """
+    Prints the cost and data-movement steps of each plan.
+
+    Args:
+        plans (dict): Output of 'explain_queries'.
+    Returns:
+        None
+    """
+    print('{:<32}{:>20}{:>10}{:>10}{:>10}'.format('QUERY', 'COST', 'BCAST', 'DIST', 'LOOPS'))
+    for name, plan in sorted(plans.items()):
+        broadcasts = plan['movement']['DS_BCAST_INNER']
+        print('{:<32}{:>20,.2f}{:>10}{:>10}{:>10}'.format(name, plan['cost'], broadcasts,
+                                                          sum(plan['movement'].values()) - broadcasts,
+                                                          plan['nested_loops']))
+        for step in plan['flagged']:
+            print('    ' + step)
+
+
+def check_plans(fetch_all, baseline_path='plan_baseline.json', tolerance=0.5, queries=insert_table_queries):
+    """
+    Explains the queries and fails on a plan that regressed against the baseline.
+    Queries without a baseline plan are added to it.
+
+    Args:
+        fetch_all (function): Executes a query and returns all rows.
+        baseline_path (str): JSON baseline file.
+        tolerance (float): Allowed cost increase.
+        queries (list): Queries to explain.
+    Returns:
+        dict: Output of 'explain_queries'.
+    """
+    plans = explain_queries(fetch_all, queries)
+    print_report(plans)
+    baseline = load_baseline(baseline_path)
+    passed_tests, failed_tests = compare(plans, baseline, tolerance)
+
+    if passed_tests:
+        print("PASSED PLAN CHECKS:")
+        for passed_test in passed_tests:
+            print(passed_test)
+
+    if failed_tests:
+        print("FAILED PLAN CHECKS:")
+        for failed_test in failed_tests:
+            print(failed_test)
+        raise Exception('Query plan check FAILED!')
+
+    new_plans = dict((name, plan) for name, plan in plans.items() if name not in baseline)
+    if new_plans:
+        save_baseline(baseline_path, new_plans)
+    return plans
+
+
+def main():
+    """
+    Explains every query in 'insert_table_queries' on the cluster, prints the
+    data-movement steps and checks the plans against the stored baseline.
+    """
+    import psycopg2
+    from etl import connection_string, bind_schema
+
+    parser = argparse.ArgumentParser(description='Check the insert query plans for data-movement regressions.')
+    parser.add_argument('--baseline', default='plan_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed plan cost increase before the check fails (default 0.5)')
+    parser.add_argument('--schema', default=None, help="schema to explain in instead of 'public'")
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='store these plans as the new baseline')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(connection_string())
+    cur = conn.cursor()
+
+    def fetch_all(query):
+        cur.execute(bind_schema(query, args.schema))
+        rows = cur.fetchall()
+        conn.commit()
+        return rows
+
+    try:
+        if args.update_baseline:
+            plans = explain_queries(fetch_all)
+            print_report(plans)
+            save_baseline(args.baseline, plans)
+            print('\n' + 'Baseline written to ' + args.baseline)
+        else:
+            check_plans(fetch_all, args.baseline, args.tolerance)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
+#EOF
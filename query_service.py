@@ -0,0 +1,281 @@
+# IMPORTS
+import configparser
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from psycopg2.pool import ThreadedConnectionPool
+from aggregates import aggregate_query
+from sql_queries import aggregate_tables
+from sql_queries import load_version_select
+
+# CONFIG
+config = configparser.ConfigParser()
+config.read('dwh.cfg')
+
+POOL_MIN = config.getint('SERVICE', 'pool_min', fallback=1)
+POOL_MAX = config.getint('SERVICE', 'pool_max', fallback=8)
+CACHE_SIZE = config.getint('SERVICE', 'cache_size', fallback=1024)
+CACHE_TTL = config.getfloat('SERVICE', 'cache_ttl_seconds', fallback=900)
+CACHE_MAX_ROWS = config.getint('SERVICE', 'cache_max_rows', fallback=100000)
+MAX_RESULT_ROWS = config.getint('SERVICE', 'max_result_rows', fallback=100000)
+VERSION_CHECK = config.getfloat('SERVICE', 'version_check_seconds', fallback=10)
+PORT = config.getint('SERVICE', 'port', fallback=8080)
+# Schema the tables and load version are served from (see 'etl.serving_schema').
+SERVING_SCHEMA = config.get('ETL', 'serving_schema', fallback='public') \
+    if config.getboolean('ETL', 'blue_green', fallback=False) else 'public'
+
+# Splits a query into quoted literals/identifiers and the SQL between them.
+QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+READ_ONLY = re.compile(r'^(select|with)\b')
+# Columns requests may group or filter on: the dimensions of the aggregate tables.
+AGGREGATE_COLUMNS = set(column for table in aggregate_tables for column in table['dimensions'])
+
+
+def normalize_sql(query):
+    """
+    Normalizes a query for use as a cache key: comments are removed, whitespace
+    collapsed and everything outside quotes lower-cased, so the same query written
+    differently hits the same cache entry.
+
+    Args:
+        query (str): Query.
+    Returns:
+        str: Normalized query.
+    """
+    parts = QUOTED.split(query)
+    for i in range(0, len(parts), 2):
+        sql = re.sub(r'--[^\n]*', ' ', parts[i])
+        sql = re.sub(r'/\*.*?\*/', ' ', sql, flags=re.S)
+        sql = re.sub(r'\s+', ' ', sql).lower()
+        parts[i] = re.sub(r'\s*([(),=<>])\s*', r'\1', sql)
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of query results; entries also expire after 'ttl'
+    seconds, and the whole cache is cleared when a new load is published.
+    """
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class QueryService:
+    """
+    Read-only query API over the warehouse. Results are served from memory until
+    their TTL expires or 'etl.py' publishes a new load version.
+    """
+    def __init__(self, pool=None, cache=None, version_check=VERSION_CHECK, max_rows=CACHE_MAX_ROWS,
+                 max_result_rows=MAX_RESULT_ROWS):
+        if pool is None:
+            # Imported here so the 'etl.py' settings are only read when connecting.
+            from etl import connection_string
+            pool = ThreadedConnectionPool(POOL_MIN, POOL_MAX, connection_string())
+        self.pool = pool
+        self.cache = cache or ResultCache()
+        self.version_check = version_check
+        self.max_rows = max_rows
+        self.max_result_rows = max_result_rows
+        self.version_lock = threading.Lock()
+        self.version = None
+        self.version_checked_at = 0
+
+    def fetch(self, query, params=None, max_rows=None):
+        """
+        Runs a query on a pooled connection.
+
+        Args:
+            query (str): Query.
+            params (list): Query parameters, psycopg2 '%s' style.
+            max_rows (int): Most rows returned; a larger result raises ValueError.
+        Returns:
+            tuple: (columns, rows).
+        """
+        conn = self.pool.getconn()
+        try:
+            cur = conn.cursor()
+            cur.execute(query, params or None)
+            columns = [column[0] for column in cur.description]
+            rows = [tuple(row) for row in (cur.fetchall() if max_rows is None else cur.fetchmany(max_rows + 1))]
+            if max_rows is not None and len(rows) > max_rows:
+                raise ValueError('Result has more than {} rows, add filters'.format(max_rows))
+            conn.rollback()
+            return columns, rows
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def load_version(self):
+        """
+        Returns the published load version, re-reading it at most every
+        'version_check' seconds; the cache is cleared when it has changed.
+
+        Returns:
+            str: Load version, or None before the first published load.
+        """
+        with self.version_lock:
+            if time.time() - self.version_checked_at < self.version_check:
+                return self.version
+            version = self.fetch(load_version_select.format(SERVING_SCHEMA))[1][0][0]
+            if version != self.version:
+                self.cache.clear()
+                self.version = version
+            self.version_checked_at = time.time()
+            return self.version
+
+    def query(self, query, params=None):
+        """
+        Runs a read-only query, from the cache when possible. Results over
+        'max_result_rows' rows raise ValueError.
+
+        Args:
+            query (str): SELECT or WITH query.
+            params (list): Query parameters, psycopg2 '%s' style.
+        Returns:
+            dict: {'columns', 'rows', 'load_version', 'cached'}.
+        """
+        normalized = normalize_sql(query)
+        if not READ_ONLY.match(normalized) or ';' in QUOTED.sub('', normalized):
+            raise ValueError('Only single SELECT queries are served')
+        version = self.load_version()
+        key = (version, normalized, tuple(params or ()))
+        result = self.cache.get(key)
+        if result is not None:
+            return dict(result, cached=True)
+        columns, rows = self.fetch(query, params, self.max_result_rows)
+        result = {'columns': columns, 'rows': rows, 'load_version': version}
+        if len(rows) <= self.max_rows:
+            self.cache.put(key, result)
+        return dict(result, cached=False)
+
+    def aggregate(self, dimensions, measures, filters=None):
+        """
+        Answers a dashboard request from the smallest aggregate table that can
+        (see 'aggregates.aggregate_query'), through the cache. Only the dimensions
+        of the aggregate tables can be grouped or filtered on, and the query is
+        limited to one row past 'max_result_rows', so no request reads an
+        unbounded result.
+
+        Args:
+            dimensions (list): Columns to group by, example: ['i94addr'].
+            measures (list): Measures from 'aggregate_measures', example: ['arrivals'].
+            filters (dict): Column mapped to the value it must equal, example: {'i94yr': 2016}.
+        Returns:
+            dict: Output of 'query', plus the 'table' answering it.
+        """
+        invalid = [column for column in list(dimensions) + list(filters or {}) if column not in AGGREGATE_COLUMNS]
+        if invalid:
+            raise ValueError('Invalid columns: {}'.format(', '.join(invalid)))
+        query, params, table = aggregate_query(dimensions, measures, filters, schema=SERVING_SCHEMA)
+        query = query.rstrip(';') + ' LIMIT {};'.format(self.max_result_rows + 1)
+        return dict(self.query(query, params), table=table)
+
+    def stats(self):
+        return dict(self.cache.stats(), load_version=self.version)
+
+
+def parse_value(value):
+    """
+    Args:
+        value (str): Filter value from a request, example: '2016'.
+    Returns:
+        int or str: Integer if the value is numeric.
+    """
+    return int(value) if re.match(r'^-?\d+$', value) else value
+
+
+def make_handler(service):
+    """
+    Builds the HTTP handler serving:
+        GET /aggregate?dimensions=i94addr,i94mon&measures=arrivals&i94yr=2016
+        GET /stats
+
+    Args:
+        service (QueryService): Service answering the requests.
+    Returns:
+        class: BaseHTTPRequestHandler subclass.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body, default=str).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            args = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+            try:
+                if url.path == '/stats':
+                    return self.send_json(200, service.stats())
+                if url.path != '/aggregate':
+                    return self.send_json(404, {'error': 'Not found'})
+                dimensions = [d for d in args.pop('dimensions', '').split(',') if d]
+                measures = [m for m in args.pop('measures', '').split(',') if m]
+                filters = dict((column, parse_value(value)) for column, value in args.items())
+                self.send_json(200, service.aggregate(dimensions, measures, filters))
+            except ValueError as e:
+                self.send_json(400, {'error': str(e)})
+            except Exception as e:
+                self.send_json(500, {'error': str(e).strip()})
+
+    return Handler
+
+
+def main():
+    """
+    Serves the aggregate API over HTTP on the 'SERVICE' port in 'dwh.cfg'.
+    """
+    service = QueryService()
+    server = ThreadingHTTPServer(('', PORT), make_handler(service))
+    print('Query service listening on port {}'.format(PORT))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.pool.closeall()
+
+
+if __name__ == "__main__":
+    main()
+#EOF
@@ -0,0 +1,187 @@
+# IMPORTS
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+MB = 1024 * 1024
+
+# Adaptive retries back off on throttling and transient network errors.
+RETRY_CONFIG = Config(retries={'max_attempts': 10, 'mode': 'adaptive'},
+                      max_pool_connections=50)
+
+
+def object_etag(s3_client, bucket, key):
+    """
+    Returns the ETag of an S3 object.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        bucket (str): S3 bucket name.
+        key (str): Object key.
+    Returns:
+        str: ETag without quotes, or None if the object does not exist.
+    """
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+
+def read_part(path, part_number, chunk_size):
+    """
+    Reads one multipart chunk of a local file.
+
+    Args:
+        path (str): Local file path.
+        part_number (int): 1-based part number.
+        chunk_size (int): Part size in bytes.
+    Returns:
+        bytes: Part contents.
+    """
+    with open(path, 'rb') as f:
+        f.seek((part_number - 1) * chunk_size)
+        return f.read(chunk_size)
+
+
+def find_multipart_upload(s3_client, bucket, key):
+    """
+    Returns the id of the most recent unfinished multipart upload of 'key', if any.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        bucket (str): S3 bucket name.
+        key (str): Object key.
+    Returns:
+        str: Upload id, or None.
+    """
+    response = s3_client.list_multipart_uploads(Bucket=bucket, Prefix=key)
+    uploads = [upload for upload in response.get('Uploads', []) if upload['Key'] == key]
+    if not uploads:
+        return None
+    return max(uploads, key=lambda upload: upload['Initiated'])['UploadId']
+
+
+def list_uploaded_parts(s3_client, bucket, key, upload_id):
+    """
+    Lists the parts already uploaded for a multipart upload.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        bucket (str): S3 bucket name.
+        key (str): Object key.
+        upload_id (str): Multipart upload id.
+    Returns:
+        dict: Part number mapped to {'ETag': str, 'Size': int}.
+    """
+    parts = {}
+    paginator = s3_client.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts[part['PartNumber']] = {'ETag': part['ETag'], 'Size': part['Size']}
+    return parts
+
+
+def resumable_upload(s3_client, path, bucket, key, chunk_size=64 * MB, max_concurrency=8):
+    """
+    Uploads a file with a multipart upload, resuming an unfinished upload of the
+    same key if one exists. Parts already in S3 are kept when their size and MD5
+    match the local chunk; the rest are uploaded concurrently.
+    Files no larger than one chunk are sent with a single PUT.
+
+    Args:
+        s3_client (boto3.client): S3 client.
+        path (str): Local file path.
+        bucket (str): S3 bucket name.
+        key (str): Object key.
+        chunk_size (int): Part size in bytes (S3 minimum is 5MB).
+        max_concurrency (int): Parts uploaded at the same time.
+    Returns:
+        int: Bytes sent in this call, excluding resumed parts.
+    """
+    size = os.path.getsize(path)
+    if size <= chunk_size:
+        with open(path, 'rb') as f:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=f)
+        return size
+
+    upload_id = find_multipart_upload(s3_client, bucket, key)
+    uploaded = {}
+    if upload_id:
+        uploaded = list_uploaded_parts(s3_client, bucket, key, upload_id)
+    else:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    part_count = (size + chunk_size - 1) // chunk_size
+
+    def upload_part(part_number):
+        body = read_part(path, part_number, chunk_size)
+        existing = uploaded.get(part_number)
+        if existing and existing['Size'] == len(body) \
+                and existing['ETag'].strip('"') == hashlib.md5(body).hexdigest():
+            return part_number, existing['ETag'], 0
+        response = s3_client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         PartNumber=part_number, Body=body)
+        return part_number, response['ETag'], len(body)
+
+    etags = {}
+    sent = 0
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(upload_part, part_number)
+                   for part_number in range(1, part_count + 1)]
+        for future in as_completed(futures):
+            part_number, etag, part_sent = future.result()
+            etags[part_number] = etag
+            sent += part_sent
+
+    s3_client.complete_multipart_upload(
+        Bucket=bucket, Key=key, UploadId=upload_id,
+        MultipartUpload={'Parts': [{'PartNumber': part_number, 'ETag': etags[part_number]}
+                                   for part_number in range(1, part_count + 1)]})
+    return sent
+
+
+def upload_files(s3_client, uploads, bucket, max_workers=4, chunk_size=64 * MB, part_concurrency=8):
+    """
+    Uploads files to S3 concurrently and prints the throughput of each file.
+
+    Args:
+        s3_client (boto3.client): S3 client, ideally created with 'RETRY_CONFIG'.
+        uploads (list): (local path, object key) tuples.
+        bucket (str): S3 bucket name.
+        max_workers (int): Files uploaded at the same time.
+        chunk_size (int): Multipart part size in bytes.
+        part_concurrency (int): Parts of one file uploaded at the same time.
+    Returns:
+        dict: Object key mapped to {'bytes': int, 'seconds': float}.
+    """
+    def upload(path, key):
+        start = time.time()
+        sent = resumable_upload(s3_client, path, bucket, key, chunk_size, part_concurrency)
+        return sent, time.time() - start
+
+    results = {}
+    failed_uploads = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(upload, path, key): key for path, key in uploads}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                sent, seconds = future.result()
+            except Exception as e:
+                failed_uploads.append((key, str(e).strip()))
+                continue
+            results[key] = {'bytes': sent, 'seconds': seconds}
+            print('{:<60}{:>10.1f}MB{:>8.1f}s{:>10.1f}MB/s'
+                  .format(key, sent / MB, seconds, sent / MB / max(seconds, 1e-6)))
+
+    if failed_uploads:
+        print("FAILED UPLOADS:")
+        for failed_upload in failed_uploads:
+            print(failed_upload)
+        raise Exception('Upload to S3 FAILED!')
+    return results
@@ -0,0 +1,184 @@
+# IMPORTS
+import argparse
+import glob
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MB = 1024 * 1024
+# Rows read to measure the in-memory size of a row before the chunk size is chosen.
+SAMPLE_ROWS = 1000
+# Copies of a chunk alive at once: the pandas frame, the Arrow table and the writer's buffers.
+CHUNK_COPIES = 3
+
+
+def arrow_schema(frame, drop_columns=()):
+    """
+    Builds the parquet schema of a SAS file from its first rows: character
+    columns become strings and numeric columns float64, as Spark writes them;
+    columns with a SAS date format become timestamps.
+
+    Args:
+        frame (pandas.DataFrame): First rows of the file.
+        drop_columns (list): Columns left out of the output.
+    Returns:
+        pyarrow.Schema: Output schema.
+    """
+    def column_type(values):
+        if pd.api.types.is_datetime64_any_dtype(values):
+            return pa.timestamp('ms')
+        return pa.float64() if pd.api.types.is_numeric_dtype(values) else pa.string()
+
+    return pa.schema([(name, column_type(frame[name])) for name in frame.columns if name not in drop_columns])
+
+
+def to_arrow(frame, schema):
+    """
+    Args:
+        frame (pandas.DataFrame): Chunk of a SAS file.
+        schema (pyarrow.Schema): Output schema.
+    Returns:
+        pyarrow.Table: Chunk with blank strings as nulls, like the Spark reader.
+    """
+    columns = []
+    for field in schema:
+        values = frame[field.name]
+        if pa.types.is_string(field.type):
+            values = values.where(values.notna() & (values.astype(str).str.strip() != ''), None)
+        columns.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def chunk_rows(sample, memory_bytes):
+    """
+    Args:
+        sample (pandas.DataFrame): First rows of the file.
+        memory_bytes (int): Memory one conversion may use.
+    Returns:
+        int: Rows per chunk that keep the conversion within 'memory_bytes'.
+    """
+    row_bytes = max(1, sample.memory_usage(deep=True, index=False).sum() // max(1, len(sample)))
+    return max(SAMPLE_ROWS, int(memory_bytes // (row_bytes * CHUNK_COPIES)))
+
+
+def read_chunk(reader, rows):
+    """
+    Args:
+        reader: pandas SAS reader.
+        rows (int): Rows to read.
+    Returns:
+        pandas.DataFrame: Next rows, or None at the end of the file.
+    """
+    try:
+        chunk = reader.read(rows)
+    except StopIteration:
+        return None
+    return None if chunk is None or chunk.empty else chunk
+
+
+def convert(sas_path, output_dir, memory_bytes=512 * MB, rows_per_file=5000000, drop_columns=(),
+            encoding='latin-1'):
+    """
+    Streams a SAS file into snappy parquet part files, one chunk at a time, so
+    memory use stays bounded whatever the size of the file; no JVM is needed.
+
+    Args:
+        sas_path (str): '.sas7bdat' (or '.xpt') file.
+        output_dir (str): Directory for the part files; existing parts are replaced.
+        memory_bytes (int): Memory the conversion may use.
+        rows_per_file (int): Rows per part file.
+        drop_columns (list): Columns left out of the output.
+        encoding (str): Encoding of the SAS character columns.
+    Returns:
+        dict: {'path', 'rows', 'files', 'chunk_rows'}.
+    """
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+
+    reader = pd.read_sas(sas_path, chunksize=SAMPLE_ROWS, encoding=encoding)
+    try:
+        chunk = read_chunk(reader, SAMPLE_ROWS)
+        if chunk is None:
+            return {'path': sas_path, 'rows': 0, 'files': 0, 'chunk_rows': 0}
+        schema = arrow_schema(chunk, drop_columns)
+        rows_per_chunk = min(chunk_rows(chunk, memory_bytes), rows_per_file)
+
+        rows = 0
+        files = 0
+        file_rows = 0
+        writer = None
+        while chunk is not None:
+            table = to_arrow(chunk, schema)
+            del chunk
+            if writer is None or file_rows >= rows_per_file:
+                if writer is not None:
+                    writer.close()
+                writer = pq.ParquetWriter(os.path.join(output_dir, 'part-{:05d}.snappy.parquet'.format(files)),
+                                          schema, compression='snappy')
+                files += 1
+                file_rows = 0
+            writer.write_table(table)
+            rows += table.num_rows
+            file_rows += table.num_rows
+            del table
+            chunk = read_chunk(reader, min(rows_per_chunk, rows_per_file - file_rows) or rows_per_chunk)
+        writer.close()
+    finally:
+        reader.close()
+    return {'path': sas_path, 'rows': rows, 'files': files, 'chunk_rows': rows_per_chunk}
+
+
+def convert_all(jobs, processes=4, max_memory_bytes=2048 * MB, rows_per_file=5000000, encoding='latin-1'):
+    """
+    Converts several SAS files in a process pool. The memory cap is shared by
+    the workers, so each conversion streams with a proportionally smaller chunk.
+
+    Args:
+        jobs (list): (SAS path, output directory, columns to drop) tuples.
+        processes (int): Conversions run at the same time.
+        max_memory_bytes (int): Memory all conversions together may use.
+        rows_per_file (int): Rows per part file.
+        encoding (str): Encoding of the SAS character columns.
+    Yields:
+        tuple: (job, result of 'convert'), as conversions complete.
+    """
+    workers = max(1, min(processes, len(jobs)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(convert, sas_path, output_dir, max_memory_bytes // workers,
+                                        rows_per_file, drop_columns, encoding),
+                        (sas_path, output_dir, drop_columns))
+                       for sas_path, output_dir, drop_columns in jobs)
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def main():
+    """
+    Converts SAS files to folders of parquet part files, one folder per file.
+    """
+    parser = argparse.ArgumentParser(description='Convert SAS files to parquet without Spark.')
+    parser.add_argument('sas_files', nargs='+', help="files or globs, example: '/data/18-83510-I94-Data-2016/*.sas7bdat'")
+    parser.add_argument('--output-dir', default='sas_data')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--max-memory-mb', type=int, default=2048,
+                        help='memory all conversions together may use (default 2048)')
+    parser.add_argument('--rows-per-file', type=int, default=5000000)
+    parser.add_argument('--drop-columns', nargs='*', default=[])
+    args = parser.parse_args()
+
+    paths = sorted(set(path for pattern in args.sas_files for path in glob.glob(pattern)))
+    jobs = [(path, os.path.join(args.output_dir, os.path.splitext(os.path.basename(path))[0]), args.drop_columns)
+            for path in paths]
+    for (path, output_dir, _), result in convert_all(jobs, args.processes, args.max_memory_mb * MB,
+                                                     args.rows_per_file):
+        print('{:<40}{:>12} rows{:>6} files  -> {}'.format(os.path.basename(path), result['rows'],
+                                                          result['files'], output_dir))
+
+
+if __name__ == "__main__":
+    main()
+#EOF
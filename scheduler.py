@@ -0,0 +1,114 @@
+# IMPORTS
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def run_dag(steps, run_step, max_workers=4):
+    """
+    Runs steps as soon as every table in their 'inputs' has been produced.
+    Inputs that no step produces are treated as already available (e.g. staging tables).
+
+    Args:
+        steps (list): Step dictionaries with 'name', 'query', 'inputs' and 'outputs', example:
+            {'name': 'airport_codes_table_insert', 'query': '...',
+             'inputs': ['staging_airport_codes'], 'outputs': ['airport_codes']}
+        run_step (function): Called with a step dictionary; executes the step.
+        max_workers (int): Maximum number of steps running at the same time.
+    Returns:
+        dict: Step name mapped to {'start': float, 'end': float, 'duration': float},
+            times in seconds relative to the start of the run.
+    """
+    produced_by = {}
+    for step in steps:
+        for table in step['outputs']:
+            produced_by[table] = step['name']
+
+    available = set(table for step in steps for table in step['inputs']
+                     if table not in produced_by)
+    pending = list(steps)
+    running = {}
+    timings = {}
+    failed_steps = []
+    run_start = time.time()
+
+    def submit_ready(executor):
+        for step in list(pending):
+            if all(table in available for table in step['inputs']):
+                pending.remove(step)
+                start = time.time() - run_start
+                running[executor.submit(run_step, step)] = (step, start)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        submit_ready(executor)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, start = running.pop(future)
+                end = time.time() - run_start
+                try:
+                    future.result()
+                except Exception as e:
+                    failed_steps.append((step['name'], str(e).strip()))
+                    continue
+                timings[step['name']] = {'start': start, 'end': end, 'duration': end - start}
+                available.update(step['outputs'])
+            if not failed_steps:
+                submit_ready(executor)
+
+    if failed_steps:
+        print("FAILED STEPS:")
+        for failed_step in failed_steps:
+            print(failed_step)
+        raise Exception('DAG step FAILED!')
+    if pending:
+        raise Exception('DAG has unresolvable inputs: {}'
+                        .format([step['name'] for step in pending]))
+    return timings
+
+
+def critical_path(steps, timings):
+    """
+    Walks back from the last step to finish, following the upstream step that
+    finished last at each point, to find the chain that set the wall-clock time.
+
+    Args:
+        steps (list): Step dictionaries as passed to 'run_dag'.
+        timings (dict): Result of 'run_dag'.
+    Returns:
+        list: Step names on the critical path, first to last.
+    """
+    if not timings:
+        return []
+    produced_by = {}
+    for step in steps:
+        for table in step['outputs']:
+            produced_by[table] = step['name']
+    inputs = {step['name']: step['inputs'] for step in steps}
+
+    path = [max(timings, key=lambda name: timings[name]['end'])]
+    while True:
+        upstream = [produced_by[table] for table in inputs[path[-1]] if table in produced_by]
+        if not upstream:
+            break
+        path.append(max(upstream, key=lambda name: timings[name]['end']))
+    return list(reversed(path))
+
+
+def print_timing_report(steps, timings):
+    """
+    Prints start, end and duration of each step followed by the critical path.
+
+    Args:
+        steps (list): Step dictionaries as passed to 'run_dag'.
+        timings (dict): Result of 'run_dag'.
+    Returns:
+        None
+    """
+    print('{:<40}{:>10}{:>10}{:>10}'.format('STEP', 'START', 'END', 'SECONDS'))
+    for name, timing in sorted(timings.items(), key=lambda item: item[1]['start']):
+        print('{:<40}{:>10.2f}{:>10.2f}{:>10.2f}'
+              .format(name, timing['start'], timing['end'], timing['duration']))
+
+    path = critical_path(steps, timings)
+    print('CRITICAL PATH ({:.2f}s): {}'.format(
+        sum(timings[name]['duration'] for name in path), ' -> '.join(path)))
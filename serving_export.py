@@ -0,0 +1,117 @@
+# IMPORTS
+import configparser
+import decimal
+import json
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from aggregates import aggregate_query
+from sql_queries import serving_exports
+
+# CONFIG
+config = configparser.ConfigParser()
+config.read('dwh.cfg')
+
+EXPORT_DIR = config.get('EXPORT', 'directory', fallback='serving_export')
+EXPORT_FORMAT = config.get('EXPORT', 'format', fallback='arrow')
+MANIFEST = 'manifest.json'
+
+
+def export_query(export, schema='public'):
+    """
+    Args:
+        export (dict): Entry of 'serving_exports'.
+        schema (str): Schema the serving tables are in.
+    Returns:
+        tuple: (query, column names).
+    """
+    if 'table' in export:
+        return ('SELECT {} FROM {}.{} ORDER BY {};'.format(', '.join(export['columns']), schema, export['table'],
+                                                           export['columns'][0]),
+                export['columns'])
+    query, _, _ = aggregate_query(export['dimensions'], export['measures'], schema=schema)
+    return query, export['dimensions'] + export['measures']
+
+
+def arrow_column(values):
+    """
+    Builds one column of an export. Strings are dictionary-encoded, since every
+    exported string is a low-cardinality code; decimals become float64.
+
+    Args:
+        values (list): Column values.
+    Returns:
+        pyarrow.Array: Column.
+    """
+    if any(isinstance(value, decimal.Decimal) for value in values):
+        values = [float(value) if value is not None else None for value in values]
+    column = pa.array(values)
+    if pa.types.is_string(column.type):
+        column = column.dictionary_encode()
+    return column
+
+
+def write_file(table, path, fmt):
+    """
+    Writes a table atomically, as an uncompressed Arrow IPC file (memory-mappable
+    without copying) or a dictionary-encoded parquet file.
+
+    Args:
+        table (pyarrow.Table): Table to write.
+        path (str): Destination path.
+        fmt (str): 'arrow' or 'parquet'.
+    Returns:
+        None
+    """
+    tmp_path = path + '.tmp'
+    if fmt == 'arrow':
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        pq.write_table(table, tmp_path, use_dictionary=True, compression='zstd')
+    os.replace(tmp_path, path)
+
+
+def export_serving(fetch_all, load_version, directory=EXPORT_DIR, fmt=EXPORT_FORMAT, exports=serving_exports,
+                   schema='public'):
+    """
+    Exports the serving tables and rollups to local files for 'serving_reader.py'.
+    File names carry the load version and the manifest is replaced last, so
+    readers switch to the new load in one step; files of older loads are then
+    removed (processes that mapped them keep their open mapping).
+
+    Args:
+        fetch_all (function): Executes a query and returns all rows.
+        load_version (str): Version of the load being exported.
+        directory (str): Export directory.
+        fmt (str): 'arrow' or 'parquet'.
+        exports (list): Export definitions.
+        schema (str): Schema the serving tables are in.
+    Returns:
+        dict: Manifest written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = {'load_version': load_version, 'format': fmt, 'tables': {}}
+    for export in exports:
+        query, columns = export_query(export, schema)
+        rows = fetch_all(query)
+        values = list(zip(*rows)) if rows else [[] for _ in columns]
+        table = pa.table([arrow_column(list(column)) for column in values], names=columns)
+        table = table.replace_schema_metadata({'load_version': str(load_version)})
+        file_name = '{}_{}.{}'.format(export['name'], load_version, 'arrow' if fmt == 'arrow' else 'parquet')
+        write_file(table, os.path.join(directory, file_name), fmt)
+        manifest['tables'][export['name']] = {'file': file_name, 'rows': table.num_rows, 'columns': columns}
+        print('{:<40}{:>12} rows'.format(export['name'], table.num_rows))
+
+    tmp_path = os.path.join(directory, MANIFEST + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, os.path.join(directory, MANIFEST))
+
+    current = set(table['file'] for table in manifest['tables'].values())
+    for file_name in os.listdir(directory):
+        if file_name.endswith(('.arrow', '.parquet')) and file_name not in current:
+            os.remove(os.path.join(directory, file_name))
+    return manifest
+#EOF
@@ -0,0 +1,121 @@
+# IMPORTS
+import json
+import os
+import threading
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+MANIFEST = 'manifest.json'
+
+
+def open_file(path):
+    """
+    Opens an export file. Arrow IPC files are memory-mapped without copying, so
+    every process reading them shares the page cache; parquet files are decoded.
+
+    Args:
+        path (str): '.arrow' or '.parquet' file.
+    Returns:
+        pyarrow.Table: Table.
+    """
+    if path.endswith('.arrow'):
+        return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return pq.read_table(path, memory_map=True)
+
+
+def equals(column, value):
+    """
+    Args:
+        column (pyarrow.ChunkedArray): Column, possibly dictionary-encoded.
+        value: Value to compare to.
+    Returns:
+        pyarrow.ChunkedArray: Boolean mask.
+    """
+    if pa.types.is_dictionary(column.type):
+        # Compare the small dictionary once and map the result through the indices.
+        chunks = []
+        for chunk in column.chunks:
+            matches = pc.fill_null(pc.equal(chunk.dictionary, pa.scalar(value, chunk.dictionary.type)), False)
+            chunks.append(pc.fill_null(pc.take(matches, chunk.indices), False))
+        return pa.chunked_array(chunks, pa.bool_())
+    return pc.fill_null(pc.equal(column, pa.scalar(value, column.type)), False)
+
+
+class ServingData:
+    """
+    Reads the files written by 'serving_export.py'. Tables are opened on first use
+    and reopened when a new load's manifest appears.
+    """
+    def __init__(self, directory='serving_export'):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.manifest = None
+        self.manifest_mtime = None
+        self.tables = {}
+
+    def refresh(self):
+        """
+        Re-reads the manifest if it changed, dropping the tables of the previous load.
+
+        Returns:
+            dict: Current manifest.
+        """
+        path = os.path.join(self.directory, MANIFEST)
+        mtime = os.stat(path).st_mtime_ns
+        with self.lock:
+            if mtime != self.manifest_mtime:
+                with open(path) as f:
+                    self.manifest = json.load(f)
+                self.manifest_mtime = mtime
+                self.tables = {}
+            return self.manifest
+
+    def load_version(self):
+        return self.refresh()['load_version']
+
+    def table(self, name):
+        """
+        Args:
+            name (str): Export name, example: 'state_month'.
+        Returns:
+            pyarrow.Table: Memory-mapped table.
+        """
+        for attempt in range(2):
+            manifest = self.refresh()
+            if name not in manifest['tables']:
+                raise ValueError('Unknown export: {}'.format(name))
+            with self.lock:
+                if name in self.tables:
+                    return self.tables[name]
+                try:
+                    self.tables[name] = open_file(os.path.join(self.directory, manifest['tables'][name]['file']))
+                    return self.tables[name]
+                except FileNotFoundError:
+                    # A newer export replaced the load between reading the manifest and the file.
+                    if attempt:
+                        raise
+                    self.manifest_mtime = None
+
+    def lookup(self, name, filters=None, columns=None):
+        """
+        Filters an export without a cluster round-trip; only the matching rows are copied.
+
+        Args:
+            name (str): Export name.
+            filters (dict): Column mapped to the value it must equal, example: {'i94addr': 'CA'}.
+            columns (list): Columns to return; all if None.
+        Returns:
+            pyarrow.Table: Matching rows.
+        """
+        table = self.table(name)
+        if columns:
+            table = table.select(columns + [column for column in (filters or {}) if column not in columns])
+        mask = None
+        for column, value in (filters or {}).items():
+            column_mask = equals(table.column(column), value)
+            mask = column_mask if mask is None else pc.and_(mask, column_mask)
+        if mask is not None:
+            table = table.filter(mask)
+        return table.select(columns) if columns else table
+#EOF
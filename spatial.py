@@ -0,0 +1,108 @@
+# IMPORTS
+import math
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def to_xyz(latitude, longitude):
+    """
+    Converts a position to a point on the unit sphere. Straight-line distance
+    between such points grows with great-circle distance, so a k-d tree over them
+    finds true nearest neighbours, including across the antimeridian and poles.
+
+    Args:
+        latitude (float): Degrees north.
+        longitude (float): Degrees east.
+    Returns:
+        tuple: (x, y, z).
+    """
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+
+def chord_to_km(chord):
+    """
+    Args:
+        chord (float): Straight-line distance between two points on the unit sphere.
+    Returns:
+        float: Great-circle distance in km.
+    """
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def build_kdtree(points, indexes=None, depth=0):
+    """
+    Builds a k-d tree by splitting on the median of x, y and z in turn.
+
+    Args:
+        points (list): (x, y, z) tuples.
+        indexes (list): Indexes of 'points' in this subtree; all if None.
+        depth (int): Depth of the subtree, which picks the split axis.
+    Returns:
+        tuple: (index, axis, left subtree, right subtree), or None when empty.
+    """
+    if indexes is None:
+        indexes = list(range(len(points)))
+    if not indexes:
+        return None
+    axis = depth % 3
+    indexes = sorted(indexes, key=lambda i: points[i][axis])
+    median = len(indexes) // 2
+    return (indexes[median], axis,
+            build_kdtree(points, indexes[:median], depth + 1),
+            build_kdtree(points, indexes[median + 1:], depth + 1))
+
+
+def nearest(tree, points, target):
+    """
+    Finds the point nearest to 'target', visiting O(log n) nodes on average.
+
+    Args:
+        tree (tuple): Output of 'build_kdtree'.
+        points (list): Points the tree was built on.
+        target (tuple): (x, y, z).
+    Returns:
+        tuple: (index, chord distance) of the nearest point.
+    """
+    best = [None, float('inf')]
+
+    def search(node):
+        if node is None:
+            return
+        index, axis, left, right = node
+        distance = math.sqrt(sum((a - b) ** 2 for a, b in zip(points[index], target)))
+        if distance < best[1]:
+            best[0], best[1] = index, distance
+        offset = target[axis] - points[index][axis]
+        near, far = (left, right) if offset < 0 else (right, left)
+        search(near)
+        # The far side can only hold a closer point if the splitting plane is closer than the best so far.
+        if abs(offset) < best[1]:
+            search(far)
+
+    search(tree)
+    return best[0], best[1]
+
+
+def nearest_stations(ports, stations):
+    """
+    Maps each port to its nearest weather station.
+
+    Args:
+        ports (list): (port, latitude, longitude) tuples.
+        stations (list): (city, country, latitude, longitude) tuples.
+    Returns:
+        list: (port, port latitude, port longitude, city, country, latitude, longitude, distance km) tuples.
+    """
+    if not stations:
+        return []
+    points = [to_xyz(float(latitude), float(longitude)) for _, _, latitude, longitude in stations]
+    tree = build_kdtree(points)
+    matches = []
+    for port, latitude, longitude in ports:
+        index, chord = nearest(tree, points, to_xyz(float(latitude), float(longitude)))
+        matches.append((port, float(latitude), float(longitude)) + tuple(stations[index][:2])
+                       + (float(stations[index][2]), float(stations[index][3]), round(chord_to_km(chord), 3)))
+    return matches
+#EOF
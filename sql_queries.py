@@ -1,5 +1,8 @@
 # IMPORT
 import configparser
+import json
+import os
+import re
 
 
 # CONFIG
@@ -8,7 +11,24 @@ config.read('dwh.cfg')
 s3_bucket = config.get("S3", "BUCKET")
 s3_raw_data = 's3://' + s3_bucket + '/raw'
 s3_lookup_data = 's3://' + s3_bucket + '/lookup'
+s3_manifest_data = 's3://' + s3_bucket + '/manifests'
 ARN_IAM_ROLE = config.get("IAM_ROLE", "arn")
+# 'redshift' stages the raw i94 parquet and cleans it with 'i94_immigration_table_insert';
+# 'spark' COPYs the typed parquet written by the transform stage of 'stage_to_s3.py'.
+i94_transform = config.get("ETL", "i94_transform", fallback="redshift")
+i94_dataset = 'i94_immigration_clean' if i94_transform == 'spark' else 'i94_immigration_data'
+i94_source_prefix = 'raw/' + i94_dataset + '/'
+i94_manifest_key = 'manifests/' + i94_dataset + '/{}.manifest'
+# 'rebuild' drops and rebuilds us_city_demographics every full load; 'scd2' merges
+# only new or changed cities and keeps their versions in us_city_demographics_history.
+city_demographics_load = config.get("ETL", "city_demographics_load", fallback="rebuild")
+# Large CSVs are staged as compressed parts listed in a manifest by 'stage_to_s3.py'.
+csv_compression = config.get("S3", "csv_compression", fallback="gzip").lower()
+csv_compression_flag = {'gzip': 'GZIP', 'zstd': 'ZSTD'}[csv_compression]
+# Format with the dataset folder and the file name without extension.
+csv_manifest_key = 'manifests/{}/{}.' + csv_compression + '.manifest'
+# Column encodings written by 'compression.py', applied to 'create_table_queries'.
+column_encodings_path = config.get("ETL", "column_encodings", fallback="column_encodings.json")
 
 
 # DROP TABLE QUERIES
@@ -20,6 +40,7 @@ i94_immigration_table_drop = "DROP TABLE IF EXISTS public.i94_immigration;"
 
 staging_us_city_demographics_table_drop = "DROP TABLE IF EXISTS public.staging_us_city_demographics;"
 us_city_demographics_table_drop = "DROP TABLE IF EXISTS public.us_city_demographics;"
+us_city_demographics_history_drop = "DROP TABLE IF EXISTS public.us_city_demographics_history;"
 
 staging_world_temperatures_table_drop = "DROP TABLE IF EXISTS public.staging_world_temperatures;"
 world_temperatures_table_drop = "DROP TABLE IF EXISTS public.world_temperatures;"
@@ -32,6 +53,15 @@ i94visal_table_drop = "DROP TABLE IF EXISTS public.i94visal;"
 
 us_state_visitor_demographics_drop = "DROP TABLE IF EXISTS public.us_state_visitor_demographics;"
 
+agg_state_month_drop = "DROP TABLE IF EXISTS public.agg_state_month;"
+agg_port_month_drop = "DROP TABLE IF EXISTS public.agg_port_month;"
+agg_residence_visatype_drop = "DROP TABLE IF EXISTS public.agg_residence_visatype;"
+
+port_weather_station_drop = "DROP TABLE IF EXISTS public.port_weather_station;"
+port_month_temperature_drop = "DROP TABLE IF EXISTS public.port_month_temperature;"
+
+dim_date_drop = "DROP TABLE IF EXISTS public.dim_date;"
+
 # CREATE TABLE QUERIES
 staging_airport_codes_table_create = ("""
     CREATE TABLE IF NOT EXISTS public.staging_airport_codes (
@@ -110,7 +140,7 @@ staging_i94_immigration_table_create = ("""
 """)
 
 i94_immigration_table_create = ("""
-    CREATE TABLE "i94_immigration" (
+    CREATE TABLE IF NOT EXISTS public.i94_immigration (
         "cicid" int4 NOT NULL,
         "i94yr" int2 NOT NULL,
         "i94mon" int2 NOT NULL,
@@ -190,6 +220,39 @@ us_city_demographics_table_create = ("""
     );
 """)
 
+# Not dropped by 'drop_table_queries' with 'city_demographics_load = scd2'; one row per
+# version of a city, valid from 'effective_from' until 'effective_to' (exclusive).
+us_city_demographics_history_create = ("""
+    CREATE TABLE IF NOT EXISTS public.us_city_demographics_history (
+        state_code char(2) NOT NULL,
+        city varchar(47) NOT NULL,
+        state varchar(20) NOT NULL,
+        median_age float4 NOT NULL,
+        male_population int4,
+        female_population int4,
+        total_population int4 NOT NULL,
+        american_indian_and_alaska_native int4,
+        asian int4,
+        black_or_african_american int4,
+        hispanic_or_latino int4,
+        white int4,
+        number_of_veterans int4,
+        foreign_born int4,
+        average_household_size float4,
+        row_hash char(32) NOT NULL,
+        effective_from timestamp NOT NULL,
+        effective_to timestamp NOT NULL,
+        is_current boolean NOT NULL,
+        CONSTRAINT pk_us_city_demographics_history PRIMARY KEY (
+            state_code,city,effective_from
+        )
+    )
+    DISTKEY (state_code)
+    COMPOUND SORTKEY (
+        state_code,city,effective_from
+    );
+""")
+
 staging_world_temperatures_table_create = ("""
     CREATE TABLE IF NOT EXISTS public.staging_world_temperatures (
         dt date,
@@ -285,7 +348,7 @@ i94visal_table_create = ("""
 """)
 
 us_state_visitor_demographics_create = ("""
-    CREATE TABLE public.us_state_visitor_demographics (
+    CREATE TABLE IF NOT EXISTS public.us_state_visitor_demographics (
         state_code char(2) NOT NULL,
         visit_year int2 NOT NULL,
         visit_median_age float4 NOT NULL,
@@ -308,6 +371,162 @@ us_state_visitor_demographics_create = ("""
     );
 """)
 
+# Not dropped by 'drop_table_queries'; records which i94 partitions are loaded.
+load_watermark_table_create = ("""
+    CREATE TABLE IF NOT EXISTS public.load_watermark (
+        i94yr int2 NOT NULL,
+        i94mon int2 NOT NULL,
+        source_prefix varchar(256) NOT NULL,
+        row_count int8 NOT NULL,
+        loaded_at timestamp NOT NULL,
+        CONSTRAINT pk_load_watermark PRIMARY KEY (
+            i94yr,i94mon
+        )
+    )
+    DISTSTYLE ALL
+    SORTKEY (i94yr,i94mon);
+""")
+
+# Not dropped by 'drop_table_queries'; one row naming the load readers are served from.
+load_version_table_create = ("""
+    CREATE TABLE IF NOT EXISTS public.load_version (
+        version varchar(32) NOT NULL,
+        load_mode varchar(16) NOT NULL,
+        published_at timestamp NOT NULL
+    )
+    DISTSTYLE ALL;
+""")
+
+# Aggregate layer: additive measures only (averages are age_sum / age_count), so
+# each table can be rolled up further and refreshed one month at a time.
+agg_state_month_create = ("""
+    CREATE TABLE IF NOT EXISTS public.agg_state_month (
+        i94yr int2 NOT NULL,
+        i94mon int2 NOT NULL,
+        i94addr char(2) NOT NULL,
+        arrivals int8 NOT NULL,
+        visitors int8 NOT NULL,
+        male int8 NOT NULL,
+        female int8 NOT NULL,
+        age_sum int8,
+        age_count int8 NOT NULL,
+        CONSTRAINT pk_agg_state_month PRIMARY KEY (
+            i94yr,i94mon,i94addr
+        )
+    )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (
+        i94yr,i94mon,i94addr
+    );
+""")
+
+agg_port_month_create = ("""
+    CREATE TABLE IF NOT EXISTS public.agg_port_month (
+        i94yr int2 NOT NULL,
+        i94mon int2 NOT NULL,
+        i94port varchar(3) NOT NULL,
+        arrivals int8 NOT NULL,
+        visitors int8 NOT NULL,
+        male int8 NOT NULL,
+        female int8 NOT NULL,
+        age_sum int8,
+        age_count int8 NOT NULL,
+        CONSTRAINT pk_agg_port_month PRIMARY KEY (
+            i94yr,i94mon,i94port
+        )
+    )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (
+        i94yr,i94mon,i94port
+    );
+""")
+
+agg_residence_visatype_create = ("""
+    CREATE TABLE IF NOT EXISTS public.agg_residence_visatype (
+        i94yr int2 NOT NULL,
+        i94mon int2 NOT NULL,
+        i94res int2 NOT NULL,
+        visatype varchar(3) NOT NULL,
+        arrivals int8 NOT NULL,
+        visitors int8 NOT NULL,
+        male int8 NOT NULL,
+        female int8 NOT NULL,
+        age_sum int8,
+        age_count int8 NOT NULL,
+        CONSTRAINT pk_agg_residence_visatype PRIMARY KEY (
+            i94yr,i94mon,i94res,visatype
+        )
+    )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (
+        i94yr,i94mon,i94res,visatype
+    );
+""")
+
+# One row per day from the SAS epoch (1960-01-01) to 2099-12-31, keyed by SAS day
+# number and by the raw 'dtadfile' (YYYYMMDD) and 'dtaddto' (MMDDYYYY) strings.
+dim_date_create = ("""
+    CREATE TABLE IF NOT EXISTS public.dim_date (
+        sas_day int4 NOT NULL,
+        date date NOT NULL,
+        yyyymmdd char(8) NOT NULL,
+        mmddyyyy char(8) NOT NULL,
+        year int2 NOT NULL,
+        quarter int2 NOT NULL,
+        month int2 NOT NULL,
+        day int2 NOT NULL,
+        day_of_week int2 NOT NULL, --0 = Sunday
+        day_name varchar(9) NOT NULL,
+        week_of_year int2 NOT NULL,
+        is_weekend boolean NOT NULL,
+        is_holiday boolean NOT NULL,
+        holiday_name varchar(26),
+        CONSTRAINT pk_dim_date PRIMARY KEY (
+            sas_day
+        )
+    )
+    DISTSTYLE ALL
+    SORTKEY (sas_day);
+""")
+
+# Temperature enrichment: each i94 port's nearest 'world_temperatures' station,
+# found by 'spatial.py', and that station's monthly climate normal.
+port_weather_station_create = ("""
+    CREATE TABLE IF NOT EXISTS public.port_weather_station (
+        i94port varchar(3) NOT NULL,
+        port_latitude float8 NOT NULL,
+        port_longitude float8 NOT NULL,
+        city varchar(25) NOT NULL,
+        country varchar(34) NOT NULL,
+        latitude float8 NOT NULL,
+        longitude float8 NOT NULL,
+        distance_km float8 NOT NULL,
+        CONSTRAINT pk_port_weather_station PRIMARY KEY (
+            i94port
+        )
+    )
+    DISTSTYLE ALL
+    SORTKEY (i94port);
+""")
+
+port_month_temperature_create = ("""
+    CREATE TABLE IF NOT EXISTS public.port_month_temperature (
+        i94port varchar(3) NOT NULL,
+        month int2 NOT NULL,
+        avg_temp float8,
+        avg_temp_uncert float8,
+        years int2 NOT NULL,
+        distance_km float8 NOT NULL,
+        CONSTRAINT pk_port_month_temperature PRIMARY KEY (
+            i94port,month
+        )
+    )
+    DISTSTYLE ALL
+    COMPOUND SORTKEY (
+        i94port,month
+    );
+""")
+
 
 # STAGING TABLE QUERIES
 staging_airport_codes_copy = ("""
@@ -315,8 +534,11 @@ staging_airport_codes_copy = ("""
     FROM '{}'
     IAM_ROLE {}
     FORMAT AS CSV
-    IGNOREHEADER 1;
-""".format(s3_raw_data + '/airport_code_data/airport-codes_csv.csv', ARN_IAM_ROLE))
+    IGNOREHEADER 1
+    {}
+    MANIFEST;
+""".format('s3://' + s3_bucket + '/' + csv_manifest_key.format('airport_code_data', 'airport-codes_csv'),
+           ARN_IAM_ROLE, csv_compression_flag))
 
 staging_i94_immigration_copy = ("""
     COPY staging_i94_immigration
@@ -330,16 +552,47 @@ staging_us_city_demographics_copy = ("""
     FROM '{}'
     IAM_ROLE {}
     DELIMITER ';'
-    IGNOREHEADER 1;
-""".format(s3_raw_data + '/us_city_demographic_data/us-cities-demographics.csv', ARN_IAM_ROLE))
+    IGNOREHEADER 1
+    {}
+    MANIFEST;
+""".format('s3://' + s3_bucket + '/' + csv_manifest_key.format('us_city_demographic_data', 'us-cities-demographics'),
+           ARN_IAM_ROLE, csv_compression_flag))
 
 staging_world_temperatures_copy = ("""
     COPY staging_world_temperatures
     FROM '{}'
     IAM_ROLE {}
     FORMAT AS CSV
-    IGNOREHEADER 1;
-""".format(s3_raw_data + '/world_temperature_data/GlobalLandTemperaturesByCity.csv', ARN_IAM_ROLE))
+    IGNOREHEADER 1
+    {}
+    MANIFEST;
+""".format('s3://' + s3_bucket + '/' + csv_manifest_key.format('world_temperature_data', 'GlobalLandTemperaturesByCity'),
+           ARN_IAM_ROLE, csv_compression_flag))
+
+# Format with the month folder name, e.g. 'i94_jan16_sub'; see 'i94_manifest_key'.
+staging_i94_immigration_manifest_copy = ("""
+    COPY staging_i94_immigration
+    FROM '{}/i94_immigration_data/{{}}.manifest'
+    IAM_ROLE {}
+    FORMAT AS PARQUET
+    MANIFEST;
+""".format(s3_manifest_data, ARN_IAM_ROLE))
+
+i94_immigration_copy = ("""
+    COPY public.i94_immigration
+    FROM '{}'
+    IAM_ROLE {}
+    FORMAT AS PARQUET;
+""".format(s3_raw_data + '/i94_immigration_clean', ARN_IAM_ROLE))
+
+# Format with the month folder name, e.g. 'i94_jan16_sub'; see 'i94_manifest_key'.
+i94_immigration_manifest_copy = ("""
+    COPY public.i94_immigration
+    FROM '{}/i94_immigration_clean/{{}}.manifest'
+    IAM_ROLE {}
+    FORMAT AS PARQUET
+    MANIFEST;
+""".format(s3_manifest_data, ARN_IAM_ROLE))
 
 i94addrl_copy = ("""
     COPY i94addrl
@@ -420,7 +673,7 @@ i94_immigration_table_insert = ("""
                      THEN 'XXX'
                      ELSE i94port
                 END) AS i94port
-             , DATEADD(day, arrdate::int2, '1960/01/01')::date AS arrdate
+             , COALESCE(ad.date, DATEADD(day, arrdate::int2, '1960/01/01')::date) AS arrdate
              --, i94mode::int2
              , (CASE WHEN m.id IS NULL
                      THEN 9::int2
@@ -431,7 +684,7 @@ i94_immigration_table_insert = ("""
                      THEN '99'
                      ELSE i94addr
                 END) AS i94addr
-             , DATEADD(day, depdate::int4, '1960/01/01')::date AS depdate
+             , COALESCE(dd.date, DATEADD(day, depdate::int4, '1960/01/01')::date) AS depdate
              , i94bir::int2
              --, i94visa::int2
              , (CASE WHEN v.id IS NULL
@@ -439,7 +692,7 @@ i94_immigration_table_insert = ("""
                      ELSE i94visa::int2
                 END) AS i94visa     
              , count::int2
-             , to_date(dtadfile, 'YYYYMMDD') As dtadfile
+             , COALESCE(fd.date, to_date(dtadfile, 'YYYYMMDD')) As dtadfile
              , visapost
              , occup
              , entdepa
@@ -448,7 +701,7 @@ i94_immigration_table_insert = ("""
              , matflag
              , biryear::int2
              --, dtaddto
-             , to_date((CASE
+             , COALESCE(td.date, to_date((CASE
                         WHEN TRIM(dtaddto) ~ '^\\d{8}$' 
                         THEN 
                             (CASE WHEN TRIM(dtaddto) = '00000000' OR TRIM(dtaddto) = '12319999'
@@ -456,7 +709,7 @@ i94_immigration_table_insert = ("""
                                   ELSE dtaddto
                              END)
                         ELSE NULL
-                        END),  'MMDDYYYY') AS dtaddto
+                        END),  'MMDDYYYY')) AS dtaddto
              , gender
              , insnum
              , airline
@@ -476,11 +729,85 @@ i94_immigration_table_insert = ("""
                  ON i.i94addr = a.id
           LEFT JOIN i94visal v
                  ON i.i94visa = v.id
+          -- Dates are looked up in dim_date; only values outside it are computed per row.
+          LEFT JOIN dim_date ad
+                 ON i.arrdate = ad.sas_day
+          LEFT JOIN dim_date dd
+                 ON i.depdate = dd.sas_day
+          LEFT JOIN dim_date fd
+                 ON i.dtadfile = fd.yyyymmdd
+          LEFT JOIN dim_date td
+                 ON TRIM(i.dtaddto) = td.mmddyyyy
     );
 """)
 
-us_city_demographics_table_insert = ("""
-    INSERT INTO public.us_city_demographics (
+# Days 0 to 51134 from five cross-joined digits; US federal holidays by current rules.
+dim_date_digits = '(' + ' UNION ALL '.join('SELECT {} AS n'.format(digit) for digit in range(10)) + ')'
+dim_date_insert = ("""
+    INSERT INTO public.dim_date (
+        SELECT sas_day
+             , date
+             , TO_CHAR(date, 'YYYYMMDD') AS yyyymmdd
+             , TO_CHAR(date, 'MMDDYYYY') AS mmddyyyy
+             , EXTRACT(year FROM date)::int2 AS year
+             , EXTRACT(quarter FROM date)::int2 AS quarter
+             , EXTRACT(month FROM date)::int2 AS month
+             , EXTRACT(day FROM date)::int2 AS day
+             , EXTRACT(dow FROM date)::int2 AS day_of_week
+             , (CASE EXTRACT(dow FROM date)
+                     WHEN 0 THEN 'Sunday' WHEN 1 THEN 'Monday' WHEN 2 THEN 'Tuesday'
+                     WHEN 3 THEN 'Wednesday' WHEN 4 THEN 'Thursday' WHEN 5 THEN 'Friday'
+                     ELSE 'Saturday'
+                END) AS day_name
+             , EXTRACT(week FROM date)::int2 AS week_of_year
+             , EXTRACT(dow FROM date) IN (0, 6) AS is_weekend
+             , holiday_name IS NOT NULL AS is_holiday
+             , holiday_name
+          FROM (SELECT sas_day
+                     , date
+                     , (CASE WHEN EXTRACT(month FROM date) = 1 AND EXTRACT(day FROM date) = 1
+                             THEN 'New Year''s Day'
+                             WHEN EXTRACT(month FROM date) = 1 AND EXTRACT(dow FROM date) = 1
+                                  AND EXTRACT(day FROM date) BETWEEN 15 AND 21
+                             THEN 'Martin Luther King Jr. Day'
+                             WHEN EXTRACT(month FROM date) = 2 AND EXTRACT(dow FROM date) = 1
+                                  AND EXTRACT(day FROM date) BETWEEN 15 AND 21
+                             THEN 'Presidents Day'
+                             WHEN EXTRACT(month FROM date) = 5 AND EXTRACT(dow FROM date) = 1
+                                  AND EXTRACT(day FROM date) >= 25
+                             THEN 'Memorial Day'
+                             WHEN EXTRACT(month FROM date) = 6 AND EXTRACT(day FROM date) = 19
+                                  AND EXTRACT(year FROM date) >= 2021
+                             THEN 'Juneteenth'
+                             WHEN EXTRACT(month FROM date) = 7 AND EXTRACT(day FROM date) = 4
+                             THEN 'Independence Day'
+                             WHEN EXTRACT(month FROM date) = 9 AND EXTRACT(dow FROM date) = 1
+                                  AND EXTRACT(day FROM date) <= 7
+                             THEN 'Labor Day'
+                             WHEN EXTRACT(month FROM date) = 10 AND EXTRACT(dow FROM date) = 1
+                                  AND EXTRACT(day FROM date) BETWEEN 8 AND 14
+                             THEN 'Columbus Day'
+                             WHEN EXTRACT(month FROM date) = 11 AND EXTRACT(day FROM date) = 11
+                             THEN 'Veterans Day'
+                             WHEN EXTRACT(month FROM date) = 11 AND EXTRACT(dow FROM date) = 4
+                                  AND EXTRACT(day FROM date) BETWEEN 22 AND 28
+                             THEN 'Thanksgiving Day'
+                             WHEN EXTRACT(month FROM date) = 12 AND EXTRACT(day FROM date) = 25
+                             THEN 'Christmas Day'
+                        END) AS holiday_name
+                  FROM (SELECT d1.n + d2.n * 10 + d3.n * 100 + d4.n * 1000 + d5.n * 10000 AS sas_day
+                             , DATEADD(day, d1.n + d2.n * 10 + d3.n * 100 + d4.n * 1000 + d5.n * 10000, '1960/01/01')::date AS date
+                          FROM {0} d1
+                         CROSS JOIN {0} d2
+                         CROSS JOIN {0} d3
+                         CROSS JOIN {0} d4
+                         CROSS JOIN {0} d5) n
+                 WHERE sas_day <= 51134) d
+    );
+""".format(dim_date_digits))
+
+# One row per city: the race counts pivoted into columns.
+us_city_demographics_pivot = ("""
         SELECT state_code
              , city
              , state
@@ -522,7 +849,141 @@ us_city_demographics_table_insert = ("""
                 , number_of_veterans
                 , foreign_born
                 , average_household_size
-    );
+""")
+
+us_city_demographics_table_insert = ("""
+    INSERT INTO public.us_city_demographics (
+{}    );
+""").format(us_city_demographics_pivot.lstrip('\n'))
+
+# Type 2 merge of the pivoted cities. A city whose row hash differs from its current
+# version (or that is new or no longer in the source) is replaced in
+# us_city_demographics and versioned in us_city_demographics_history; the version
+# it supersedes is closed. Unchanged cities are not touched.
+us_city_demographics_scd2_merge = ("""
+    CREATE TEMP TABLE us_city_demographics_changes AS
+    SELECT COALESCE(p.state_code, h.state_code) AS state_code
+         , COALESCE(p.city, h.city) AS city
+         , p.state
+         , p.median_age
+         , p.male_population
+         , p.female_population
+         , p.total_population
+         , p.american_indian_and_alaska_native
+         , p.asian
+         , p.black_or_african_american
+         , p.hispanic_or_latino
+         , p.white
+         , p.number_of_veterans
+         , p.foreign_born
+         , p.average_household_size
+         , p.row_hash
+         , p.row_hash IS NULL AS removed
+         , GETDATE() AS changed_at
+      FROM (SELECT d.*
+                 , MD5(COALESCE(state, '') || '|'
+                    || COALESCE(CAST(median_age AS varchar), '') || '|'
+                    || COALESCE(CAST(male_population AS varchar), '') || '|'
+                    || COALESCE(CAST(female_population AS varchar), '') || '|'
+                    || COALESCE(CAST(total_population AS varchar), '') || '|'
+                    || COALESCE(CAST(american_indian_and_alaska_native AS varchar), '') || '|'
+                    || COALESCE(CAST(asian AS varchar), '') || '|'
+                    || COALESCE(CAST(black_or_african_american AS varchar), '') || '|'
+                    || COALESCE(CAST(hispanic_or_latino AS varchar), '') || '|'
+                    || COALESCE(CAST(white AS varchar), '') || '|'
+                    || COALESCE(CAST(number_of_veterans AS varchar), '') || '|'
+                    || COALESCE(CAST(foreign_born AS varchar), '') || '|'
+                    || COALESCE(CAST(average_household_size AS varchar), '')) AS row_hash
+              FROM ({}) d) p
+      FULL JOIN (SELECT state_code
+                      , city
+                      , row_hash
+                   FROM public.us_city_demographics_history
+                  WHERE is_current) h
+             ON p.state_code = h.state_code
+            AND p.city = h.city
+     WHERE p.row_hash IS NULL
+        OR h.row_hash IS NULL
+        OR p.row_hash <> h.row_hash;
+
+    DELETE FROM public.us_city_demographics
+     USING us_city_demographics_changes c
+     WHERE us_city_demographics.state_code = c.state_code
+       AND us_city_demographics.city = c.city;
+
+    INSERT INTO public.us_city_demographics
+    SELECT state_code
+         , city
+         , state
+         , median_age
+         , male_population
+         , female_population
+         , total_population
+         , american_indian_and_alaska_native
+         , asian
+         , black_or_african_american
+         , hispanic_or_latino
+         , white
+         , number_of_veterans
+         , foreign_born
+         , average_household_size
+      FROM us_city_demographics_changes
+     WHERE NOT removed;
+
+    UPDATE public.us_city_demographics_history
+       SET effective_to = c.changed_at
+         , is_current = FALSE
+      FROM us_city_demographics_changes c
+     WHERE us_city_demographics_history.state_code = c.state_code
+       AND us_city_demographics_history.city = c.city
+       AND us_city_demographics_history.is_current;
+
+    INSERT INTO public.us_city_demographics_history
+    SELECT state_code
+         , city
+         , state
+         , median_age
+         , male_population
+         , female_population
+         , total_population
+         , american_indian_and_alaska_native
+         , asian
+         , black_or_african_american
+         , hispanic_or_latino
+         , white
+         , number_of_veterans
+         , foreign_born
+         , average_household_size
+         , row_hash
+         , changed_at
+         , '9999-12-31'
+         , TRUE
+      FROM us_city_demographics_changes
+     WHERE NOT removed;
+
+    DROP TABLE us_city_demographics_changes;
+""").format(us_city_demographics_pivot)
+
+# Format with a timestamp, example: '2016-06-30'; the cities as they were at that time.
+us_city_demographics_as_of = ("""
+    SELECT state_code
+         , city
+         , state
+         , median_age
+         , male_population
+         , female_population
+         , total_population
+         , american_indian_and_alaska_native
+         , asian
+         , black_or_african_american
+         , hispanic_or_latino
+         , white
+         , number_of_veterans
+         , foreign_born
+         , average_household_size
+      FROM public.us_city_demographics_history
+     WHERE effective_from <= '{0}'
+       AND effective_to > '{0}';
 """)
 
 #us_state_demographics_table_insert = ("""
@@ -608,6 +1069,289 @@ us_state_visitor_demographics_insert = ("""
 """)
 
 
+load_watermark_rebuild = ("""
+    DELETE FROM public.load_watermark;
+    INSERT INTO public.load_watermark (
+        SELECT i94yr
+             , i94mon
+             , '{}'
+             , COUNT(*)
+             , GETDATE()
+          FROM public.i94_immigration
+         GROUP BY i94yr, i94mon
+    );
+""".format(s3_raw_data + '/' + i94_dataset))
+
+# Format with '' to aggregate every partition, or with 'i94_month_filter' to aggregate one month.
+agg_state_month_insert = ("""
+    INSERT INTO public.agg_state_month (
+        SELECT i94yr
+             , i94mon
+             , i94addr
+             , COUNT(*)
+             , SUM(count)
+             , SUM(CASE WHEN gender = 'M'
+                        THEN 1
+                        ELSE 0
+                    END)
+             , SUM(CASE WHEN gender = 'F'
+                        THEN 1
+                        ELSE 0
+                    END)
+             , SUM(i94bir)
+             , COUNT(i94bir)
+          FROM public.i94_immigration{}
+         GROUP BY i94yr, i94mon, i94addr
+    );
+""")
+
+agg_port_month_insert = ("""
+    INSERT INTO public.agg_port_month (
+        SELECT i94yr
+             , i94mon
+             , i94port
+             , COUNT(*)
+             , SUM(count)
+             , SUM(CASE WHEN gender = 'M'
+                        THEN 1
+                        ELSE 0
+                    END)
+             , SUM(CASE WHEN gender = 'F'
+                        THEN 1
+                        ELSE 0
+                    END)
+             , SUM(i94bir)
+             , COUNT(i94bir)
+          FROM public.i94_immigration{}
+         GROUP BY i94yr, i94mon, i94port
+    );
+""")
+
+agg_residence_visatype_insert = ("""
+    INSERT INTO public.agg_residence_visatype (
+        SELECT i94yr
+             , i94mon
+             , i94res
+             , visatype
+             , COUNT(*)
+             , SUM(count)
+             , SUM(CASE WHEN gender = 'M'
+                        THEN 1
+                        ELSE 0
+                    END)
+             , SUM(CASE WHEN gender = 'F'
+                        THEN 1
+                        ELSE 0
+                    END)
+             , SUM(i94bir)
+             , COUNT(i94bir)
+          FROM public.i94_immigration{}
+         GROUP BY i94yr, i94mon, i94res, visatype
+    );
+""")
+
+i94_month_filter = """
+         WHERE i94yr = {} AND i94mon = {}"""
+
+
+# INCREMENTAL LOAD QUERIES
+load_watermark_select = "SELECT i94yr, i94mon FROM public.load_watermark;"
+
+staging_i94_immigration_clear = "DELETE FROM public.staging_i94_immigration;"
+
+i94_immigration_partition_delete = ("""
+    DELETE FROM public.i94_immigration
+     USING (SELECT DISTINCT i94yr::int2 AS i94yr
+                 , i94mon::int2 AS i94mon
+              FROM public.staging_i94_immigration) s
+     WHERE i94_immigration.i94yr = s.i94yr
+       AND i94_immigration.i94mon = s.i94mon;
+""")
+
+load_watermark_partition_delete = ("""
+    DELETE FROM public.load_watermark
+     USING (SELECT DISTINCT i94yr::int2 AS i94yr
+                 , i94mon::int2 AS i94mon
+              FROM public.staging_i94_immigration) s
+     WHERE load_watermark.i94yr = s.i94yr
+       AND load_watermark.i94mon = s.i94mon;
+""")
+
+# Format with the month folder name, e.g. 'i94_jan16_sub'.
+load_watermark_month_insert = ("""
+    INSERT INTO public.load_watermark (
+        SELECT i94yr::int2
+             , i94mon::int2
+             , '{}/{{}}'
+             , COUNT(*)
+             , GETDATE()
+          FROM public.staging_i94_immigration
+         GROUP BY i94yr::int2, i94mon::int2
+    );
+""".format(s3_raw_data + '/i94_immigration_data'))
+
+# Format with i94yr and i94mon.
+i94_immigration_month_delete = "DELETE FROM public.i94_immigration WHERE i94yr = {} AND i94mon = {};"
+
+load_watermark_month_delete = "DELETE FROM public.load_watermark WHERE i94yr = {} AND i94mon = {};"
+
+# Format with the month folder name, i94yr and i94mon.
+load_watermark_clean_month_insert = ("""
+    INSERT INTO public.load_watermark (
+        SELECT i94yr
+             , i94mon
+             , '{}/{{0}}'
+             , COUNT(*)
+             , GETDATE()
+          FROM public.i94_immigration
+         WHERE i94yr = {{1}}
+           AND i94mon = {{2}}
+         GROUP BY i94yr, i94mon
+    );
+""".format(s3_raw_data + '/i94_immigration_clean'))
+
+us_state_visitor_demographics_clear = "DELETE FROM public.us_state_visitor_demographics;"
+
+# Format with i94yr and i94mon.
+agg_state_month_month_delete = "DELETE FROM public.agg_state_month WHERE i94yr = {} AND i94mon = {};"
+agg_port_month_month_delete = "DELETE FROM public.agg_port_month WHERE i94yr = {} AND i94mon = {};"
+agg_residence_visatype_month_delete = "DELETE FROM public.agg_residence_visatype WHERE i94yr = {} AND i94mon = {};"
+
+
+# TEMPERATURE ENRICHMENT QUERIES
+# Climate normals cover the last 30 years of the temperature data (1984-2013).
+temperature_normal_start = '1984-01-01'
+
+# Stations with readings in the normal period.
+weather_stations_select = ("""
+    SELECT DISTINCT city
+         , country
+         , latitude
+         , longitude
+      FROM public.world_temperatures
+     WHERE dt >= '{}'
+       AND avg_temp IS NOT NULL;
+""".format(temperature_normal_start))
+
+# Location of each US port: the airport with the port's code, else the largest
+# airport of the port's city. The join on state avoids a nested loop over the OR.
+port_locations_select = ("""
+    SELECT i94port
+         , latitude
+         , longitude
+      FROM (SELECT p.id AS i94port
+                 , a.latitude
+                 , a.longitude
+                 , ROW_NUMBER() OVER (PARTITION BY p.id
+                                      ORDER BY (CASE WHEN a.iata_code = p.id THEN 0 ELSE 1 END)
+                                             , (CASE a.type WHEN 'large_airport' THEN 0
+                                                            WHEN 'medium_airport' THEN 1
+                                                            WHEN 'small_airport' THEN 2
+                                                            ELSE 3 END)
+                                             , a.ident) AS location_rank
+              FROM public.i94prtl p
+              JOIN public.airport_codes a
+                ON a.iso_country = 'US'
+               AND a.state_code = p.us_state_code
+             WHERE a.iata_code = p.id
+                OR UPPER(a.municipality) = UPPER(p.us_city)) l
+     WHERE location_rank = 1;
+""")
+
+port_weather_station_clear = "DELETE FROM public.port_weather_station;"
+
+# Format with comma-separated value tuples.
+port_weather_station_insert = """
+    INSERT INTO public.port_weather_station VALUES {};
+"""
+
+port_month_temperature_insert = ("""
+    INSERT INTO public.port_month_temperature (
+        SELECT s.i94port
+             , EXTRACT(month FROM t.dt)::int2 AS month
+             , AVG(t.avg_temp) AS avg_temp
+             , AVG(t.avg_temp_uncert) AS avg_temp_uncert
+             , COUNT(t.avg_temp)::int2 AS years
+             , MAX(s.distance_km) AS distance_km
+          FROM public.port_weather_station s
+          JOIN public.world_temperatures t
+            ON t.city = s.city
+           AND t.country = s.country
+           AND t.latitude = s.latitude
+           AND t.longitude = s.longitude
+         WHERE t.dt >= '{}'
+         GROUP BY s.i94port, EXTRACT(month FROM t.dt)
+    );
+""".format(temperature_normal_start))
+
+port_month_temperature_clear = "DELETE FROM public.port_month_temperature;"
+
+
+# LOAD VERSION QUERIES
+# Format with the serving schema, version and load mode; run after each successful load so
+# cached reads are invalidated.
+load_version_publish = ("""
+    DELETE FROM {0}.load_version;
+    INSERT INTO {0}.load_version VALUES ('{1}', '{2}', GETDATE());
+""")
+
+# Format with the serving schema.
+load_version_select = "SELECT MAX(version) FROM {}.load_version;"
+
+
+# UNLOAD QUERIES
+# Tables unloaded to parquet after each load for the Spark serving tier; readers
+# prune on the 'partition_by' columns (hive-style 'column=value' folders).
+unload_exports = [
+    {'table': 'i94_immigration', 'partition_by': ['i94yr', 'i94mon', 'i94addr']},
+    {'table': 'us_state_visitor_demographics', 'partition_by': []},
+    {'table': 'world_temperatures', 'partition_by': []}
+]
+
+# Format with the SELECT (single quotes doubled), the target prefix, the PARTITION BY
+# clause ('' for none) and the file size cap in MB. Every slice writes its own files;
+# CLEANPATH clears files left at the prefix by a failed attempt.
+unload_parquet = ("""
+    UNLOAD ('{{}}')
+    TO '{{}}'
+    IAM_ROLE {}
+    FORMAT AS PARQUET
+    {{}}MAXFILESIZE {{}} MB
+    MANIFEST VERBOSE
+    CLEANPATH
+    PARALLEL ON;
+""".format(ARN_IAM_ROLE))
+
+
+# BLUE/GREEN SCHEMA QUERIES
+# Format with the schema name(s); full loads are built in a new schema and swapped in.
+schema_create = "CREATE SCHEMA IF NOT EXISTS {};"
+
+schema_drop = "DROP SCHEMA IF EXISTS {} CASCADE;"
+
+schema_rename = "ALTER SCHEMA {} RENAME TO {};"
+
+schema_exists = "SELECT COUNT(*) FROM pg_namespace WHERE nspname = '{}';"
+
+# Format with the schema and the reader group. Grants follow a schema when it is renamed.
+schema_grant_usage = "GRANT USAGE ON SCHEMA {} TO GROUP {};"
+
+schema_grant_select = "GRANT SELECT ON ALL TABLES IN SCHEMA {} TO GROUP {};"
+
+# Format with the schema; the default privileges every user has on 'public'.
+schema_grant_public = "GRANT USAGE, CREATE ON SCHEMA {} TO PUBLIC;"
+
+# Undoes the 'SET search_path' of 'bind_schema' once the build schema is renamed.
+search_path_reset = "RESET search_path;"
+
+# Format with the schema and table name.
+table_exists = "SELECT COUNT(*) FROM pg_tables WHERE schemaname = '{}' AND tablename = '{}';"
+
+# Format with the table and the serving schema; the quotes keep 'bind_schema' from
+# rewriting the source schema when it is 'public'.
+table_carry_over = 'INSERT INTO public.{0} (SELECT * FROM "{1}".{0});'
+
+
 # QUERY LISTS
 drop_table_queries = [staging_airport_codes_table_drop
                      ,airport_codes_table_drop
@@ -622,7 +1366,13 @@ drop_table_queries = [staging_airport_codes_table_drop
                      ,i94model_table_drop
                      ,i94prtl_table_drop
                      ,i94visal_table_drop
-                     ,us_state_visitor_demographics_drop]
+                     ,us_state_visitor_demographics_drop
+                     ,agg_state_month_drop
+                     ,agg_port_month_drop
+                     ,agg_residence_visatype_drop
+                     ,port_weather_station_drop
+                     ,port_month_temperature_drop
+                     ,dim_date_drop]
 
 create_table_queries = [staging_airport_codes_table_create
                        ,airport_codes_table_create
@@ -637,7 +1387,15 @@ create_table_queries = [staging_airport_codes_table_create
                        ,i94model_table_create
                        ,i94prtl_table_create
                        ,i94visal_table_create
-                       ,us_state_visitor_demographics_create]
+                       ,us_state_visitor_demographics_create
+                       ,load_watermark_table_create
+                       ,load_version_table_create
+                       ,agg_state_month_create
+                       ,agg_port_month_create
+                       ,agg_residence_visatype_create
+                       ,port_weather_station_create
+                       ,port_month_temperature_create
+                       ,dim_date_create]
 
 copy_table_queries = [staging_airport_codes_copy
                      ,staging_i94_immigration_copy
@@ -649,11 +1407,94 @@ copy_table_queries = [staging_airport_codes_copy
                      ,i94prtl_copy
                      ,i94visal_copy]
 
-insert_table_queries = [airport_codes_table_insert
-                       ,i94_immigration_table_insert
-                       ,us_city_demographics_table_insert
-                       ,world_temperatures_table_insert
-                       ,us_state_visitor_demographics_insert]
+# Each insert declares the tables it reads ('inputs') and writes ('outputs') so
+# the DAG scheduler in 'etl.py' can run independent inserts at the same time.
+insert_table_steps = [
+    {'name': 'airport_codes_table_insert',
+     'query': airport_codes_table_insert,
+     'inputs': ['staging_airport_codes'],
+     'outputs': ['airport_codes']},
+    {'name': 'dim_date_insert',
+     'query': dim_date_insert,
+     'inputs': [],
+     'outputs': ['dim_date']},
+    {'name': 'i94_immigration_table_insert',
+     'query': i94_immigration_table_insert,
+     'inputs': ['staging_i94_immigration', 'i94cntyl', 'i94prtl', 'i94model', 'i94addrl', 'i94visal', 'dim_date'],
+     'outputs': ['i94_immigration']},
+    {'name': 'us_city_demographics_table_insert',
+     'query': us_city_demographics_table_insert,
+     'inputs': ['staging_us_city_demographics'],
+     'outputs': ['us_city_demographics']},
+    {'name': 'world_temperatures_table_insert',
+     'query': world_temperatures_table_insert,
+     'inputs': ['staging_world_temperatures'],
+     'outputs': ['world_temperatures']},
+    {'name': 'us_state_visitor_demographics_insert',
+     'query': us_state_visitor_demographics_insert,
+     'inputs': ['i94_immigration', 'us_city_demographics'],
+     'outputs': ['us_state_visitor_demographics']},
+    {'name': 'load_watermark_rebuild',
+     'query': load_watermark_rebuild,
+     'inputs': ['i94_immigration'],
+     'outputs': ['load_watermark']},
+    {'name': 'agg_state_month_insert',
+     'query': agg_state_month_insert.format(''),
+     'inputs': ['i94_immigration'],
+     'outputs': ['agg_state_month']},
+    {'name': 'agg_port_month_insert',
+     'query': agg_port_month_insert.format(''),
+     'inputs': ['i94_immigration'],
+     'outputs': ['agg_port_month']},
+    {'name': 'agg_residence_visatype_insert',
+     'query': agg_residence_visatype_insert.format(''),
+     'inputs': ['i94_immigration'],
+     'outputs': ['agg_residence_visatype']}
+]
+
+insert_table_queries = [step['query'] for step in insert_table_steps]
+
+# Tables a blue/green build copies from the serving schema before loading, because
+# the load updates them instead of rebuilding them.
+carry_over_tables = []
+
+# Registry of the aggregate tables, for 'aggregates.py': the i94_immigration
+# columns each one is grouped by and its approximate size (rows per month).
+aggregate_tables = [
+    {'table': 'agg_state_month',
+     'dimensions': ['i94yr', 'i94mon', 'i94addr'],
+     'rows_per_month': 55},
+    {'table': 'agg_port_month',
+     'dimensions': ['i94yr', 'i94mon', 'i94port'],
+     'rows_per_month': 300},
+    {'table': 'agg_residence_visatype',
+     'dimensions': ['i94yr', 'i94mon', 'i94res', 'visatype'],
+     'rows_per_month': 2000}
+]
+
+# Measure name mapped to its expression over an aggregate table and over i94_immigration.
+aggregate_measures = {
+    'arrivals': ('SUM(arrivals)', 'COUNT(*)'),
+    'visitors': ('SUM(visitors)', 'SUM(count)'),
+    'male': ('SUM(male)', "SUM(CASE WHEN gender = 'M' THEN 1 ELSE 0 END)"),
+    'female': ('SUM(female)', "SUM(CASE WHEN gender = 'F' THEN 1 ELSE 0 END)"),
+    'average_age': ('SUM(age_sum)::float8 / NULLIF(SUM(age_count), 0)', 'AVG(i94bir::float8)')
+}
+
+# Serving exports written after each load for dashboards: a table with its
+# columns, or a rollup answered through the aggregate registry.
+serving_exports = [
+    {'name': 'us_state_visitor_demographics',
+     'table': 'us_state_visitor_demographics',
+     'columns': ['state_code', 'visit_year', 'visit_median_age', 'visit_male', 'visit_female', 'visit_total',
+                 'census_median_age', 'census_male', 'census_female', 'census_total']},
+    {'name': 'state_month',
+     'dimensions': ['i94yr', 'i94mon', 'i94addr'],
+     'measures': ['arrivals', 'visitors', 'male', 'female', 'average_age']},
+    {'name': 'country_month',
+     'dimensions': ['i94yr', 'i94mon', 'i94res'],
+     'measures': ['arrivals', 'visitors', 'male', 'female', 'average_age']}
+]
 
 staging_checks = [
     {'check_sql': 'SELECT COUNT(*) FROM staging_airport_codes', 'expected_result': 55075},
@@ -672,5 +1513,233 @@ insert_checks = [
     {'check_sql': 'SELECT COUNT(*) FROM i94_immigration', 'expected_result': 40790529},
     {'check_sql': 'SELECT COUNT(*) FROM us_city_demographics WHERE state_code IS NULL', 'expected_result': 0},
     {'check_sql': 'SELECT COUNT(*) FROM world_temperatures', 'expected_result': 8599212},
-    {'check_sql': 'SELECT COUNT(*) FROM us_state_visitor_demographics WHERE state_code IS NULL', 'expected_result': 0}
-]
\ No newline at end of file
+    {'check_sql': 'SELECT COUNT(*) FROM dim_date', 'expected_result': 51135},
+    {'check_sql': 'SELECT COUNT(*) FROM us_state_visitor_demographics WHERE state_code IS NULL', 'expected_result': 0},
+    {'check_sql': """SELECT COUNT(*)
+                       FROM (SELECT i94yr, i94mon, SUM(arrivals) AS arrivals
+                               FROM agg_state_month
+                              GROUP BY i94yr, i94mon) a
+                       FULL JOIN (SELECT i94yr, i94mon, COUNT(*) AS arrivals
+                                    FROM i94_immigration
+                                   GROUP BY i94yr, i94mon) i
+                              ON a.i94yr = i.i94yr
+                             AND a.i94mon = i.i94mon
+                      WHERE COALESCE(a.arrivals, -1) <> COALESCE(i.arrivals, -1)""", 'expected_result': 0}
+]
+
+def incremental_i94_month_queries(month, partition):
+    """
+    Returns the queries that replace one month's partition in 'i94_immigration'
+    and refresh that month in the aggregate tables.
+
+    Args:
+        month (str): Month folder name, example: 'i94_jan16_sub'.
+        partition (tuple): (i94yr, i94mon) of the month, example: (2016, 1).
+    Returns:
+        list: Queries to execute in order, in one transaction.
+    """
+    aggregate_refresh = [agg_state_month_month_delete.format(*partition)
+                        ,agg_state_month_insert.format(i94_month_filter.format(*partition))
+                        ,agg_port_month_month_delete.format(*partition)
+                        ,agg_port_month_insert.format(i94_month_filter.format(*partition))
+                        ,agg_residence_visatype_month_delete.format(*partition)
+                        ,agg_residence_visatype_insert.format(i94_month_filter.format(*partition))]
+    if i94_transform == 'spark':
+        return [i94_immigration_month_delete.format(*partition)
+               ,i94_immigration_manifest_copy.format(month)
+               ,load_watermark_month_delete.format(*partition)
+               ,load_watermark_clean_month_insert.format(month, *partition)] + aggregate_refresh
+    return [staging_i94_immigration_clear
+           ,staging_i94_immigration_manifest_copy.format(month)
+           ,i94_immigration_partition_delete
+           ,i94_immigration_table_insert
+           ,load_watermark_partition_delete
+           ,load_watermark_month_insert.format(month)] + aggregate_refresh
+
+def incremental_i94_month_removal_queries(partition):
+    """
+    Returns the queries that remove a month whose folder was deleted from S3 from
+    'i94_immigration', 'load_watermark' and the aggregate tables.
+
+    Args:
+        partition (tuple): (i94yr, i94mon) of the month, example: (2016, 1).
+    Returns:
+        list: Queries to execute in order, in one transaction.
+    """
+    return [i94_immigration_month_delete.format(*partition)
+           ,load_watermark_month_delete.format(*partition)
+           ,agg_state_month_month_delete.format(*partition)
+           ,agg_port_month_month_delete.format(*partition)
+           ,agg_residence_visatype_month_delete.format(*partition)]
+
+incremental_refresh_queries = [us_state_visitor_demographics_clear
+                              ,us_state_visitor_demographics_insert]
+
+incremental_checks = [
+    {'check_sql': """SELECT COUNT(*)
+                       FROM load_watermark w
+                       LEFT JOIN (SELECT i94yr, i94mon, COUNT(*) AS row_count
+                                    FROM i94_immigration
+                                   GROUP BY i94yr, i94mon) i
+                              ON w.i94yr = i.i94yr
+                             AND w.i94mon = i.i94mon
+                      WHERE i.row_count IS NULL
+                         OR i.row_count <> w.row_count""", 'expected_result': 0},
+    {'check_sql': 'SELECT COUNT(*) FROM us_state_visitor_demographics WHERE state_code IS NULL', 'expected_result': 0},
+    {'check_sql': """SELECT COUNT(*)
+                       FROM (SELECT i94yr, i94mon, SUM(arrivals) AS arrivals
+                               FROM agg_state_month
+                              GROUP BY i94yr, i94mon) a
+                       FULL JOIN (SELECT i94yr, i94mon, COUNT(*) AS arrivals
+                                    FROM i94_immigration
+                                   GROUP BY i94yr, i94mon) i
+                              ON a.i94yr = i.i94yr
+                             AND a.i94mon = i.i94mon
+                      WHERE COALESCE(a.arrivals, -1) <> COALESCE(i.arrivals, -1)""", 'expected_result': 0}
+]
+
+# Profile-based quality checks: one scan per table computes the row count and,
+# for each listed column, null rate, min, max and approximate distinct count.
+# Checks give a tolerance range ('min'/'max'); 'row_count_delta_pct' compares
+# the row count with the previous successful run.
+staging_profiles = [
+    {'table': 'staging_airport_codes',
+     'columns': ['ident', 'iso_region', 'coordinates'],
+     'checks': [{'metric': 'row_count', 'min': 55075},
+                {'metric': 'null_rate', 'column': 'ident', 'max': 0},
+                {'metric': 'null_rate', 'column': 'coordinates', 'max': 0}]},
+    {'table': 'staging_i94_immigration',
+     'columns': ['cicid', 'i94yr', 'i94mon', 'i94addr', 'arrdate', 'admnum'],
+     'checks': [{'metric': 'row_count', 'min': 40790529},
+                {'metric': 'row_count_delta_pct', 'min': 0, 'max': 50},
+                {'metric': 'null_rate', 'column': 'cicid', 'max': 0},
+                {'metric': 'null_rate', 'column': 'arrdate', 'max': 0},
+                {'metric': 'min', 'column': 'i94mon', 'min': 1},
+                {'metric': 'max', 'column': 'i94mon', 'max': 12}]},
+    {'table': 'staging_us_city_demographics',
+     'columns': ['state_code', 'city', 'race'],
+     'checks': [{'metric': 'row_count', 'min': 2891},
+                {'metric': 'null_rate', 'column': 'state_code', 'max': 0},
+                {'metric': 'distinct', 'column': 'race', 'max': 5}]},
+    {'table': 'staging_world_temperatures',
+     'columns': ['dt', 'city', 'latitude', 'longitude'],
+     'checks': [{'metric': 'row_count', 'min': 8599212},
+                {'metric': 'null_rate', 'column': 'latitude', 'max': 0},
+                {'metric': 'null_rate', 'column': 'longitude', 'max': 0}]},
+    {'table': 'i94addrl',
+     'checks': [{'metric': 'row_count', 'min': 55, 'max': 55}]},
+    {'table': 'i94cntyl',
+     'checks': [{'metric': 'row_count', 'min': 289, 'max': 289}]},
+    {'table': 'i94model',
+     'checks': [{'metric': 'row_count', 'min': 4, 'max': 4}]},
+    {'table': 'i94prtl',
+     'checks': [{'metric': 'row_count', 'min': 697, 'max': 697}]},
+    {'table': 'i94visal',
+     'checks': [{'metric': 'row_count', 'min': 3, 'max': 3}]}
+]
+
+insert_profiles = [
+    {'table': 'airport_codes',
+     'columns': ['ident', 'latitude', 'longitude'],
+     'checks': [{'metric': 'null_rate', 'column': 'ident', 'max': 0},
+                {'metric': 'min', 'column': 'latitude', 'min': -90},
+                {'metric': 'max', 'column': 'latitude', 'max': 90}]},
+    {'table': 'i94_immigration',
+     'columns': ['i94yr', 'i94mon', 'i94addr', 'gender', 'visatype'],
+     'checks': [{'metric': 'row_count', 'min': 40790529},
+                {'metric': 'row_count_delta_pct', 'min': 0, 'max': 50},
+                {'metric': 'min', 'column': 'i94mon', 'min': 1},
+                {'metric': 'max', 'column': 'i94mon', 'max': 12},
+                {'metric': 'null_rate', 'column': 'gender', 'max': 0.25},
+                {'metric': 'distinct', 'column': 'i94addr', 'max': 60}]},
+    {'table': 'us_city_demographics',
+     'columns': ['state_code'],
+     'checks': [{'metric': 'null_rate', 'column': 'state_code', 'max': 0}]},
+    {'table': 'world_temperatures',
+     'columns': ['dt', 'latitude', 'longitude'],
+     'checks': [{'metric': 'row_count', 'min': 8599212},
+                {'metric': 'min', 'column': 'latitude', 'min': -90},
+                {'metric': 'max', 'column': 'latitude', 'max': 90},
+                {'metric': 'min', 'column': 'longitude', 'min': -180},
+                {'metric': 'max', 'column': 'longitude', 'max': 180}]},
+    {'table': 'us_state_visitor_demographics',
+     'columns': ['state_code', 'visit_total'],
+     'checks': [{'metric': 'null_rate', 'column': 'state_code', 'max': 0},
+                {'metric': 'min', 'column': 'visit_total', 'min': 0}]}
+]
+
+
+def apply_column_encodings(query, encodings):
+    """
+    Adds 'ENCODE <encoding>' after the data type of each column in a CREATE TABLE query.
+
+    Args:
+        query (str): CREATE TABLE query.
+        encodings (dict): Table name mapped to {column: encoding}, as written by 'compression.py'.
+    Returns:
+        str: CREATE TABLE query with column encodings.
+    """
+    table = re.search(r'CREATE TABLE (?:IF NOT EXISTS )?(?:public\.)?"?(\w+)"?', query).group(1)
+    table_encodings = encodings.get(table, {})
+    if not table_encodings:
+        return query
+
+    def encode_column(match):
+        column = match.group(2)
+        if column not in table_encodings or 'ENCODE' in match.group(4).upper():
+            return match.group(0)
+        return '{}{}{} ENCODE {}{}'.format(match.group(1), match.group(2), match.group(3),
+                                          table_encodings[column], match.group(4))
+
+    return re.sub(r'^(\s+"?)(\w+)("?\s+\w+(?:\(\d+(?:,\s*\d+)?\))?)(.*)$', encode_column, query, flags=re.MULTILINE)
+
+
+# With SCD2, us_city_demographics and its history persist across full loads and the
+# pivot is merged into them instead of rebuilding the table.
+if city_demographics_load == 'scd2':
+    drop_table_queries = [query for query in drop_table_queries if query is not us_city_demographics_table_drop]
+    create_table_queries = create_table_queries + [us_city_demographics_history_create]
+    insert_table_steps = [dict(step, query=us_city_demographics_scd2_merge,
+                               outputs=['us_city_demographics', 'us_city_demographics_history'])
+                          if step['name'] == 'us_city_demographics_table_insert' else step
+                          for step in insert_table_steps]
+    insert_table_queries = [step['query'] for step in insert_table_steps]
+    carry_over_tables = ['us_city_demographics', 'us_city_demographics_history']
+    insert_checks = insert_checks + [
+        {'check_sql': """SELECT COUNT(*)
+                           FROM (SELECT state_code, city
+                                   FROM us_city_demographics_history
+                                  WHERE is_current
+                                  GROUP BY state_code, city
+                                 HAVING COUNT(*) > 1) d""", 'expected_result': 0},
+        {'check_sql': """SELECT COUNT(*)
+                           FROM us_city_demographics c
+                           FULL JOIN (SELECT state_code, city
+                                        FROM us_city_demographics_history
+                                       WHERE is_current) h
+                                  ON c.state_code = h.state_code
+                                 AND c.city = h.city
+                          WHERE c.city IS NULL
+                             OR h.city IS NULL""", 'expected_result': 0}]
+
+
+if column_encodings_path and os.path.exists(column_encodings_path):
+    with open(column_encodings_path) as f:
+        column_encodings = json.load(f)
+    create_table_queries = [apply_column_encodings(query, column_encodings) for query in create_table_queries]
+
+
+# With the Spark transform, i94_immigration is COPYed from typed parquet and the
+# float8 staging_i94_immigration table and its insert are not used.
+if i94_transform == 'spark':
+    copy_table_queries = [query for query in copy_table_queries
+                          if query is not staging_i94_immigration_copy] + [i94_immigration_copy]
+    insert_table_steps = [step for step in insert_table_steps
+                          if step['name'] != 'i94_immigration_table_insert']
+    insert_table_queries = [step['query'] for step in insert_table_steps]
+    staging_checks = [check for check in staging_checks
+                      if 'staging_i94_immigration' not in check['check_sql']] \
+                   + [check for check in insert_checks if check['check_sql'].endswith('FROM i94_immigration')]
+    staging_profiles = [profile for profile in staging_profiles
+                        if profile['table'] != 'staging_i94_immigration'] \
+                     + [profile for profile in insert_profiles if profile['table'] == 'i94_immigration']
\ No newline at end of file
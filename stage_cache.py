@@ -0,0 +1,117 @@
+# IMPORTS
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+
+staged_files_table_create = ("""
+    CREATE TABLE IF NOT EXISTS staged_files (
+        s3_key TEXT PRIMARY KEY,
+        source_path TEXT NOT NULL,
+        source_hash TEXT NOT NULL,
+        source_size INTEGER NOT NULL,
+        source_mtime_ns INTEGER NOT NULL,
+        etag TEXT NOT NULL,
+        staged_at TEXT NOT NULL
+    );
+""")
+
+
+def open_cache(path):
+    """
+    Opens (and creates if needed) the SQLite manifest of staged files.
+
+    Args:
+        path (str): SQLite database file.
+    Returns:
+        sqlite3.Connection: Cache connection.
+    """
+    cache = sqlite3.connect(path, check_same_thread=False)
+    cache.execute(staged_files_table_create)
+    cache.commit()
+    return cache
+
+
+def file_hash(path, cache=None, s3_key=None):
+    """
+    Returns the SHA-256 of a local file. When the cache already holds the file
+    with the same size and mtime, the stored hash is reused instead of re-reading it.
+
+    Args:
+        path (str): Local file path.
+        cache (sqlite3.Connection): Optional cache to reuse a stored hash from.
+        s3_key (str): Key the file is staged to, used to look up the stored hash.
+    Returns:
+        str: Hex digest.
+    """
+    stat = os.stat(path)
+    if cache is not None and s3_key is not None:
+        row = cache.execute("""SELECT source_hash FROM staged_files
+                                WHERE s3_key = ? AND source_path = ?
+                                  AND source_size = ? AND source_mtime_ns = ?""",
+                            (s3_key, path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def prefix_etag(objects):
+    """
+    Combines the ETags of every object under a prefix (e.g. a parquet directory)
+    into a single value that changes when any part changes.
+
+    Args:
+        objects (dict): Listing from 'manifest.list_s3_objects'.
+    Returns:
+        str: Combined ETag.
+    """
+    md5 = hashlib.md5()
+    for key in sorted(objects):
+        md5.update('{}:{}\n'.format(key, objects[key]['version']).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def is_unchanged(cache, path, s3_key, current_etag):
+    """
+    Checks whether a source file was already staged to 's3_key' with the same
+    content and the S3 object has not changed since.
+
+    Args:
+        cache (sqlite3.Connection): Cache connection.
+        path (str): Local source file.
+        s3_key (str): Key (or prefix) the file is staged to.
+        current_etag (str): ETag currently in S3, or None if the object is missing.
+    Returns:
+        bool: True if the upload can be skipped.
+    """
+    row = cache.execute("SELECT source_hash, source_size, etag FROM staged_files WHERE s3_key = ?",
+                        (s3_key,)).fetchone()
+    if row is None or current_etag is None or row[2] != current_etag:
+        return False
+    return row[1] == os.path.getsize(path) and row[0] == file_hash(path, cache, s3_key)
+
+
+def record(cache, path, s3_key, etag):
+    """
+    Records that a source file has been staged to 's3_key'.
+
+    Args:
+        cache (sqlite3.Connection): Cache connection.
+        path (str): Local source file.
+        s3_key (str): Key (or prefix) the file was staged to.
+        etag (str): ETag of the staged object.
+    Returns:
+        None
+    """
+    stat = os.stat(path)
+    cache.execute("""INSERT OR REPLACE INTO staged_files
+                     (s3_key, source_path, source_hash, source_size, source_mtime_ns, etag, staged_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                  (s3_key, path, file_hash(path), stat.st_size, stat.st_mtime_ns, etag,
+                   datetime.utcnow().isoformat()))
+    cache.commit()
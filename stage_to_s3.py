@@ -1,8 +1,17 @@
 # Imports and installs
 import boto3
 import configparser
+import glob
 import os
-from pyspark.sql import SparkSession
+import shutil
+import tempfile
+from csv_split import part_count, split_csv
+from distkeys import SLICES_PER_NODE
+from manifest import list_s3_objects, build_manifest, upload_manifest
+from s3_upload import MB, RETRY_CONFIG, object_etag, upload_files
+from sas_to_parquet import convert_all
+from stage_cache import open_cache, is_unchanged, prefix_etag, record
+from sql_queries import csv_compression, csv_manifest_key
 
 config = configparser.ConfigParser()
 config.read_file(open('dwh.cfg'))
@@ -10,44 +19,48 @@ os.environ["AWS_ACCESS_KEY_ID"]= config['AWS']['KEY']
 os.environ["AWS_SECRET_ACCESS_KEY"]= config['AWS']['SECRET']
 s3_bucket = config.get("S3","BUCKET")
 s3_raw_data = 's3a://' + s3_bucket + '/raw'
+upload_concurrency = config.getint("S3", "upload_concurrency", fallback=4)
+multipart_chunksize = config.getint("S3", "multipart_chunksize_mb", fallback=64) * MB
+part_concurrency = config.getint("S3", "part_concurrency", fallback=8)
+stage_cache_path = config.get("S3", "stage_cache", fallback="stage_cache.sqlite")
+i94_transform = config.get("ETL", "i94_transform", fallback="redshift")
+# 'python' converts the SAS files with 'sas_to_parquet.py'; Spark is then only needed for 'i94_transform = spark'.
+sas_converter = config.get("S3", "sas_converter", fallback="python")
+sas_processes = config.getint("S3", "sas_processes", fallback=4)
+sas_max_memory = config.getint("S3", "sas_max_memory_mb", fallback=2048) * MB
+csv_parts_per_slice = config.getint("S3", "csv_parts_per_slice", fallback=1)
+csv_split_min_bytes = config.getint("S3", "csv_split_min_mb", fallback=64) * MB
+cluster_slices = config.getint("DWH", "dwh_num_nodes", fallback=2) \
+    * SLICES_PER_NODE.get(config.get("DWH", "dwh_node_type", fallback="dc2.large"), 2)
 
-s3 = boto3.resource('s3', region_name="us-west-2")
-
-spark = SparkSession \
-    .builder \
-    .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0,saurfang:spark-sas7bdat:2.0.0-s_2.11") \
-    .enableHiveSupport().getOrCreate()
-
-# Load I94 Immigration Data to Spark
-i94_jan16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_jan16_sub.sas7bdat')
-i94_feb16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_feb16_sub.sas7bdat')
-i94_mar16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_mar16_sub.sas7bdat')
-i94_apr16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_apr16_sub.sas7bdat')
-i94_may16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_may16_sub.sas7bdat')
-i94_jun16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_jun16_sub.sas7bdat')
-i94_jul16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_jul16_sub.sas7bdat')
-i94_aug16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_aug16_sub.sas7bdat')
-i94_sep16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_sep16_sub.sas7bdat')
-i94_oct16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_oct16_sub.sas7bdat')
-i94_nov16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_nov16_sub.sas7bdat')
-i94_dec16_sub =spark.read.format('com.github.saurfang.sas.spark').load('/data/18-83510-I94-Data-2016/i94_dec16_sub.sas7bdat')
+s3 = boto3.resource('s3', region_name="us-west-2", config=RETRY_CONFIG)
+cache = open_cache(stage_cache_path)
 
-# Remove extra columns in June 2016 data
-columns_to_drop = ['validres','delete_days','delete_mexl','delete_dup','delete_visa','delete_recdup']
-i94_jun16_sub = i94_jun16_sub.drop(*columns_to_drop)
-
-df_i94 = [i94_jan16_sub,
-          i94_feb16_sub,
-          i94_mar16_sub,
-          i94_apr16_sub,
-          i94_may16_sub,
-          i94_jun16_sub,
-          i94_jul16_sub,
-          i94_aug16_sub,
-          i94_sep16_sub,
-          i94_oct16_sub,
-          i94_nov16_sub,
-          i94_dec16_sub]
+spark = None
+
+
+def get_spark():
+    """
+    Starts the SparkSession on first use, so re-stages with nothing to convert skip it.
+
+    Returns:
+        SparkSession: Spark session with the hadoop-aws and spark-sas7bdat packages.
+    """
+    global spark
+    if spark is None:
+        from pyspark.sql import SparkSession
+        spark = SparkSession \
+            .builder \
+            .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0,saurfang:spark-sas7bdat:2.0.0-s_2.11") \
+            .enableHiveSupport().getOrCreate()
+    return spark
+
+
+# I94 Immigration Data
+i94_sas_path = '/data/18-83510-I94-Data-2016/{}.sas7bdat'
+# With 'i94_transform = spark' the cleaning runs here and typed parquet is written for a direct COPY.
+i94_dataset = 'i94_immigration_clean' if i94_transform == 'spark' else 'i94_immigration_data'
+lookups = None
 
 df_i94_names = ['i94_jan16_sub',
                 'i94_feb16_sub',
@@ -62,23 +75,111 @@ df_i94_names = ['i94_jan16_sub',
                 'i94_nov16_sub',
                 'i94_dec16_sub']
 
-# Upload I94 Immigration Data to S3
-count=0
-for i,df in enumerate(df_i94):
-    df.write.mode('ignore').parquet(s3_raw_data + '/i94_immigration_data/' + df_i94_names[count])
-    print('Upload of ' + df_i94_names[count] + '...complete')
-    count += 1
-    
-# Upload Raw and Lookup data to S3
-s3.meta.client.upload_file('/data2/GlobalLandTemperaturesByCity.csv', s3_bucket, 'raw/world_temperature_data/GlobalLandTemperaturesByCity.csv')
-s3.meta.client.upload_file('./raw_data/us-cities-demographics.csv', s3_bucket, 'raw/us_city_demographic_data/us-cities-demographics.csv')
-s3.meta.client.upload_file('./raw_data/airport-codes_csv.csv', s3_bucket, 'raw/airport_code_data/airport-codes_csv.csv')
-s3.meta.client.upload_file('./lookup_data/i94addrl.csv', s3_bucket, 'lookup/i94addrl.csv')
-s3.meta.client.upload_file('./lookup_data/i94cntyl.csv', s3_bucket, 'lookup/i94cntyl.csv')
-s3.meta.client.upload_file('./lookup_data/i94model.csv', s3_bucket, 'lookup/i94model.csv')
-s3.meta.client.upload_file('./lookup_data/i94prtl.csv', s3_bucket, 'lookup/i94prtl.csv')
-s3.meta.client.upload_file('./lookup_data/i94prtl_enriched.csv', s3_bucket, 'lookup/i94prtl_enriched.csv')
-s3.meta.client.upload_file('./lookup_data/i94visal.csv', s3_bucket, 'lookup/i94visal.csv')
-print('Upload of CSV data...complete')
+# Remove extra columns in June 2016 data
+columns_to_drop = ['validres','delete_days','delete_mexl','delete_dup','delete_visa','delete_recdup']
+
+# Upload I94 Immigration Data to S3, skipping months whose SAS file and parquet output are unchanged
+changed_months = []
+for name in df_i94_names:
+    sas_path = i94_sas_path.format(name)
+    prefix = 'raw/' + i94_dataset + '/' + name + '/'
+    objects = list_s3_objects(s3.meta.client, s3_bucket, prefix)
+    if objects and is_unchanged(cache, sas_path, prefix, prefix_etag(objects)):
+        print('Upload of ' + name + '...unchanged, skipped')
+    else:
+        changed_months.append(name)
+
+convert_dir = tempfile.mkdtemp(prefix='sas_to_parquet_')
+sas_jobs = [(i94_sas_path.format(name), os.path.join(convert_dir, name), columns_to_drop if name == 'i94_jun16_sub' else [])
+            for name in changed_months] if sas_converter == 'python' and i94_transform != 'spark' else []
+try:
+    # Months are converted in a process pool and each is uploaded as soon as it is done.
+    for (sas_path, output_dir, _), result in convert_all(sas_jobs, sas_processes, sas_max_memory):
+        name = os.path.basename(output_dir)
+        prefix = 'raw/' + i94_dataset + '/' + name + '/'
+        part_uploads = [(path, prefix + os.path.basename(path)) for path in sorted(glob.glob(os.path.join(output_dir, '*')))]
+        upload_files(s3.meta.client, part_uploads, s3_bucket,
+                     max_workers=upload_concurrency,
+                     chunk_size=multipart_chunksize,
+                     part_concurrency=part_concurrency)
+        # Replace the month like Spark's 'overwrite' mode: parts of the previous output are removed.
+        stale_keys = sorted(set(list_s3_objects(s3.meta.client, s3_bucket, prefix)) - set(key for _, key in part_uploads))
+        for start in range(0, len(stale_keys), 1000):
+            s3.meta.client.delete_objects(Bucket=s3_bucket,
+                                          Delete={'Objects': [{'Key': key} for key in stale_keys[start:start + 1000]]})
+        shutil.rmtree(output_dir)
+        record(cache, sas_path, prefix, prefix_etag(list_s3_objects(s3.meta.client, s3_bucket, prefix)))
+        print('Upload of ' + name + '...complete ({} rows)'.format(result['rows']))
+finally:
+    shutil.rmtree(convert_dir, ignore_errors=True)
+
+for name in ([] if sas_jobs else changed_months):
+    sas_path = i94_sas_path.format(name)
+    prefix = 'raw/' + i94_dataset + '/' + name + '/'
+    df = get_spark().read.format('com.github.saurfang.sas.spark').load(sas_path)
+    if name == 'i94_jun16_sub':
+        df = df.drop(*columns_to_drop)
+    if i94_transform == 'spark':
+        from i94_transform import load_lookups, transform_i94
+        if lookups is None:
+            lookups = load_lookups(get_spark())
+        df = transform_i94(df, lookups)
+    df.write.mode('overwrite').parquet(s3_raw_data + '/' + i94_dataset + '/' + name)
+    record(cache, sas_path, prefix, prefix_etag(list_s3_objects(s3.meta.client, s3_bucket, prefix)))
+    print('Upload of ' + name + '...complete')
+
+# Split Raw data into compressed parts, a multiple of the cluster's slices, so COPY loads them in parallel
+# (local path, dataset folder, file name without extension, fields may be quoted)
+csv_splits = [('/data2/GlobalLandTemperaturesByCity.csv', 'world_temperature_data', 'GlobalLandTemperaturesByCity', True),
+              ('./raw_data/us-cities-demographics.csv', 'us_city_demographic_data', 'us-cities-demographics', False),
+              ('./raw_data/airport-codes_csv.csv', 'airport_code_data', 'airport-codes_csv', True)]
+
+for path, dataset, name, quoted in csv_splits:
+    manifest_key = csv_manifest_key.format(dataset, name)
+    if is_unchanged(cache, path, manifest_key, object_etag(s3.meta.client, s3_bucket, manifest_key)):
+        print('Upload of ' + manifest_key + '...unchanged, skipped')
+        continue
+
+    parts = part_count(os.path.getsize(path), cluster_slices, csv_parts_per_slice, csv_split_min_bytes)
+    split_dir = tempfile.mkdtemp(prefix='csv_split_')
+    try:
+        part_paths = split_csv(path, split_dir, parts, csv_compression, header=True, quoted=quoted)
+        part_uploads = [(part_path, 'raw/{}/{}.{}/{}'.format(dataset, name, csv_compression, os.path.basename(part_path)))
+                        for part_path in part_paths]
+        upload_files(s3.meta.client, part_uploads, s3_bucket,
+                     max_workers=upload_concurrency,
+                     chunk_size=multipart_chunksize,
+                     part_concurrency=part_concurrency)
+        # The manifest lists exactly this split, so parts left by an earlier split with more parts are not loaded.
+        objects = dict((key, {'size': os.path.getsize(part_path)}) for part_path, key in part_uploads)
+        upload_manifest(s3.meta.client, s3_bucket, manifest_key,
+                        build_manifest(s3_bucket, [key for _, key in part_uploads], objects))
+    finally:
+        shutil.rmtree(split_dir)
+    record(cache, path, manifest_key, object_etag(s3.meta.client, s3_bucket, manifest_key))
+    print('Upload of ' + name + '...complete ({} {} parts)'.format(len(part_paths), csv_compression))
+
+# Upload Lookup data to S3
+csv_uploads = [('./lookup_data/i94addrl.csv', 'lookup/i94addrl.csv'),
+               ('./lookup_data/i94cntyl.csv', 'lookup/i94cntyl.csv'),
+               ('./lookup_data/i94model.csv', 'lookup/i94model.csv'),
+               ('./lookup_data/i94prtl.csv', 'lookup/i94prtl.csv'),
+               ('./lookup_data/i94prtl_enriched.csv', 'lookup/i94prtl_enriched.csv'),
+               ('./lookup_data/i94visal.csv', 'lookup/i94visal.csv')]
+
+changed_uploads = []
+for path, key in csv_uploads:
+    if is_unchanged(cache, path, key, object_etag(s3.meta.client, s3_bucket, key)):
+        print('Upload of ' + key + '...unchanged, skipped')
+    else:
+        changed_uploads.append((path, key))
+
+upload_files(s3.meta.client, changed_uploads, s3_bucket,
+             max_workers=upload_concurrency,
+             chunk_size=multipart_chunksize,
+             part_concurrency=part_concurrency)
+for path, key in changed_uploads:
+    record(cache, path, key, object_etag(s3.meta.client, s3_bucket, key))
+print('Upload of lookup data...complete')
 
 # EOF
\ No newline at end of file
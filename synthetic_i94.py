@@ -0,0 +1,252 @@
+# IMPORTS
+import argparse
+import calendar
+import datetime
+import glob
+import os
+import re
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+SAS_EPOCH = datetime.date(1960, 1, 1)
+# Code columns where codes from 'lookup_data' that never occur in the samples are
+# mixed in, so the lookup normalization sees its long tail; column -> lookup file.
+TAIL_LOOKUPS = {'i94port': 'i94prtl.csv', 'i94cit': 'i94cntyl.csv', 'i94addr': 'i94addrl.csv'}
+SCALES = {'1M': 1000000, '10M': 10000000, '100M': 100000000}
+
+
+def parse_rows(value):
+    """
+    Args:
+        value (str): Row count, example: '10M', '500k' or '250000'.
+    Returns:
+        int: Row count.
+    """
+    match = re.match(r'^(\d+)([kKmM]?)$', value)
+    if not match:
+        raise argparse.ArgumentTypeError('Invalid row count: ' + value)
+    return int(match.group(1)) * {'': 1, 'k': 1000, 'm': 1000000}[match.group(2).lower()]
+
+
+def read_samples(parquet_glob='sas_data/*.parquet', csv_path='raw_data/immigration_data_sample.csv'):
+    """
+    Reads the i94 samples: the parquet extract and the 1,000-row CSV, cast to the
+    parquet schema written by 'stage_to_s3.py'.
+
+    Args:
+        parquet_glob (str): Parquet sample files.
+        csv_path (str): CSV sample file.
+    Returns:
+        pyarrow.Table: Sample rows.
+    """
+    tables = [pq.read_table(path) for path in sorted(glob.glob(parquet_glob))]
+    schema = tables[0].schema.remove_metadata() if tables else None
+    if os.path.exists(csv_path):
+        column_types = dict((field.name, field.type) for field in schema) if schema else None
+        sample = pv.read_csv(csv_path, convert_options=pv.ConvertOptions(column_types=column_types,
+                                                                         strings_can_be_null=True))
+        sample = sample.drop([name for name in sample.column_names if name == '' or name.startswith('Unnamed')])
+        tables.append(sample.cast(schema) if schema else sample)
+    if not tables:
+        raise Exception('No i94 samples found in ' + parquet_glob + ' or ' + csv_path)
+    return pa.concat_tables([table.cast(schema) if schema else table for table in tables])
+
+
+def read_lookup_codes(lookup_dir='lookup_data'):
+    """
+    Args:
+        lookup_dir (str): Directory with the lookup CSV files.
+    Returns:
+        dict: Lookup file name mapped to its list of codes.
+    """
+    codes = {}
+    for name in set(TAIL_LOOKUPS.values()):
+        table = pv.read_csv(os.path.join(lookup_dir, name),
+                            read_options=pv.ReadOptions(column_names=['id', 'name']),
+                            convert_options=pv.ConvertOptions(column_types={'id': pa.string()}))
+        codes[name] = [code.strip() for code in table.column('id').to_pylist() if code and code.strip()]
+    return codes
+
+
+def learn(sample, lookup_codes, max_templates=500000, tail_rate=0.001, seed=0):
+    """
+    Learns the generator model from the samples. Whole sample rows are kept as
+    templates, so the joint distribution of codes, visa types, modes, airlines,
+    flags and stay lengths (all cross-column correlations) is preserved; the
+    arrival day of month is learned as its own distribution so any month can be
+    generated, and lookup codes missing from the samples form a small tail.
+
+    Args:
+        sample (pyarrow.Table): Output of 'read_samples'.
+        lookup_codes (dict): Output of 'read_lookup_codes'.
+        max_templates (int): Maximum number of template rows kept in memory.
+        tail_rate (float): Share of rows given a code seen only in the lookups.
+        seed (int): Random seed for the template subsample.
+    Returns:
+        dict: Generator model.
+    """
+    rng = np.random.default_rng(seed)
+    if sample.num_rows > max_templates:
+        sample = sample.take(np.sort(rng.choice(sample.num_rows, max_templates, replace=False)))
+
+    arrdate = sample.column('arrdate').to_numpy(zero_copy_only=False)
+    arrdate = arrdate[~np.isnan(arrdate)].astype(np.int64)
+    day_of_month = np.array([(SAS_EPOCH + datetime.timedelta(days=int(day))).day for day in np.unique(arrdate)])
+    day_counts = np.array([np.sum(arrdate == day) for day in np.unique(arrdate)], dtype=np.float64)
+
+    tail_codes = {}
+    for column, lookup in TAIL_LOOKUPS.items():
+        seen = set(str(value).split('.')[0] for value in pc.unique(sample.column(column)).to_pylist() if value is not None)
+        tail_codes[column] = [code for code in lookup_codes[lookup] if code not in seen]
+
+    return {'templates': sample,
+            'day_of_month': day_of_month,
+            'day_probabilities': day_counts / day_counts.sum(),
+            'tail_codes': tail_codes,
+            'tail_rate': tail_rate}
+
+
+def shift_date_strings(column, shift, fmt):
+    """
+    Moves date strings by a number of days, keeping unparsable values ('D/S') as they are.
+
+    Args:
+        column (pyarrow.Array): Date strings.
+        shift (numpy.ndarray): Days to add, per row.
+        fmt (str): strptime format of the strings, example: '%Y%m%d'.
+    Returns:
+        pyarrow.Array: Shifted date strings.
+    """
+    parsed = pc.strptime(column, format=fmt, unit='s', error_is_null=True)
+    days = pc.cast(pc.cast(parsed, pa.int64()), pa.float64()).to_numpy(zero_copy_only=False) / 86400 + shift
+    valid = ~np.isnan(days)
+    shifted = pa.array(np.where(valid, days, 0).astype('datetime64[D]').astype('datetime64[s]'), mask=~valid)
+    return pc.if_else(pc.is_valid(parsed), pc.strftime(shifted, format=fmt), column)
+
+
+def generate_chunk(model, rows, first_cicid, year, months, rng):
+    """
+    Generates one chunk of synthetic i94 rows with the schema of the samples.
+
+    Args:
+        model (dict): Output of 'learn'.
+        rows (int): Rows to generate.
+        first_cicid (int): cicid of the first row; ids are sequential.
+        year (int): i94yr of the generated rows.
+        months (list): Months the rows are spread over, uniformly.
+        rng (numpy.random.Generator): Random generator.
+    Returns:
+        pyarrow.Table: Generated rows.
+    """
+    templates = model['templates']
+    chunk = templates.take(rng.integers(0, templates.num_rows, rows))
+    columns = dict((name, chunk.column(name).combine_chunks()) for name in chunk.column_names)
+
+    # Arrival dates: month, then day of month from the learned distribution.
+    month = rng.choice(months, rows)
+    month_start = np.array([(datetime.date(year, m, 1) - SAS_EPOCH).days for m in range(1, 13)])[month - 1]
+    month_days = np.array([calendar.monthrange(year, m)[1] for m in range(1, 13)])[month - 1]
+    day = np.minimum(rng.choice(model['day_of_month'], rows, p=model['day_probabilities']), month_days)
+    arrdate = (month_start + day - 1).astype(np.float64)
+    # Every other date moves with the arrival date, preserving stays and gaps.
+    shift = arrdate - columns['arrdate'].to_numpy(zero_copy_only=False)
+    columns['arrdate'] = pa.array(arrdate)
+    columns['depdate'] = pa.array(columns['depdate'].to_numpy(zero_copy_only=False) + shift, from_pandas=True)
+    columns['dtadfile'] = shift_date_strings(columns['dtadfile'], shift, '%Y%m%d')
+    columns['dtaddto'] = shift_date_strings(columns['dtaddto'], shift, '%m%d%Y')
+    columns['i94yr'] = pa.array(np.full(rows, float(year)))
+    columns['i94mon'] = pa.array(month.astype(np.float64))
+
+    # Ages jitter by up to two years; birth year follows.
+    age = columns['i94bir'].to_numpy(zero_copy_only=False) + rng.integers(-2, 3, rows)
+    age = np.where(age < 0, 0, age)
+    columns['i94bir'] = pa.array(age, from_pandas=True)
+    columns['biryear'] = pa.array(year - age, from_pandas=True)
+
+    columns['cicid'] = pa.array(np.arange(first_cicid, first_cicid + rows, dtype=np.float64))
+    columns['admnum'] = pa.array(rng.integers(10 ** 10, 10 ** 11, rows).astype(np.float64))
+
+    # Long tail of lookup codes that never occur in the samples.
+    for column, codes in model['tail_codes'].items():
+        if not codes:
+            continue
+        tail = rng.random(rows) < model['tail_rate']
+        values = pa.array(rng.choice(codes, rows))
+        if pa.types.is_floating(columns[column].type):
+            values = pc.cast(values, pa.float64(), safe=False) if all(code.isdigit() for code in codes) else None
+        if values is not None:
+            columns[column] = pc.if_else(pa.array(tail), values, columns[column])
+
+    return pa.table([columns[name] for name in chunk.column_names], schema=chunk.schema)
+
+
+def generate(model, rows, output_dir, formats=('parquet',), rows_per_file=1000000, year=2016,
+             months=range(1, 13), seed=0):
+    """
+    Writes 'rows' synthetic i94 rows as numbered part files, chunk by chunk, so the
+    size of the output is not limited by memory.
+
+    Args:
+        model (dict): Output of 'learn'.
+        rows (int): Total rows.
+        output_dir (str): Directory written with 'parquet/' and 'csv/' subfolders.
+        formats (tuple): 'parquet' and/or 'csv'.
+        rows_per_file (int): Rows per part file.
+        year (int): i94yr of the generated rows.
+        months (list): Months the rows are spread over.
+        seed (int): Random seed.
+    Returns:
+        dict: Format mapped to the glob of the files written.
+    """
+    rng = np.random.default_rng(seed)
+    months = np.array(list(months))
+    for fmt in formats:
+        os.makedirs(os.path.join(output_dir, fmt), exist_ok=True)
+        for path in glob.glob(os.path.join(output_dir, fmt, 'part-*')):
+            os.remove(path)
+
+    written = 0
+    part = 0
+    while written < rows:
+        chunk = generate_chunk(model, min(rows_per_file, rows - written), written + 1, year, months, rng)
+        if 'parquet' in formats:
+            pq.write_table(chunk, os.path.join(output_dir, 'parquet', 'part-{:05d}.snappy.parquet'.format(part)),
+                           compression='snappy')
+        if 'csv' in formats:
+            pv.write_csv(chunk, os.path.join(output_dir, 'csv', 'part-{:05d}.csv'.format(part)))
+        written += chunk.num_rows
+        part += 1
+        print('{:>12} / {} rows'.format(written, rows))
+    return dict((fmt, os.path.join(output_dir, fmt, 'part-*')) for fmt in formats)
+
+
+def main():
+    """
+    Learns from the i94 samples and lookups and writes a synthetic dataset.
+    """
+    parser = argparse.ArgumentParser(description='Generate synthetic I94 immigration data.')
+    parser.add_argument('--rows', type=parse_rows, default='1M',
+                        help="rows to generate, example: 1M, 10M, 100M (default 1M)")
+    parser.add_argument('--format', choices=['parquet', 'csv', 'both'], default='parquet')
+    parser.add_argument('--output-dir', default=None,
+                        help="default 'synthetic_data/<rows>'")
+    parser.add_argument('--rows-per-file', type=parse_rows, default='1M')
+    parser.add_argument('--year', type=int, default=2016)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    formats = ('parquet', 'csv') if args.format == 'both' else (args.format,)
+    output_dir = args.output_dir or os.path.join('synthetic_data', str(args.rows))
+    model = learn(read_samples(), read_lookup_codes(), seed=args.seed)
+    print('Learned from {} template rows'.format(model['templates'].num_rows))
+    paths = generate(model, args.rows, output_dir, formats, args.rows_per_file, args.year, seed=args.seed)
+    for fmt, path in sorted(paths.items()):
+        print('\n' + 'Synthetic {} written to {}'.format(fmt, path))
+
+
+if __name__ == "__main__":
+    main()
+#EOF
@@ -0,0 +1,115 @@
+# IMPORTS
+import json
+import boto3
+import pytest
+from moto import mock_aws
+from manifest import list_s3_objects \
+                   , changed_objects \
+                   , changed_months \
+                   , month_keys \
+                   , build_manifest \
+                   , upload_manifest
+
+BUCKET = 'capstone-test'
+PREFIX = 'raw/i94_immigration_data/'
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def put_part(s3_client, month, part, body=b'parquet'):
+    s3_client.put_object(Bucket=BUCKET, Key='{}{}/{}'.format(PREFIX, month, part), Body=body)
+
+
+def stage_loaded_months(s3_client):
+    """
+    Uploads two months of parts and returns their listing as the catalog of a previous load.
+    """
+    for month in ['i94_jan16_sub', 'i94_feb16_sub']:
+        put_part(s3_client, month, 'part-00000.parquet')
+        put_part(s3_client, month, 'part-00001.parquet')
+    return list_s3_objects(s3_client, BUCKET, PREFIX)
+
+
+def test_list_skips_markers_and_empty_files(s3_client):
+    put_part(s3_client, 'i94_jan16_sub', 'part-00000.parquet')
+    put_part(s3_client, 'i94_jan16_sub', '_SUCCESS', b'')
+    put_part(s3_client, 'i94_jan16_sub', '.crc', b'x')
+    put_part(s3_client, 'i94_jan16_sub', 'part-00001.parquet', b'')
+
+    assert list(list_s3_objects(s3_client, BUCKET, PREFIX)) == [PREFIX + 'i94_jan16_sub/part-00000.parquet']
+
+
+def test_unchanged_listing_has_no_changes(s3_client):
+    catalog = stage_loaded_months(s3_client)
+    objects = list_s3_objects(s3_client, BUCKET, PREFIX)
+
+    assert changed_objects(objects, catalog) == []
+    assert changed_months(objects, catalog, PREFIX) == ([], [])
+
+
+def test_added_part(s3_client):
+    catalog = stage_loaded_months(s3_client)
+    put_part(s3_client, 'i94_jan16_sub', 'part-00002.parquet')
+    put_part(s3_client, 'i94_mar16_sub', 'part-00000.parquet')
+    objects = list_s3_objects(s3_client, BUCKET, PREFIX)
+
+    assert changed_objects(objects, catalog) == [PREFIX + 'i94_jan16_sub/part-00002.parquet',
+                                                 PREFIX + 'i94_mar16_sub/part-00000.parquet']
+    assert changed_months(objects, catalog, PREFIX) == (['i94_jan16_sub', 'i94_mar16_sub'], [])
+
+
+def test_changed_part(s3_client):
+    catalog = stage_loaded_months(s3_client)
+    put_part(s3_client, 'i94_feb16_sub', 'part-00001.parquet', b'rewritten parquet')
+    objects = list_s3_objects(s3_client, BUCKET, PREFIX)
+
+    assert changed_objects(objects, catalog) == [PREFIX + 'i94_feb16_sub/part-00001.parquet']
+    assert changed_months(objects, catalog, PREFIX) == (['i94_feb16_sub'], [])
+
+
+def test_removed_part(s3_client):
+    catalog = stage_loaded_months(s3_client)
+    s3_client.delete_object(Bucket=BUCKET, Key=PREFIX + 'i94_jan16_sub/part-00001.parquet')
+    objects = list_s3_objects(s3_client, BUCKET, PREFIX)
+
+    assert changed_objects(objects, catalog) == [PREFIX + 'i94_jan16_sub/part-00001.parquet']
+    assert changed_months(objects, catalog, PREFIX) == (['i94_jan16_sub'], [])
+
+
+def test_removed_month(s3_client):
+    catalog = stage_loaded_months(s3_client)
+    for part in ['part-00000.parquet', 'part-00001.parquet']:
+        s3_client.delete_object(Bucket=BUCKET, Key=PREFIX + 'i94_feb16_sub/' + part)
+    objects = list_s3_objects(s3_client, BUCKET, PREFIX)
+
+    assert changed_objects(objects, catalog) == [PREFIX + 'i94_feb16_sub/part-00000.parquet',
+                                                 PREFIX + 'i94_feb16_sub/part-00001.parquet']
+    assert changed_months(objects, catalog, PREFIX) == ([], ['i94_feb16_sub'])
+
+
+def test_manifest_lists_month_parts_with_sizes(s3_client):
+    catalog = stage_loaded_months(s3_client)
+    put_part(s3_client, 'i94_jan16_sub', 'part-00000.parquet', b'larger parquet part')
+    objects = list_s3_objects(s3_client, BUCKET, PREFIX)
+    month, _ = changed_months(objects, catalog, PREFIX)
+    keys = month_keys(objects, PREFIX)[month[0]]
+
+    manifest = build_manifest(BUCKET, keys, objects)
+    upload_manifest(s3_client, BUCKET, 'manifests/i94_immigration_data/i94_jan16_sub.manifest', manifest)
+    uploaded = json.loads(s3_client.get_object(Bucket=BUCKET,
+                                               Key='manifests/i94_immigration_data/i94_jan16_sub.manifest')['Body'].read())
+
+    assert uploaded == manifest
+    assert manifest == {'entries': [{'url': 's3://{}/{}i94_jan16_sub/part-00000.parquet'.format(BUCKET, PREFIX),
+                                     'mandatory': True,
+                                     'meta': {'content_length': len(b'larger parquet part')}},
+                                    {'url': 's3://{}/{}i94_jan16_sub/part-00001.parquet'.format(BUCKET, PREFIX),
+                                     'mandatory': True,
+                                     'meta': {'content_length': len(b'parquet')}}]}
+#EOF
@@ -0,0 +1,146 @@
+# IMPORTS
+import json
+import os
+from sql_queries import unload_exports, unload_parquet
+
+MANIFEST = 'manifest.json'
+
+
+class S3Target:
+    """
+    S3 bucket the cluster unloads to.
+    """
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def url(self, key):
+        return 's3://{}/{}'.format(self.bucket, key)
+
+    def write(self, key, text):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=text.encode('utf-8'))
+
+    def keys(self, prefix):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        return [obj['Key'] for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+                for obj in page.get('Contents', [])]
+
+    def delete(self, keys):
+        for start in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(Bucket=self.bucket,
+                                          Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]]})
+
+
+class LocalTarget:
+    """
+    Local directory standing in for the S3 bucket, for the local engine.
+    """
+    def __init__(self, directory='unload_data'):
+        self.directory = directory
+
+    def url(self, key):
+        return os.path.join(os.path.abspath(self.directory), key)
+
+    def write(self, key, text):
+        path = self.url(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+    def keys(self, prefix):
+        root = os.path.abspath(self.directory)
+        return sorted(os.path.relpath(os.path.join(folder, name), root).replace(os.sep, '/')
+                      for folder, _, names in os.walk(self.url(prefix)) for name in names)
+
+    def delete(self, keys):
+        for key in keys:
+            os.remove(self.url(key))
+        for key in keys:
+            folder = os.path.dirname(self.url(key))
+            while folder.startswith(os.path.abspath(self.directory) + os.sep) and os.path.isdir(folder) \
+                    and not os.listdir(folder):
+                os.rmdir(folder)
+                folder = os.path.dirname(folder)
+
+
+def unload_prefix(prefix, table, version):
+    """
+    Args:
+        prefix (str): Key prefix of all unloads, example: 'unload'.
+        table (str): Unloaded table.
+        version (str): Load version.
+    Returns:
+        str: Key prefix of the table's files for that load, example: 'unload/i94_immigration/20160131120000/'.
+    """
+    return '{}/{}/{}/'.format(prefix, table, version)
+
+
+def unload_query(export, url, max_file_size_mb=256, schema='public'):
+    """
+    Args:
+        export (dict): Entry of 'unload_exports'.
+        url (str): Target prefix.
+        max_file_size_mb (int): Largest parquet file written.
+        schema (str): Schema the serving tables are in.
+    Returns:
+        str: UNLOAD query.
+    """
+    partition = 'PARTITION BY ({})\n    '.format(', '.join(export['partition_by'])) if export['partition_by'] else ''
+    select = 'SELECT * FROM {}.{}'.format(schema, export['table'])
+    return unload_parquet.format(select.replace("'", "''"), url, partition, max_file_size_mb)
+
+
+def unload_queries(target, version, prefix='unload', max_file_size_mb=256, schema='public', exports=unload_exports):
+    """
+    Args:
+        target (S3Target or LocalTarget): Where the files go.
+        version (str): Load version; each load unloads to its own prefix.
+        prefix (str): Key prefix of all unloads.
+        max_file_size_mb (int): Largest parquet file written.
+        schema (str): Schema the serving tables are in.
+        exports (list): Tables to unload.
+    Returns:
+        list: (table, UNLOAD query) tuples.
+    """
+    return [(export['table'], unload_query(export, target.url(unload_prefix(prefix, export['table'], version)),
+                                           max_file_size_mb, schema))
+            for export in exports]
+
+
+def publish_unload(target, version, prefix='unload', exports=unload_exports, keep_versions=2):
+    """
+    Points readers at this load's files: '<prefix>/manifest.json' lists the prefix,
+    UNLOAD manifest and partition columns of each table, and is replaced only once
+    every table is unloaded. The files of loads older than the last 'keep_versions'
+    are then removed; the ones kept let jobs that read an earlier manifest finish.
+
+    Args:
+        target (S3Target or LocalTarget): Where the files are.
+        version (str): Load version that was unloaded.
+        prefix (str): Key prefix of all unloads.
+        exports (list): Tables that were unloaded.
+        keep_versions (int): Loads kept, this one included; at least 2.
+    Returns:
+        dict: Manifest written.
+    """
+    manifest = {'load_version': version, 'tables': {}}
+    for export in exports:
+        table_prefix = unload_prefix(prefix, export['table'], version)
+        manifest['tables'][export['table']] = {'url': target.url(table_prefix),
+                                               'manifest': target.url(table_prefix + 'manifest'),
+                                               'partition_by': export['partition_by']}
+    target.write(prefix + '/' + MANIFEST, json.dumps(manifest, indent=2, sort_keys=True))
+
+    stale_keys = []
+    for export in exports:
+        table_prefix = prefix + '/' + export['table'] + '/'
+        keys = target.keys(table_prefix)
+        # Versions are run ids ('%Y%m%d%H%M%S'), so they sort in load order.
+        versions = sorted(set(key[len(table_prefix):].split('/')[0] for key in keys) - {version})
+        kept = set(versions[max(0, len(versions) - max(2, keep_versions) + 1):]) | {version}
+        stale_keys += [key for key in keys if key[len(table_prefix):].split('/')[0] not in kept]
+    if stale_keys:
+        target.delete(stale_keys)
+    return manifest
+#EOF